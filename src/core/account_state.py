@@ -0,0 +1,165 @@
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
+from core.encoding import encode_value
+
+MINT_ADDRESS = '0'  # Sender of newly created coins, e.g. mining rewards; never debited
+
+
+def transaction_cost(transaction) -> float:
+    """
+    Total debited from the sender: amount plus fee. Fees are not credited to anyone, since
+    blocks do not name a miner.
+    :raises ValueError: If the amount or fee is not a non-negative number
+    """
+    amount = transaction.amount
+    fee = transaction.extra.get('fee', 0) if transaction.extra else 0
+    for value in (amount, fee):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"Invalid transaction value {value!r}")
+    return amount + fee
+
+
+def transaction_nonce(transaction) -> Optional[int]:
+    """Nonce a transaction was created with: the number of transactions its sender sent before it."""
+    return transaction.extra.get('nonce') if transaction.extra else None
+
+
+class AccountState:
+    """
+    Balance and nonce of every address, maintained incrementally as blocks are applied
+    and reverted, so account queries are O(1) instead of a scan over the chain.
+    The nonce of an address is the number of confirmed transactions it has sent, and every
+    transaction it sends carries the nonce it will take, so a confirmed one cannot be replayed.
+    """
+
+    def __init__(self):
+        self.balances: Dict[str, float] = {}
+        self.nonces: Dict[str, int] = {}
+
+    @classmethod
+    def restore(cls, balances: Dict[str, float], nonces: Dict[str, int]) -> 'AccountState':
+        """Rebuild the state saved in a snapshot."""
+        state = cls()
+        state.balances = dict(balances)
+        state.nonces = dict(nonces)
+        return state
+
+    def digest(self) -> str:
+        """SHA-256 of the canonical encoding of the balances and nonces, which a state checkpoint pins."""
+        payload = bytearray()
+        encode_value({'balances': self.balances, 'nonces': self.nonces}, payload)
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_balance(self, address: str) -> float:
+        return self.balances.get(address, 0)
+
+    def get_nonce(self, address: str) -> int:
+        return self.nonces.get(address, 0)
+
+    def next_nonce(self, address: str, pooled: int = None) -> Optional[int]:
+        """
+        Nonce of the next transaction of an address; None for the mint, which has none
+        :param pooled: Nonce following its pending transactions, if it has any
+        """
+        if address == MINT_ADDRESS:
+            return None
+        return self.get_nonce(address) if pooled is None else max(self.get_nonce(address), pooled)
+
+    def can_spend(self, address: str, cost: float, pending: float = 0) -> bool:
+        """Check that an address can pay cost on top of what it already has pending."""
+        return address == MINT_ADDRESS or self.get_balance(address) - pending >= cost
+
+    def in_sequence(self, transaction, sent: int = 0) -> bool:
+        """
+        Check that a transaction is its sender's next one; minted coins need no nonce
+        :param sent: Transactions of the sender applied before it on top of this state
+        """
+        if transaction.sender == MINT_ADDRESS:
+            return True
+        nonce = transaction_nonce(transaction)
+        return type(nonce) is int and nonce == self.get_nonce(transaction.sender) + sent
+
+    def affordable(self, transactions: Iterable) -> Tuple[List, List]:
+        """
+        Split transactions into those that can be applied in order without overdrafts or nonces
+        out of sequence and the rest
+        :return: (affordable transactions, rejected transactions)
+        """
+        spent: Dict[str, float] = {}
+        sent: Dict[str, int] = {}
+        accepted, rejected = [], []
+        for transaction in transactions:
+            try:
+                cost = transaction_cost(transaction)
+            except ValueError:
+                rejected.append(transaction)
+                continue
+            sender = transaction.sender
+            if not self.can_spend(sender, cost, spent.get(sender, 0)) or not self.in_sequence(
+                    transaction, sent.get(sender, 0)):
+                rejected.append(transaction)
+                continue
+            spent[sender] = spent.get(sender, 0) + cost
+            sent[sender] = sent.get(sender, 0) + 1
+            if transaction.recipient != sender:
+                spent[transaction.recipient] = spent.get(transaction.recipient, 0) - transaction.amount
+            accepted.append(transaction)
+        return accepted, rejected
+
+    def _credit(self, address: str, amount: float):
+        balance = self.balances.get(address, 0) + amount
+        if balance:
+            self.balances[address] = balance
+        else:
+            self.balances.pop(address, None)
+
+    def _count(self, address: str, step: int):
+        nonce = self.nonces.get(address, 0) + step
+        if nonce:
+            self.nonces[address] = nonce
+        else:
+            self.nonces.pop(address, None)
+
+    def apply_block(self, block, check: bool = False):
+        """
+        Apply the transactions of a block
+        :param block: Block with its transactions
+        :param check: Reject the block if any sender would overdraw or a nonce is out of sequence;
+            the state is left unchanged
+        :raises ValueError: If the block has no body, or on an overdraft or a replayed or skipped
+            nonce when check is set
+        """
+        transactions = block.transactions
+        if transactions is None:
+            raise ValueError(f"Block {block.index} has no transactions to apply")
+        applied = []
+        try:
+            for transaction in transactions:
+                cost = transaction_cost(transaction)
+                if check and not self.can_spend(transaction.sender, cost):
+                    raise ValueError(f"Overdraft by {transaction.sender} in block {block.index}")
+                if check and not self.in_sequence(transaction):
+                    raise ValueError(f"Nonce out of sequence for {transaction.sender} in block {block.index}")
+                self._apply(transaction, cost)
+                applied.append((transaction, cost))
+        except ValueError:
+            for transaction, cost in reversed(applied):
+                self._revert(transaction, cost)
+            raise
+
+    def revert_block(self, block):
+        """Undo apply_block for the most recently applied block."""
+        for transaction in reversed(block.transactions):
+            self._revert(transaction, transaction_cost(transaction))
+
+    def _apply(self, transaction, cost):
+        if transaction.sender != MINT_ADDRESS:
+            self._credit(transaction.sender, -cost)
+            self._count(transaction.sender, 1)
+        self._credit(transaction.recipient, transaction.amount)
+
+    def _revert(self, transaction, cost):
+        self._credit(transaction.recipient, -transaction.amount)
+        if transaction.sender != MINT_ADDRESS:
+            self._credit(transaction.sender, cost)
+            self._count(transaction.sender, -1)
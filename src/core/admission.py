@@ -0,0 +1,132 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Hashable, Optional, Tuple
+
+# Requests per second and burst size per route (the name of the view); None is any other route
+DEFAULT_RATE_LIMITS = {
+    'new_transaction': (50, 100),
+    'new_transactions': (20, 40),  # A peer's gossip engine sends up to one batch per 50 ms window
+    'new_block': (20, 50),
+    'register_nodes': (1, 10),
+    'resolve_conflicts': (0.2, 3),
+    None: (100, 200),
+}
+
+
+class Overloaded(RuntimeError):
+    """The work queue is full; the request should be retried later."""
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` per second; each request takes one."""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiting per client and route. A client may send a burst of requests
+    to a route and is then held to the route's steady rate. Buckets of the least recently
+    seen clients are dropped beyond max_buckets; a dropped bucket comes back full.
+    """
+
+    def __init__(self, limits: Dict[Optional[str], Tuple[float, float]] = None, max_buckets: int = 100000):
+        """
+        :param limits: Route -> (requests per second, burst); the None entry applies to routes
+            not listed, and routes without a limit are not limited
+        :param max_buckets: Maximum number of (client, route) buckets kept
+        """
+        self.limits = DEFAULT_RATE_LIMITS if limits is None else limits
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict = OrderedDict()  # (client, route) -> TokenBucket, least recently used first
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def check(self, client: str, route: str) -> float:
+        """
+        Take a token for a request
+        :return: 0 if the request is allowed, otherwise the seconds until a token is available
+        """
+        limit = self.limits.get(route, self.limits.get(None))
+        if limit is None:
+            return 0
+        rate, burst = limit
+        now = time.monotonic()
+        key = (client, route)
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(burst, now)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket.tokens) / rate
+
+    @staticmethod
+    def retry_after(delay: float) -> str:
+        """Value of the Retry-After header for a delay from check, in whole seconds."""
+        return str(max(1, math.ceil(delay)))
+
+
+class WorkQueue:
+    """
+    Bounded queue for expensive operations, run by a few worker threads. A submission beyond
+    max_pending operations waiting or running is rejected at once instead of queueing, and
+    submissions with the same key while one is pending share its run and its result.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8):
+        """
+        :param max_workers: Operations run at once
+        :param max_pending: Operations waiting or running before new ones are rejected
+        """
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='work-queue')
+        self.pending: Dict[Hashable, Future] = {}  # Key -> future of its pending run
+        self.count = 0  # Operations waiting or running
+        self.coalesced = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, key: Hashable = None) -> Future:
+        """
+        Queue a call of function(*args)
+        :param key: Submissions with the same key share a pending run; None to always run
+        :return: Future of the result
+        :raises Overloaded: If max_pending operations are already waiting or running
+        """
+        with self._lock:
+            if key is not None and key in self.pending:
+                self.coalesced += 1
+                return self.pending[key]
+            if self.count >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded('Too many pending operations')
+            self.count += 1
+            future = self.executor.submit(function, *args)
+            if key is not None:
+                self.pending[key] = future
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            self.count -= 1
+            if key is not None and self.pending.get(key) is future:
+                del self.pending[key]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
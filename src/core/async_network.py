@@ -0,0 +1,619 @@
+import asyncio
+import json
+import re
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote
+from core.account_state import MINT_ADDRESS
+from core.admission import Overloaded, RateLimiter, WorkQueue
+from core.gossip import GossipEngine
+from core.network import (EVENT_KEEPALIVE, StaleCursor, address_history_args, block_event, gzip_chunks,
+                          latest_snapshot, mining_stats_args, select_block_range, stream_binary_blocks,
+                          stream_json_blocks, submit_transactions, tip_wait_args)
+from core.peers import BINARY_CHAIN_MIMETYPE, BLOCK_EVENTS_MIMETYPE, CHAIN_LENGTH_HEADER, NEXT_CURSOR_HEADER
+from core.sync import BlockSubscriber, HeaderSync
+
+BLOCK_HASH_PATH = re.compile(r'^/blocks/(\d+)/hash$')
+ACCOUNT_PATH = re.compile(r'^/accounts/([^/]+)$')
+ADDRESS_HISTORY_PATH = re.compile(r'^/accounts/([^/]+)/transactions$')
+TRANSACTION_PATH = re.compile(r'^/transactions/([^/]+)$')
+
+
+class AsyncNetwork:
+    """
+    ASGI application serving the node API of Network without Flask, for one event loop to
+    handle many concurrent connections. Header sync and transaction gossip run as tasks in
+    the same loop; blocking peer requests and chain writes are handed to worker threads. New-block subscriptions
+    and tip long-polls wait on the loop, so they cost no thread.
+    The app runs under any ASGI server, or under the bundled ASGIServer via start().
+    """
+
+    def __init__(self, blockchain, sync_interval: float = 60, rate_limits=None):
+        """
+        :param blockchain: Blockchain to serve
+        :param sync_interval: Seconds between fallback header sync rounds; peers' new blocks
+            are otherwise followed as they are announced
+        :param rate_limits: Per-client rate limits by route, as for Network
+        """
+        self.blockchain = blockchain
+        self.port = 5000  # Default port for the node
+        self.sync_interval = sync_interval
+        self.header_sync = HeaderSync(blockchain)
+        self.block_subscriber = BlockSubscriber(self.header_sync)
+        self.gossip = GossipEngine(blockchain.nodes, self.header_sync.client)
+        self.tasks = []
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.work_queue = WorkQueue()
+        self.routes = {
+            ('GET', '/chain'): self.get_chain,
+            ('GET', '/chain/tip'): self.get_tip,
+            ('GET', '/headers'): self.get_headers,
+            ('POST', '/blocks'): self.new_block,
+            ('GET', '/blocks/events'): self.get_block_events,
+            ('GET', '/snapshot'): self.get_snapshot,
+            ('POST', '/transactions/new'): self.new_transaction,
+            ('POST', '/transactions/batch'): self.new_transactions,
+            ('POST', '/nodes/register'): self.register_nodes,
+            ('GET', '/nodes/resolve'): self.resolve_conflicts,
+            ('GET', '/gossip/metrics'): self.get_gossip_metrics,
+            ('GET', '/mining/stats'): self.get_mining_stats,
+        }
+
+    def start(self, host='0.0.0.0'):
+        """
+        Serve the node with the bundled ASGI server until interrupted
+        """
+        async def main():
+            server = ASGIServer(self, host, self.port)
+            await server.start()
+            await server.serve_forever()
+
+        asyncio.run(main())
+
+    def start_background_tasks(self):
+        """Start the sync and gossip loops in the running event loop."""
+        if not self.tasks:
+            self.tasks = [asyncio.get_running_loop().create_task(self.sync_loop()),
+                          asyncio.get_running_loop().create_task(self.gossip.run_async())]
+
+    async def stop_background_tasks(self):
+        self.block_subscriber.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def sync_loop(self):
+        """
+        Follow the registered nodes' announcements, and run a fallback header sync round every
+        sync_interval seconds without blocking the loop
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            self.block_subscriber.start()
+            if await loop.run_in_executor(None, self.header_sync.sync):
+                print(f"Synced chain to height {len(self.blockchain.chain)}")
+            await asyncio.sleep(self.sync_interval)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+
+        handler = self.routes.get((request.method, request.path))
+        args = ()
+        if handler is None and request.method == 'GET':
+            handler, args = self.match_path(request.path)
+        if handler is None:
+            status, headers, chunks = json_response({'message': 'Not found'}, 404)
+        else:
+            delay = self.rate_limiter.check(request.client, handler.__name__)
+            if delay:
+                status, headers, chunks = json_response({'message': 'Too many requests'}, 429)
+                headers['Retry-After'] = RateLimiter.retry_after(delay)
+            else:
+                status, headers, chunks = await handler(request, *args)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]})
+        if isinstance(chunks, (bytes, str)):
+            chunks = [chunks]
+        if hasattr(chunks, '__aiter__'):
+            async for chunk in chunks:
+                await self._send_chunk(send, chunk)
+        else:
+            for chunk in chunks:
+                await self._send_chunk(send, chunk)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def match_path(self, path):
+        """
+        Find the GET handler of a path with parameters
+        :return: (handler, arguments), or (None, ()) if no route matches
+        """
+        for pattern, handler, convert in ((BLOCK_HASH_PATH, self.get_block_hash, int),
+                                          (ACCOUNT_PATH, self.get_account, str),
+                                          (ADDRESS_HISTORY_PATH, self.get_address_history, str),
+                                          (TRANSACTION_PATH, self.get_transaction, str)):
+            match = pattern.match(path)
+            if match:
+                return handler, (convert(match.group(1)),)
+        return None, ()
+
+    @staticmethod
+    async def _send_chunk(send, chunk):
+        await send({'type': 'http.response.body', 'body': chunk.encode() if isinstance(chunk, str) else chunk,
+                    'more_body': True})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start_background_tasks()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop_background_tasks()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _serve_range(self, request, key, to_dict, convert, max_blocks=None):
+        try:
+            blocks, length, tip_hash, next_cursor = select_block_range(self.blockchain, request.args, max_blocks)
+        except StaleCursor as e:
+            return json_response({'message': str(e)}, 409)
+        except ValueError as e:
+            return text_response(f'Error: {e}', 400)
+
+        etag = f'W/"{tip_hash}"'
+        headers = {CHAIN_LENGTH_HEADER: str(length), 'Vary': 'Accept-Encoding', 'ETag': etag}
+        if next_cursor is not None:
+            headers[NEXT_CURSOR_HEADER] = next_cursor
+        if etag in request.if_none_match or tip_hash in request.if_none_match:
+            return 304, headers, b''
+        if request.args.get('format') == 'binary':
+            headers['Content-Type'] = BINARY_CHAIN_MIMETYPE
+            chunks = stream_binary_blocks(blocks, convert)
+        else:
+            headers['Content-Type'] = 'application/json'
+            chunks = stream_json_blocks(key, blocks, to_dict, {'length': length, 'next_cursor': next_cursor})
+        if 'gzip' in request.headers.get('accept-encoding', ''):
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        return 200, headers, chunks
+
+    async def get_chain(self, request):
+        """Get the blockchain, with the same paging, formats and ETag as Network.get_chain."""
+        return await self._serve_range(request, 'chain', lambda block: block.to_dict(), lambda block: block)
+
+    async def get_headers(self, request, max_headers=2000):
+        """Get block headers without transactions, like Network.get_headers."""
+        return await self._serve_range(request, 'headers', lambda block: block.header(),
+                                       lambda block: block.header_only(), max_headers)
+
+    async def get_tip(self, request):
+        """Get the tip, with the same long-poll parameters as Network.get_tip."""
+        try:
+            known, wait = tip_wait_args(request.args)
+        except ValueError as e:
+            return text_response(f'Error: {e}', 400)
+        if known is not None and wait:
+            await self.wait_for_tip(known, wait)
+        length, tip_hash, work = self.blockchain.get_tip_work()
+        return json_response({'length': length, 'hash': tip_hash, 'work': work})
+
+    async def wait_for_tip(self, known_hash, timeout):
+        """Wait like TipFeed.wait, on the event loop instead of in a thread."""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def listener(length, tip_hash):
+            try:
+                loop.call_soon_threadsafe(changed.set)
+            except RuntimeError:
+                pass  # The loop was closed while the waiter was leaving
+
+        feed = self.blockchain.tip_feed
+        feed.subscribe(listener)
+        try:
+            if feed.tip[1] == known_hash:
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return feed.tip
+        finally:
+            feed.unsubscribe(listener)
+
+    async def get_block_events(self, request):
+        """Subscribe to new blocks over server-sent events, like Network.get_block_events."""
+        return 200, {'Content-Type': BLOCK_EVENTS_MIMETYPE, 'Cache-Control': 'no-cache'}, self._block_events()
+
+    async def _block_events(self, keepalive=EVENT_KEEPALIVE):
+        yield f'retry: {keepalive * 1000}\n\n'
+        known = None
+        while True:
+            length, tip_hash = await self.wait_for_tip(known, keepalive)
+            if tip_hash == known:
+                yield ': keep-alive\n\n'
+            else:
+                known = tip_hash
+                yield block_event(length, tip_hash)
+
+    async def get_block_hash(self, request, height):
+        block_hash = self.blockchain.get_block_hash(height)
+        if block_hash is None:
+            return json_response({'message': 'No block at that height'}, 404)
+        return json_response({'height': height, 'hash': block_hash})
+
+    async def get_account(self, request, address):
+        """Get the balance and nonce of an address, like Network.get_account."""
+        return json_response({
+            'address': address,
+            'balance': self.blockchain.get_balance(address),
+            'nonce': self.blockchain.get_nonce(address),
+        })
+
+    async def get_address_history(self, request, address):
+        """Page through the transactions of an address, like Network.get_address_history."""
+        try:
+            cursor, limit, newest_first = address_history_args(request.args)
+        except ValueError as e:
+            return text_response(f'Error: {e}', 400)
+        # Pages of old blocks may be read from the block store
+        transactions, next_cursor = await asyncio.get_running_loop().run_in_executor(
+            None, self.blockchain.get_address_history, address, cursor, limit, newest_first)
+        return json_response({'address': address, 'transactions': transactions, 'next_cursor': next_cursor})
+
+    async def get_transaction(self, request, transaction_id):
+        """Find where a transaction landed in the chain, like Network.get_transaction."""
+        found = await asyncio.get_running_loop().run_in_executor(None, self.blockchain.find_transaction,
+                                                                 transaction_id)
+        if found is None:
+            return json_response({'message': 'Transaction not found'}, 404)
+        return json_response(found)
+
+    async def get_snapshot(self, request):
+        """Get our newest state snapshot, like Network.get_snapshot."""
+        data = latest_snapshot(self.blockchain)
+        if data is None:
+            return json_response({'message': 'No state snapshot'}, 404)
+        return 200, {'Content-Type': BINARY_CHAIN_MIMETYPE}, data
+
+    async def new_block(self, request):
+        """Add a block mined by a peer, like Network.new_block."""
+        values = request.json()
+        if not isinstance(values, dict):
+            return text_response('Error: Please supply a block', 400)
+        try:
+            status = await asyncio.get_running_loop().run_in_executor(None, self.blockchain.add_block, values)
+        except ValueError as e:
+            return json_response({'message': str(e)}, 400)
+        length, tip_hash = self.blockchain.get_tip()
+        return json_response({'status': status, 'length': length, 'hash': tip_hash})
+
+    async def new_transaction(self, request):
+        """Create a new transaction and gossip it to our peers."""
+        values = request.json()
+        if not isinstance(values, dict) or not all(k in values for k in ['sender', 'recipient', 'amount']):
+            return text_response('Missing values', 400)
+        if values['sender'] == MINT_ADDRESS:
+            return text_response('Sender address is reserved', 400)
+
+        try:
+            transaction = await asyncio.get_running_loop().run_in_executor(
+                None, self.blockchain.add_transaction, values['sender'], values['recipient'], values['amount'],
+                values.get('fee', 0), values.get('nonce'))
+        except ValueError as e:
+            return json_response({'message': str(e)}, 400)
+        index = self.blockchain.last_block['index'] + 1
+        self.gossip.publish([transaction])
+        return json_response({'message': f'Transaction will be added to Block {index}'}, 201)
+
+    async def new_transactions(self, request, max_batch=10000):
+        """Create a batch of transactions, like Network.new_transactions."""
+        values = request.json()
+        items = values.get('transactions') if isinstance(values, dict) else values
+        if not isinstance(items, list):
+            return text_response('Error: Please supply a list of transactions', 400)
+        if len(items) > max_batch:
+            return text_response(f'Error: At most {max_batch} transactions per batch', 413)
+
+        # Writers take the chain lock and a batch may take a while; keep the loop serving meanwhile
+        results, accepted = await asyncio.get_running_loop().run_in_executor(
+            None, submit_transactions, self.blockchain, items)
+        self.gossip.publish(accepted)
+        return json_response({
+            'results': results,
+            'accepted': sum(result['status'] == 'accepted' for result in results),
+        })
+
+    async def register_nodes(self, request):
+        values = request.json()
+        nodes = values.get('nodes') if isinstance(values, dict) else None
+        if nodes is None:
+            return text_response('Error: Please supply a valid list of nodes', 400)
+
+        for node in nodes:
+            self.blockchain.register_node(node)
+        return json_response({
+            'message': 'New nodes have been added',
+            'total_nodes': list(self.blockchain.nodes),
+        }, 201)
+
+    async def resolve_conflicts(self, request):
+        """
+        Resolve conflicts in a work queue thread, so other requests keep being served.
+        Concurrent requests share a single run, like Network.resolve_conflicts.
+        """
+        try:
+            future = self.work_queue.submit(self.blockchain.resolve_conflicts, key='resolve')
+        except Overloaded as e:
+            status, headers, body = json_response({'message': str(e)}, 429)
+            headers['Retry-After'] = '1'
+            return status, headers, body
+        replaced = await asyncio.wrap_future(future)
+        length, tip_hash = self.blockchain.get_tip()
+        return json_response({
+            'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+            'replaced': replaced,
+            'length': length,
+            'hash': tip_hash,
+        })
+
+    async def get_gossip_metrics(self, request):
+        return json_response(self.gossip.metrics())
+
+    async def get_mining_stats(self, request):
+        """Get difficulty and mining throughput statistics, like Network.get_mining_stats."""
+        try:
+            window = mining_stats_args(request.args)
+        except ValueError as e:
+            return text_response(f'Error: {e}', 400)
+        return json_response(self.blockchain.mining_stats(window))
+
+
+class Request:
+    """The parts of an ASGI HTTP request the handlers use."""
+
+    def __init__(self, scope, body: bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.client = scope['client'][0] if scope.get('client') else None
+        self.body = body
+
+    @property
+    def if_none_match(self):
+        return [tag.strip() for tag in self.headers.get('if-none-match', '').split(',') if tag.strip()]
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def json_response(value, status=200):
+    return status, {'Content-Type': 'application/json'}, json.dumps(value).encode()
+
+
+def text_response(text, status=200):
+    return status, {'Content-Type': 'text/html; charset=utf-8'}, text.encode()
+
+
+class ASGIServer:
+    """
+    Minimal HTTP/1.1 server for an ASGI application, built on asyncio streams so the async
+    mode needs no third-party server. It supports keep-alive and Content-Length request
+    bodies, and sends streamed responses with chunked transfer encoding. A connection whose
+    client sends nothing for idle_timeout, between requests or in the middle of one, is closed,
+    so idle keep-alive and stalled clients do not hold connections open forever.
+    """
+
+    def __init__(self, app, host: str = '127.0.0.1', port: int = 0, max_body: int = 64 * 2 ** 20,
+                 idle_timeout: float = 60):
+        """
+        :param app: ASGI application
+        :param port: Port to listen on; 0 for an ephemeral one, see self.port after start()
+        :param max_body: Largest request body accepted, in bytes
+        :param idle_timeout: Seconds each read from a client may wait before the connection is closed;
+            None to wait forever
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.connections = set()  # Tasks handling open connections
+        self._lifespan = None
+
+    async def start(self):
+        """Run the application's startup and begin accepting connections."""
+        self._lifespan = _Lifespan(self.app)
+        await self._lifespan.startup()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        """Stop accepting connections, close the open ones and run the application's shutdown."""
+        self.server.close()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+        await self._lifespan.shutdown()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass  # Client went away, went quiet or sent a malformed request
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _read(self, read):
+        """Await a read from a client, raising asyncio.TimeoutError after idle_timeout."""
+        return await asyncio.wait_for(read, self.idle_timeout)
+
+    async def _handle_request(self, reader, writer) -> bool:
+        """:return: True if the connection stays open for another request"""
+        request_line = await self._read(reader.readline())
+        if not request_line:
+            return False
+        method, target, version = request_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        headers = []
+        while True:
+            line = await self._read(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+        fields = dict(headers)
+        length = int(fields.get(b'content-length', b'0'))
+        if length > self.max_body:
+            writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return False
+        body = await self._read(reader.readexactly(length)) if length else b''
+        keep_alive = version == 'HTTP/1.1' and fields.get(b'connection', b'').lower() != b'close'
+
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version[5:], 'method': method,
+            'scheme': 'http', 'path': unquote(path), 'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'), 'headers': headers,
+            'client': writer.get_extra_info('peername'), 'server': (self.host, self.port),
+        }
+        response = _ResponseWriter(writer, keep_alive)
+        received = False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await asyncio.Event().wait()  # No disconnect detection while the app is running
+
+        await self.app(scope, receive, response.send)
+        await response.finish()
+        return keep_alive
+
+
+class _ResponseWriter:
+    """Writes ASGI response events to a stream: Content-Length for a single body, chunks otherwise."""
+
+    def __init__(self, writer, keep_alive: bool):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.start = None
+        self.chunked = False
+        self.pending = None  # First body message, held back to see whether more follow
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        body, more = message.get('body', b''), message.get('more_body', False)
+        if self.pending is None and not self.chunked:
+            if not more:
+                self._write_head(len(body))
+                self.writer.write(body)
+                self.start = None
+                return
+            self.pending = body
+            return
+        if not self.chunked:
+            if not more and not body:
+                self._write_head(len(self.pending))  # The whole body was in the first message
+                self.writer.write(self.pending)
+                self.pending, self.start = None, None
+                return
+            self._write_head(None)
+            self.chunked = True
+            self._write_chunk(self.pending)
+            self.pending = None
+        self._write_chunk(body)
+        if not more:
+            self.writer.write(b'0\r\n\r\n')
+        await self.writer.drain()
+
+    def _write_head(self, length):
+        status = self.start['status']
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+        for name, value in self.start['headers']:
+            lines.append(f"{name.decode('latin-1')}: {value.decode('latin-1')}")
+        if status == 304:
+            pass  # No body and no length for Not Modified
+        elif length is None:
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            lines.append(f'Content-Length: {length}')
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def _write_chunk(self, data):
+        if data:
+            self.writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    async def finish(self):
+        await self.writer.drain()
+
+
+class _Lifespan:
+    """Drives the ASGI lifespan protocol of an application, if it implements it."""
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.started = None
+
+    async def startup(self):
+        self.started = asyncio.get_running_loop().create_future()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        await self.queue.put({'type': 'lifespan.startup'})
+        await self.started
+
+    async def shutdown(self):
+        await self.queue.put({'type': 'lifespan.shutdown'})
+        await self.task
+
+    async def _run(self):
+        async def send(message):
+            if message['type'] == 'lifespan.startup.complete' and not self.started.done():
+                self.started.set_result(None)
+
+        try:
+            await self.app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, self.queue.get, send)
+        except Exception:
+            pass  # Applications without lifespan support may raise on the unknown scope
+        finally:
+            if not self.started.done():
+                self.started.set_result(None)
+
+
+# Example usage
+if __name__ == "__main__":
+    from core.blockchain import Blockchain
+
+    network = AsyncNetwork(Blockchain())
+    network.start()
@@ -0,0 +1,438 @@
+import asyncio
+import hashlib
+import http.client
+import json
+import logging
+import multiprocessing
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from werkzeug.serving import make_server
+from core.account_state import MINT_ADDRESS
+from core.async_network import ASGIServer, AsyncNetwork
+from core.block_store import BlockStore
+from core.blockchain import Blockchain
+from core.consensus_mechanisms import Block, ProofOfWork
+from core.difficulty import DEFAULT_WORK, DifficultyRetarget
+from core.encoding import Block as ChainBlock, encode_chain, decode_chain
+from core.network import Network
+from core.parallel_mining import ParallelMiner
+from core.pbft import PBFTCluster
+from core.simulator import (NetworkModel, PBFTSimulation, ProofOfStakeSimulation, ProofOfWorkSimulation,
+                            VoteSimulation)
+from core.stake_index import StakeIndex
+
+
+class UncheckedProofBlockchain(Blockchain):
+    """Blockchain that accepts every proof, so benchmarks measure hashing and validation without mining."""
+
+    @staticmethod
+    def valid_proof(last_proof, proof, work=None):
+        return True
+
+
+def build_chain(length, blockchain_class=UncheckedProofBlockchain):
+    """Build a blockchain of the given length with one transaction per block."""
+    blockchain = blockchain_class()
+    while len(blockchain.chain) < length:
+        blockchain.new_transaction(MINT_ADDRESS, 'recipient', len(blockchain.chain))
+        blockchain.create_block(proof=len(blockchain.chain))
+    return blockchain
+
+
+def benchmark_incremental_validation(sizes=(1000, 2000, 4000, 8000, 16000), rounds=20):
+    """Compare full and incremental validation of a peer chain (as received in JSON) that is one block ahead of ours."""
+    print(f"{'blocks':>8} {'full (ms)':>12} {'incremental (ms)':>18}")
+    results = []
+    for size in sizes:
+        ours = build_chain(size)
+        peer = build_chain(size)
+        peer.chain = list(ours.chain)
+        peer.new_transaction(MINT_ADDRESS, 'recipient', 1)
+        peer.create_block(proof=size)
+        peer_chain = peer.get_chain()
+
+        start = time.perf_counter()
+        ours.valid_chain(peer_chain)
+        full = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            ours.valid_chain(peer_chain, incremental=True)
+        incremental = (time.perf_counter() - start) * 1000 / rounds
+
+        print(f"{size:>8} {full:>12.3f} {incremental:>18.3f}")
+        results.append((size, full, incremental))
+    return results
+
+
+def benchmark_parallel_mining(worker_counts=(1, 2, 4), difficulty=5):
+    """Mine the same block sequentially and with process pools of increasing size."""
+    transactions = [{"from": "Alice", "to": "Bob", "amount": 10}]
+    block = Block(index=1, previous_hash="0", transactions=transactions)
+    start = time.perf_counter()
+    expected = ProofOfWork(difficulty).mine_block(block).nonce
+    print(f"sequential: nonce {expected} in {time.perf_counter() - start:.3f}s")
+
+    results = []
+    for workers in worker_counts:
+        with ParallelMiner(workers=workers) as miner:
+            miner.search(b'warm-up', 1)
+            block = Block(index=1, previous_hash="0", transactions=transactions)
+            mined = ProofOfWork(difficulty, miner=miner).mine_block(block)
+            assert mined.nonce == expected
+            print(f"{workers} workers: {miner.report()}")
+            results.append(miner.last_report)
+    return results
+
+
+def _mine_without_midstate(block, difficulty):
+    """The original mine_block loop, which rebuilds and rehashes the whole block string per nonce."""
+    while block.hash[:difficulty] != '0' * difficulty:
+        block.nonce += 1
+        block.hash = block.calculate_hash()
+    return block
+
+
+def benchmark_midstate_mining(transaction_counts=(1, 10, 100, 1000), difficulty=3):
+    """Compare per-attempt mining cost with and without the precomputed midstate."""
+    print(f"{'transactions':>12} {'original (us/hash)':>20} {'midstate (us/hash)':>20}")
+    results = []
+    for count in transaction_counts:
+        transactions = [{"from": f"sender{i}", "to": f"recipient{i}", "amount": i} for i in range(count)]
+
+        start = time.perf_counter()
+        original = _mine_without_midstate(Block(1, "0", transactions), difficulty)
+        original_cost = (time.perf_counter() - start) * 1e6 / (original.nonce + 1)
+
+        start = time.perf_counter()
+        mined = ProofOfWork(difficulty).mine_block(Block(1, "0", transactions))
+        midstate_cost = (time.perf_counter() - start) * 1e6 / (mined.nonce + 1)
+
+        assert (mined.nonce, mined.hash) == (original.nonce, original.hash)
+        print(f"{count:>12} {original_cost:>20.2f} {midstate_cost:>20.2f}")
+        results.append((count, original_cost, midstate_cost))
+    return results
+
+
+def _json_hash(block):
+    """The original Blockchain.hash, over a block dict."""
+    return hashlib.sha256(json.dumps(block, sort_keys=True).encode()).hexdigest()
+
+
+def _measure_memory(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def benchmark_block_encoding(blocks=100000, transactions_per_block=2):
+    """Compare memory, hashing and serialization of dict blocks against compact binary-encoded Blocks."""
+    def make_dicts():
+        return [{
+            'index': i + 1,
+            'timestamp': 1700000000.0 + i,
+            'transactions': [{'sender': f'sender{i}', 'recipient': f'recipient{t}', 'amount': t}
+                             for t in range(transactions_per_block)],
+            'proof': i * 7,
+            'previous_hash': f'{i:064x}',
+        } for i in range(blocks)]
+
+    dicts, dict_memory = _measure_memory(make_dicts)
+    # Decode from the wire format so the compact blocks do not share strings with the dicts
+    encoded = encode_chain(ChainBlock.from_dict(block) for block in dicts)
+    compact, compact_memory = _measure_memory(lambda: decode_chain(encoded))
+    print(f"memory: dicts {dict_memory / 2 ** 20:.1f} MiB, compact blocks {compact_memory / 2 ** 20:.1f} MiB")
+
+    start = time.perf_counter()
+    for block in dicts:
+        _json_hash(block)
+    json_rate = blocks / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for block in compact:
+        hashlib.sha256(block.encode_header()).hexdigest()
+    binary_rate = blocks / (time.perf_counter() - start)
+    print(f"hashing: json {json_rate:.0f} blocks/s, binary {binary_rate:.0f} blocks/s")
+
+    start = time.perf_counter()
+    json_size = len(json.dumps({'chain': dicts, 'length': blocks}))
+    json_time = time.perf_counter() - start
+    start = time.perf_counter()
+    binary_size = len(encode_chain(compact))
+    binary_time = time.perf_counter() - start
+    print(f"/chain: json {json_size / 2 ** 20:.1f} MiB in {json_time:.2f}s, "
+          f"binary {binary_size / 2 ** 20:.1f} MiB in {binary_time:.2f}s")
+    return {
+        'dict_memory': dict_memory, 'compact_memory': compact_memory,
+        'json_hash_rate': json_rate, 'binary_hash_rate': binary_rate,
+        'json_size': json_size, 'binary_size': binary_size,
+    }
+
+
+def benchmark_block_store(blocks=20000, transactions_per_block=20):
+    """
+    Measure appends to a BlockStore, loading its headers, node startup from it (headers plus the
+    account state replay and index), and a full decode of every block for comparison.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        store = BlockStore(directory)
+        blockchain = UncheckedProofBlockchain(store=store)
+        start = time.perf_counter()
+        for i in range(blocks):
+            for t in range(transactions_per_block):
+                blockchain.new_transaction(MINT_ADDRESS, f'recipient{i}', t)
+            blockchain.create_block(proof=i)
+        print(f"append: {blocks / (time.perf_counter() - start):.0f} blocks/s")
+        store.close()
+
+        store = BlockStore(directory)
+        start = time.perf_counter()
+        (_, header_memory) = _measure_memory(store.load_headers)
+        print(f"load headers: {time.perf_counter() - start:.2f}s, {header_memory / 2 ** 20:.1f} MiB")
+        start = time.perf_counter()
+        chain = UncheckedProofBlockchain(store=store).chain
+        print(f"startup (headers, state replay and index): {time.perf_counter() - start:.2f}s")
+        start = time.perf_counter()
+        (_, full_memory) = _measure_memory(lambda: [store.read(height) for height in range(len(store))])
+        print(f"full decode: {time.perf_counter() - start:.2f}s, {full_memory / 2 ** 20:.1f} MiB")
+        start = time.perf_counter()
+        for block in chain[-1000:]:
+            block.transactions
+        print(f"lazy body read: {(time.perf_counter() - start) * 1000:.3f} ms per 1000 blocks")
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def _serve_node(mode, chain_length, ports):
+    """Child process body: serve a funded chain with the Flask app or the async server."""
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    blockchain = build_chain(chain_length)
+    blockchain.new_transaction(MINT_ADDRESS, 'alice', 10 ** 12)
+    blockchain.create_block(proof=0)
+    # All load comes from one address, so rate limiting is off to measure the servers themselves
+    if mode == 'flask':
+        server = make_server('127.0.0.1', 0, Network(blockchain, rate_limits={}).app, threaded=True)
+        ports.put(server.server_port)
+        server.serve_forever()
+    else:
+        async def serve():
+            server = ASGIServer(AsyncNetwork(blockchain, sync_interval=3600, rate_limits={}))
+            await server.start()
+            ports.put(server.port)
+            await server.serve_forever()
+        asyncio.run(serve())
+
+
+def _load_node(port, clients, requests_per_client):
+    """
+    Issue requests from concurrent keep-alive clients: three GET /chain pages for every
+    POST /transactions/new
+    :return: (requests per second, p50 latency, p99 latency)
+    """
+    latencies = []
+
+    def client(number):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        own = []
+        for i in range(requests_per_client):
+            start = time.perf_counter()
+            if i % 4 == 3:
+                body = json.dumps({'sender': 'alice', 'recipient': 'bob', 'amount': number * requests_per_client + i})
+                connection.request('POST', '/transactions/new', body, {'Content-Type': 'application/json'})
+            else:
+                connection.request('GET', f'/chain?start={i % 100}&limit=20')
+            connection.getresponse().read()
+            own.append(time.perf_counter() - start)
+        connection.close()
+        latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def benchmark_server_modes(client_counts=(1, 8, 32), requests_per_client=200, chain_length=500):
+    """Load test the Flask app against the async server: requests per second and p50/p99 latency."""
+    context = multiprocessing.get_context('fork')
+    print(f"{'mode':>6} {'clients':>8} {'req/s':>8} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    results = {}
+    for mode in ('flask', 'async'):
+        ports = context.Queue()
+        process = context.Process(target=_serve_node, args=(mode, chain_length, ports), daemon=True)
+        process.start()
+        try:
+            port = ports.get(timeout=60)
+            for clients in client_counts:
+                rps, p50, p99 = _load_node(port, clients, requests_per_client)
+                results[(mode, clients)] = {'rps': rps, 'p50': p50, 'p99': p99}
+                print(f"{mode:>6} {clients:>8} {rps:>8.0f} {p50 * 1000:>10.2f} {p99 * 1000:>10.2f}")
+        finally:
+            process.terminate()
+            process.join()
+    return results
+
+
+
+def _linear_election(stakes):
+    """The original ProofOfStake.elect_validator: sum every stake and walk the stakeholders."""
+    random_choice = random.uniform(0, sum(stakes.values()))
+    current_sum = 0
+    for node, stake in stakes.items():
+        current_sum += stake
+        if current_sum >= random_choice:
+            return node
+
+
+def benchmark_stake_election(sizes=(1000, 10000, 100000), elections=2000):
+    """Compare the cost of an election and a stake update with the linear walk and with the StakeIndex."""
+    print(f"{'stakers':>8} {'linear (us)':>12} {'index (us)':>12} {'epoch (us/slot)':>16} {'update (us)':>12}")
+    results = []
+    for size in sizes:
+        stakes = {f'validator{i}': random.randint(1, 10000) for i in range(size)}
+        index = StakeIndex(stakes)
+        rounds = max(1, elections * 1000 // size)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            _linear_election(stakes)
+        linear = (time.perf_counter() - start) * 1e6 / rounds
+
+        start = time.perf_counter()
+        for _ in range(elections):
+            index.elect()
+        indexed = (time.perf_counter() - start) * 1e6 / elections
+
+        start = time.perf_counter()
+        index.elect_many(elections)
+        epoch = (time.perf_counter() - start) * 1e6 / elections
+
+        start = time.perf_counter()
+        for i in range(elections):
+            index.set(f'validator{i % size}', i + 1)
+        update = (time.perf_counter() - start) * 1e6 / elections
+
+        print(f"{size:>8} {linear:>12.1f} {indexed:>12.1f} {epoch:>16.1f} {update:>12.1f}")
+        results.append((size, linear, indexed, epoch, update))
+    return results
+
+
+
+def benchmark_pbft(sizes=(4, 7, 10, 16, 31), blocks=300, batch_size=50, in_flight=8):
+    """
+    Committed blocks per second and commit latency of a PBFT cluster over the in-process transport
+    as it grows. A closed-loop client keeps in_flight full batches outstanding, submitting a new
+    batch whenever one commits, so latency is measured under load without an unbounded queue.
+    """
+    print(f"{'replicas':>8} {'blocks/s':>10} {'p50 (ms)':>10} {'p99 (ms)':>10} {'msgs/block':>11}")
+    results = []
+    for size in sizes:
+        cluster = PBFTCluster(size=size, batch_size=batch_size, window=4 * in_flight, checkpoint_interval=in_flight)
+        start = time.perf_counter()
+        for i in range(in_flight * batch_size):
+            cluster.submit(i)
+        submitted = in_flight
+        while len(cluster.committed) < blocks:
+            cluster.transport.deliver(limit=size)
+            while submitted < len(cluster.committed) + in_flight and submitted < blocks:
+                for i in range(batch_size):
+                    cluster.submit(submitted * batch_size + i)
+                submitted += 1
+            if not cluster.transport.pending():
+                cluster.run()
+        metrics = cluster.metrics(time.perf_counter() - start)
+        print(f"{size:>8} {metrics['blocks_per_second']:>10.0f} {metrics['p50_latency'] * 1000:>10.2f} "
+              f"{metrics['p99_latency'] * 1000:>10.2f} {metrics['messages_per_block']:>11.0f}")
+        results.append(metrics)
+    return results
+
+
+
+def benchmark_simulated_consensus(longest_chain_sizes=(100, 1000, 5000), quorum_sizes=(4, 16, 64),
+                                  vote_sizes=(16, 64, 256), byzantine_share=0.05):
+    """
+    Throughput, finality latency and messages of each consensus mechanism on a simulated WAN
+    (50-100 ms latency, 100 Mbit/s uplinks, 1% loss), with a share of Byzantine nodes.
+    """
+    model = NetworkModel(latency=0.05, jitter=0.05, bandwidth=12.5e6, loss=0.01)
+    runs = [(ProofOfWorkSimulation, size, 300) for size in longest_chain_sizes]
+    runs += [(ProofOfStakeSimulation, size, 120) for size in longest_chain_sizes]
+    runs += [(PBFTSimulation, size, 10) for size in quorum_sizes]
+    runs += [(VoteSimulation, size, 10) for size in vote_sizes]
+    print(f"{'mechanism':>26} {'nodes':>6} {'blocks/s':>9} {'p50 final (s)':>14} {'msgs/block':>11} {'wall (s)':>9}")
+    results = []
+    for simulation_class, size, duration in runs:
+        # Byzantine nodes are the highest-numbered ones, so the PBFT primary, replica 0, stays correct
+        byzantine = range(size - int(size * byzantine_share), size)
+        report = simulation_class(size, model=model, byzantine=byzantine).run(duration)
+        print(f"{report['mechanism']:>26} {size:>6} {report['throughput']:>9.2f} "
+              f"{report['finality_p50'] or 0:>14.3f} {report['messages_per_block'] or 0:>11.0f} "
+              f"{report['wall_time']:>9.1f}")
+        results.append(report)
+    return results
+
+
+def benchmark_difficulty_retarget(hash_rates=(6554, 52429, 3277, 26214), blocks_per_phase=500, target_interval=10):
+    """
+    Block intervals as the network hash rate steps through hash_rates, at the fixed difficulty and
+    with retargeting. Mining is simulated: the time to find a block is exponential with mean
+    work / hash rate. The first rate makes the fixed difficulty hit the target interval.
+    """
+    print(f"{'mode':>9} {'H/s':>7} {'mean (s)':>9} {'p90 (s)':>8} {'in 0.5-2x':>10} {'estimated H/s':>14}")
+    telemetry = DifficultyRetarget(target_interval)
+    results = []
+    for mode, retarget in (('fixed', None), ('retarget', DifficultyRetarget(target_interval))):
+        rng = random.Random(1)
+        history = [(0.0, DEFAULT_WORK)]
+        for rate in hash_rates:
+            intervals = []
+            for _ in range(blocks_per_phase):
+                work = DEFAULT_WORK if retarget is None else retarget.next_work(history[-retarget.history_length:])
+                intervals.append(rng.expovariate(rate / work))
+                history.append((history[-1][0] + intervals[-1], history[-1][1] + work))
+            intervals.sort()
+            mean = sum(intervals) / len(intervals)
+            p90 = intervals[len(intervals) * 9 // 10]
+            steady = sum(target_interval / 2 <= interval <= 2 * target_interval for interval in intervals)
+            steady /= len(intervals)
+            estimated = telemetry.hash_rate(history[-telemetry.window - 1:])
+            print(f"{mode:>9} {rate:>7} {mean:>9.1f} {p90:>8.1f} {steady:>10.0%} {estimated:>14.0f}")
+            results.append((mode, rate, mean, p90, steady, estimated))
+    return results
+
+
+BENCHMARKS = {
+    'incremental_validation': benchmark_incremental_validation,
+    'parallel_mining': benchmark_parallel_mining,
+    'midstate_mining': benchmark_midstate_mining,
+    'block_encoding': benchmark_block_encoding,
+    'block_store': benchmark_block_store,
+    'server_modes': benchmark_server_modes,
+    'stake_election': benchmark_stake_election,
+    'pbft': benchmark_pbft,
+    'simulated_consensus': benchmark_simulated_consensus,
+    'difficulty_retarget': benchmark_difficulty_retarget,
+}
+
+
+def main(names=None):
+    for name in names or BENCHMARKS:
+        print(f"\n=== {name} ===")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
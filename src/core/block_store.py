@@ -0,0 +1,229 @@
+import mmap
+import os
+import struct
+import threading
+from typing import List
+from core.encoding import Block
+
+# On-disk layout of a BlockStore directory:
+#   blocks-00000.dat, blocks-00001.dat, ...  append-only segments of encoded blocks
+#   index.dat                                one fixed-size record per height:
+#                                            (segment, offset, length, header length)
+# A block is written to its segment before its index record, so after a crash any
+# index record pointing past the end of a segment is simply dropped on startup.
+
+INDEX_RECORD = struct.Struct('>IQII')
+SEGMENT_NAME = 'blocks-{:05d}.dat'
+INDEX_NAME = 'index.dat'
+
+
+class StoredBlock(Block):
+    """
+    Block whose header is held in memory while its transactions stay on disk. The body is
+    decoded from the memory-mapped segment on every access, so memory use does not grow
+    with the number of transactions in the chain; whether it was stored at all is known
+    from the header, without decoding it.
+    """
+    __slots__ = ('_store', '_height', '_stored_body')
+
+    def __init__(self, store, height, index, timestamp, proof, previous_hash, merkle_root, stored_body=True):
+        self._store = store
+        self._height = height
+        self._stored_body = stored_body
+        super().__init__(index, timestamp, None, proof, previous_hash, merkle_root)
+
+    @property
+    def transactions(self):
+        transactions = Block.transactions.__get__(self)
+        if transactions is None and self._store is not None:
+            try:
+                body = self._store.read_body(self._height)
+            except IndexError:
+                body = None  # Truncated away, so the body must have been kept in memory
+            # A reorganization keeps the body in memory before truncating the store, so if
+            # that happened while we were reading, the store may hold another block by now
+            transactions = Block.transactions.__get__(self)
+            if transactions is None:
+                return None if body is None else tuple(body)
+        return transactions
+
+    @transactions.setter
+    def transactions(self, value):
+        Block.transactions.__set__(self, value)
+
+    @property
+    def has_body(self) -> bool:
+        return self._stored_body or Block.transactions.__get__(self) is not None
+
+
+class BlockStore:
+    """
+    Persistent, append-only, segmented block store with a height index and memory-mapped reads.
+    A lock makes reads from API threads safe against concurrent appends and truncation.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 2 ** 20, sync: bool = False):
+        """
+        :param directory: Directory holding the segments and the index; created if missing
+        :param segment_size: Size after which a new segment file is started
+        :param sync: fsync every append, trading throughput for durability on power loss
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.locations = []  # height -> (segment, offset, length, header length)
+        self._maps = {}
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._index = open(self._index_path(), 'ab')
+        self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME.format(segment))
+
+    def _recover(self):
+        """Load the height index, dropping records for blocks that never reached their segment."""
+        self._segment_sizes = []
+        segment = 0
+        while os.path.exists(self._segment_path(segment)):
+            self._segment_sizes.append(os.path.getsize(self._segment_path(segment)))
+            segment += 1
+
+        data = b''
+        if os.path.exists(self._index_path()):
+            with open(self._index_path(), 'rb') as f:
+                data = f.read()
+        for pos in range(0, len(data) - INDEX_RECORD.size + 1, INDEX_RECORD.size):
+            segment, offset, length, header_length = INDEX_RECORD.unpack_from(data, pos)
+            if segment >= len(self._segment_sizes) or offset + length > self._segment_sizes[segment]:
+                break
+            self.locations.append((segment, offset, length, header_length))
+        self._truncate_files(len(self.locations))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def append(self, block: Block) -> StoredBlock:
+        """
+        Write a block at the next height
+        :param block: Block with its transactions
+        :return: The block as a StoredBlock that reads its transactions from disk
+        """
+        with self._lock:
+            data = block.encode()
+            header_length = len(block.encode_header())
+            if self._writer.tell() and self._writer.tell() + len(data) > self.segment_size:
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(self._segment_path(self._segment), 'ab')
+
+            offset = self._writer.tell()
+            self._writer.write(data)
+            self._writer.flush()
+            self._index.write(INDEX_RECORD.pack(self._segment, offset, len(data), header_length))
+            self._index.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+                os.fsync(self._index.fileno())
+
+            height = len(self.locations)
+            self.locations.append((self._segment, offset, len(data), header_length))
+            stored = StoredBlock(self, height, block.index, block.timestamp, block.proof,
+                                 block.previous_hash, block.merkle_root, block.transactions is not None)
+            stored._hash = block._hash
+            return stored
+
+    def truncate(self, height: int):
+        """
+        Drop every block at or above height, e.g. before writing the new branch of a
+        reorganization. StoredBlocks previously returned for those heights must not be used.
+        """
+        with self._lock:
+            if height >= len(self.locations):
+                return
+            self._writer.close()
+            self._index.close()
+            self._close_maps()
+            del self.locations[height:]
+            self._truncate_files(height)
+            self._index = open(self._index_path(), 'ab')
+            self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def _truncate_files(self, height: int):
+        if height < len(self.locations):
+            del self.locations[height:]
+        if self.locations:
+            segment, offset, length, _ = self.locations[-1]
+            end = offset + length
+        else:
+            segment, end = 0, 0
+
+        if os.path.exists(self._segment_path(segment)):
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(end)
+        later = segment + 1
+        while os.path.exists(self._segment_path(later)):
+            os.remove(self._segment_path(later))
+            later += 1
+        if os.path.exists(self._index_path()):
+            with open(self._index_path(), 'r+b') as f:
+                f.truncate(height * INDEX_RECORD.size)
+        self._segment = segment
+
+    def _view(self, height: int):
+        segment, offset, length, header_length = self.locations[height]
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < offset + length:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapped
+        return memoryview(mapped)[offset:offset + length], header_length
+
+    def read(self, height: int) -> Block:
+        """Decode the full block at a height."""
+        with self._lock:
+            view, _ = self._view(height)
+            try:
+                return Block.decode(view)
+            finally:
+                view.release()
+
+    def read_body(self, height: int) -> List:
+        """Decode only the transactions of the block at a height."""
+        with self._lock:
+            view, header_length = self._view(height)
+            try:
+                return Block.decode_body(view, header_length)
+            finally:
+                view.release()
+
+    def load_headers(self) -> List[StoredBlock]:
+        """Decode every header for a fast startup; transactions are read lazily on access."""
+        with self._lock:
+            blocks = []
+            for height in range(len(self.locations)):
+                view, header_length = self._view(height)
+                try:
+                    index, timestamp, proof, previous_hash, root, _ = Block.decode_header(view[:header_length])
+                    stored_body = view[header_length:header_length + 1] == b'B'  # See Block.encode
+                finally:
+                    view.release()
+                blocks.append(StoredBlock(self, height, index, timestamp, proof, previous_hash, root, stored_body))
+            return blocks
+
+    def _close_maps(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+            self._index.close()
+            self._close_maps()
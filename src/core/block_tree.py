@@ -0,0 +1,207 @@
+import heapq
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+class TreeEntry:
+    """A block off the main chain and the cumulative work of the branch it ends."""
+    __slots__ = ('block', 'work')
+
+    def __init__(self, block, work: int):
+        self.block = block
+        self.work = work
+
+
+class BlockTree:
+    """
+    The competing branches around a main chain. The main chain itself stays in the Blockchain;
+    the tree keeps the cumulative work at each of its heights, the blocks of side branches
+    (including the ones a reorganization abandoned), and a bounded pool of orphans whose parent
+    has not arrived yet. The parent of a block is found in O(1), on the main chain at height
+    index - 1 or among the side blocks by hash, and the path from a side block back to the main
+    chain takes O(depth of its branch). The work of a block, i.e. the expected number of hashes
+    behind it, depends on its ancestors once difficulty retargets, so the Blockchain computes it
+    and passes it in.
+    """
+
+    def __init__(self, max_orphans: int = 1000, max_depth: int = 1000):
+        """
+        :param max_orphans: Maximum orphans kept; the oldest are evicted beyond it
+        :param max_depth: Side blocks this many heights below the tip or deeper are dropped, so
+            abandoned branches do not pile up; a deeper reorganization needs a full chain sync
+        """
+        self.max_orphans = max_orphans
+        self.max_depth = max_depth
+        # Cumulative work of the main chain, by height - 1. Appended to, truncated in place by switch
+        # or replaced by reset; the Blockchain freezes its snapshots of it before a switch
+        self.main_work: List[int] = []
+        self.side: Dict[str, TreeEntry] = {}  # Hash -> block off the main chain
+        self.children: Dict[str, List[str]] = {}  # Hash -> hashes of its children among the side blocks
+        self.side_heights: List[Tuple[int, str]] = []  # Heap of (height, hash) of side blocks, including removed ones
+        self.orphans: OrderedDict = OrderedDict()  # Hash -> block with an unknown parent, oldest first
+        self.orphans_by_parent: Dict[str, List[str]] = {}  # Missing parent hash -> orphan hashes
+
+    @property
+    def tip_work(self) -> int:
+        """Cumulative work of the main chain."""
+        return self.main_work[-1] if self.main_work else 0
+
+    def reset(self, works):
+        """Start over from a new main chain, given the work of each block, forgetting side branches and orphans."""
+        self.main_work = []
+        self.extend(works)
+        self.side.clear()
+        self.children.clear()
+        self.side_heights.clear()
+        self.orphans.clear()
+        self.orphans_by_parent.clear()
+
+    def extend(self, works):
+        """Record blocks appended to the main chain, given the work of each."""
+        total = self.tip_work
+        for work in works:
+            total += work
+            self.main_work.append(total)
+
+    def branch_work(self, shared: int, works) -> int:
+        """Cumulative work of the first shared blocks of the main chain followed by blocks of the given works."""
+        return (self.main_work[shared - 1] if shared else 0) + sum(works)
+
+    def contains(self, chain, block) -> bool:
+        """Check whether a block is on the main chain, on a side branch or in the orphan pool."""
+        if block.hash in self.side or block.hash in self.orphans:
+            return True
+        return 1 <= block.index <= len(chain) and chain[block.index - 1].hash == block.hash
+
+    def parent(self, chain, block) -> Optional[Tuple[object, int]]:
+        """
+        Find the parent of a block
+        :param chain: Snapshot of the main chain
+        :return: (parent block, cumulative work up to it), or None if the parent is unknown
+        """
+        height = block.index - 1
+        if 1 <= height <= len(chain) and chain[height - 1].hash == block.previous_hash:
+            return chain[height - 1], self.main_work[height - 1]
+        entry = self.side.get(block.previous_hash)
+        if entry is not None and entry.block.index == height:
+            return entry.block, entry.work
+        return None
+
+    def history(self, chain, block, work: int, count: int) -> List[Tuple[float, int]]:
+        """
+        Timestamps and cumulative work of a block and its ancestors, e.g. for difficulty retargeting
+        :param chain: Snapshot of the main chain
+        :param block: Block on the main chain or a side branch
+        :param work: Cumulative work up to the block
+        :param count: Number of blocks wanted, fewer near the genesis block
+        :return: List of (timestamp, cumulative work), oldest first
+        """
+        history = [(block.timestamp, work)]
+        while len(history) < count:
+            found = self.parent(chain, block)
+            if found is None:
+                break
+            block, work = found
+            history.append((block.timestamp, work))
+        history.reverse()
+        return history
+
+    def may_link(self, block) -> bool:
+        """
+        Check that a block with an unknown parent could still join the tree: it is not a second
+        genesis block, and its parent, if already held as a side block or orphan, is one height below
+        """
+        if block.index < 2:
+            return False
+        parent = self.side[block.previous_hash].block if block.previous_hash in self.side else \
+            self.orphans.get(block.previous_hash)
+        return parent is None or parent.index == block.index - 1
+
+    def add_side(self, block, work: int):
+        self.side[block.hash] = TreeEntry(block, work)
+        self.children.setdefault(block.previous_hash, []).append(block.hash)
+        heapq.heappush(self.side_heights, (block.index, block.hash))
+
+    def _remove_side(self, block_hash: str) -> Optional[TreeEntry]:
+        entry = self.side.pop(block_hash, None)
+        if entry is not None:
+            siblings = self.children[entry.block.previous_hash]
+            siblings.remove(block_hash)
+            if not siblings:
+                del self.children[entry.block.previous_hash]
+        return entry
+
+    def discard(self, block_hash: str) -> int:
+        """
+        Drop a side block and every side block descending from it
+        :return: Number of blocks dropped
+        """
+        dropped = 0
+        pending = [block_hash]
+        while pending:
+            block_hash = pending.pop()
+            pending.extend(self.children.get(block_hash, ()))
+            dropped += self._remove_side(block_hash) is not None
+        return dropped
+
+    def evict(self, tip_height: int) -> int:
+        """
+        Drop the side blocks max_depth or more below a new tip, with the side blocks descending from them
+        :return: Number of blocks dropped
+        """
+        dropped = 0
+        while self.side_heights and self.side_heights[0][0] <= tip_height - self.max_depth:
+            _, block_hash = heapq.heappop(self.side_heights)
+            # A block that already left the side branches, e.g. adopted by a switch, keeps its side children
+            if block_hash in self.side:
+                dropped += self.discard(block_hash)
+        return dropped
+
+    def add_orphan(self, block):
+        """Keep a block until its parent arrives, evicting the oldest orphan when the pool is full."""
+        self.orphans[block.hash] = block
+        self.orphans_by_parent.setdefault(block.previous_hash, []).append(block.hash)
+        while len(self.orphans) > self.max_orphans:
+            self._pop_orphan(next(iter(self.orphans)))
+
+    def _pop_orphan(self, block_hash: str):
+        block = self.orphans.pop(block_hash)
+        waiting = self.orphans_by_parent[block.previous_hash]
+        waiting.remove(block_hash)
+        if not waiting:
+            del self.orphans_by_parent[block.previous_hash]
+        return block
+
+    def pop_orphans(self, parent_hash: str) -> list:
+        """Remove and return the orphans waiting for a parent."""
+        return [self._pop_orphan(block_hash) for block_hash in list(self.orphans_by_parent.get(parent_hash, ()))]
+
+    def branch(self, chain, block_hash: str) -> Tuple[int, list]:
+        """
+        Walk back from a side block to the main chain
+        :param chain: Snapshot of the main chain
+        :return: (height of the fork point, side blocks from just after it up to the block)
+        """
+        blocks = []
+        entry = self.side[block_hash]
+        while True:
+            block = entry.block
+            blocks.append(block)
+            height = block.index - 1
+            if height <= len(chain) and chain[height - 1].hash == block.previous_hash:
+                break
+            entry = self.side[block.previous_hash]
+        blocks.reverse()
+        return height, blocks
+
+    def switch(self, fork: int, abandoned, adopted, works):
+        """
+        Record a reorganization of the main chain: the blocks after the fork point become a
+        side branch and the adopted blocks, of the given works, leave the side branches
+        """
+        for height, block in enumerate(abandoned, fork + 1):
+            self.add_side(block, self.main_work[height - 1])
+        del self.main_work[fork:]
+        for block in adopted:
+            self._remove_side(block.hash)
+        self.extend(works)
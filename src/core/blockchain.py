@@ -1,16 +1,60 @@
 import hashlib
-import json
+import threading
+import weakref
+from collections import deque
 from time import time
 from urllib.parse import urlparse
-import requests
-from collections import OrderedDict
+from core.account_state import AccountState, transaction_cost
+from core.block_tree import BlockTree
+from core.chain_index import ChainIndex
+from core.chain_snapshot import ChainSnapshot
+from core.difficulty import DEFAULT_WORK, DifficultyRetarget, meets_work
+from core.encoding import Block, Transaction, encode_chain
+from core.merkle import verify_merkle_proof
+from core.mempool import Mempool
+from core.peers import PeerClient
+from core.tip_feed import TipFeed
 
 class Blockchain:
-    def __init__(self):
-        self.chain = []
-        self.current_transactions = []
+    """
+    The chain, its account state and indexes, and the mempool. Readers of self.chain get an
+    immutable ChainSnapshot without locking; every change to the chain, the mempool, the
+    account state or the indexes happens under one writer lock, and the new chain becomes
+    visible in a single attribute assignment once it is complete.
+    """
+
+    def __init__(self, miner=None, mempool=None, max_block_bytes=1000000, store=None, peer_client=None,
+                 checkpoints=None, retention=None, snapshots=None, retarget=None):
+        self._lock = threading.RLock()  # Serializes writers; readers use snapshots
+        self.retarget = retarget  # Optional DifficultyRetarget; without it every block takes DEFAULT_WORK
+        # Cumulative work, side branches and orphans; no branch forking below the retention window can be adopted
+        self.tree = BlockTree(max_depth=1000 if retention is None else retention)
+        self.tip_feed = TipFeed()  # Announces every new tip to subscribers
+        self.chain = []  # Blocks whose cached hashes have been verified
+        self.mempool = mempool or Mempool()  # Pending transactions, best fee rate first
+        self.max_block_bytes = max_block_bytes  # Encoded transaction bytes per block
         self.nodes = set()
-        self.create_block(previous_hash='1', proof=100)  # Create the genesis block
+        self.peer_client = peer_client  # PeerClient for resolve_conflicts, created on first use
+        self.miner = miner  # Optional ParallelMiner used by proof_of_work
+        self.store = store  # Optional BlockStore persisting the chain
+        self.accounts = AccountState()  # Balances and nonces as of the tip of self.chain
+        self.index = ChainIndex()  # Transaction id and address history lookups
+        self.checkpoints = {}  # Height -> hash of a block trusted without checks
+        self.state_checkpoints = {}  # Height -> AccountState digest after that block, which snapshots must match
+        for height, checkpoint in (checkpoints or {}).items():
+            # A checkpoint is a block hash, or a (block hash, state digest) pair
+            if isinstance(checkpoint, (tuple, list)):
+                self.checkpoints[height], self.state_checkpoints[height] = checkpoint
+            else:
+                self.checkpoints[height] = checkpoint
+        self.retention = retention  # Number of recent blocks whose transactions are kept; None for all
+        self.snapshots = snapshots  # Optional SnapshotStore for periodic account state snapshots
+        self.pruned_height = 0  # Number of leading blocks whose transactions were dropped
+
+        if store is not None and len(store):
+            self._load_store()
+        else:
+            self.create_block(previous_hash='1', proof=100)  # Create the genesis block
 
     def create_block(self, proof, previous_hash=None):
         """
@@ -19,31 +63,325 @@ class Blockchain:
         :param previous_hash: Hash of the previous block
         :return: New Block
         """
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
-        self.current_transactions = []  # Reset the current list of transactions
-        self.chain.append(block)
-        return block
+        with self._lock:
+            # Transactions after a sender's missing nonce stay pooled; balances may have changed since
+            # the others were pooled, e.g. after a chain replacement, and those that can never be mined are dropped
+            selected = self.mempool.select(self.max_block_bytes, next_nonce=self.accounts.get_nonce)
+            transactions, _ = self.accounts.affordable(selected)
+            block = Block(
+                index=len(self.chain) + 1,
+                timestamp=time(),
+                transactions=transactions,
+                proof=proof,
+                previous_hash=previous_hash or self.chain[-1].hash,
+            )
+            self._apply_block(block)
+            if self.store is not None:
+                block = self.store.append(block)
+            self._append(block)
+            return block
+
+    def _load_store(self):
+        """
+        Restart from disk: only headers are loaded, transactions are read on access. The account
+        state comes from the newest state snapshot in the chain, if any, so only the blocks after
+        it are replayed; without a SnapshotStore every block is. When pruning, only the retention
+        window is indexed. The body of a block is decoded at most once, and only if it is replayed
+        or indexed.
+        :raises ValueError: If blocks were stored without transactions, after restore_snapshot, and
+            no state snapshot at or above them is left to start from
+        """
+        self.chain = self.store.load_headers()
+        blocks = self._blocks
+        replayed = 0
+        if self.snapshots is not None:
+            snapshot = self.snapshots.latest(blocks)
+            if snapshot is not None:
+                self.accounts = AccountState.restore(snapshot['balances'], snapshot['nonces'])
+                replayed = snapshot['height']
+        kept = 0 if self.retention is None else max(0, len(blocks) - self.retention)
+        for height, block in enumerate(blocks):
+            if not block.has_body:  # Restored from a snapshot; read from the header, without decoding
+                if height >= replayed:
+                    raise ValueError(f"Block {height + 1} is stored without transactions and no state "
+                                     f"snapshot covers it")
+            elif height >= replayed or height >= kept:
+                loaded = self.store.read(height)  # One decode for both the account state and the index
+                if height >= replayed:
+                    self.accounts.apply_block(loaded)
+                if height >= kept:
+                    self.index.add_block(loaded)
+                    continue
+            blocks[height] = block.header_only()  # Out of the window, or restored from a snapshot
+            self.pruned_height = height + 1
+
+    @property
+    def chain(self):
+        """Snapshot of the chain; it stays consistent however the chain changes afterwards."""
+        return self._snapshot
+
+    @chain.setter
+    def chain(self, blocks):
+        """Install a new list of blocks as the chain, without touching the account state or indexes."""
+        with self._lock:
+            self._blocks = list(blocks)
+            self._views = weakref.WeakValueDictionary()  # id -> live snapshot of a list _reorganize truncates
+            self.tree.reset(self._branch_works(0, self._blocks))
+            self._publish()
 
-    def new_transaction(self, sender, recipient, amount):
+    def _append(self, block):
+        """Publish a block at the tip; existing snapshots keep their length."""
+        self.tree.extend(self._branch_works(len(self._blocks), (block,)))
+        self._blocks.append(block)
+        self._publish()
+        self._prune()
+        self.tree.evict(len(self._blocks))
+        self._write_snapshot()
+
+    def _publish(self):
+        """Make self._blocks the chain readers see and announce its tip."""
+        self._snapshot = ChainSnapshot(self._blocks)
+        self._work_snapshot = ChainSnapshot(self.tree.main_work)
+        self._views[id(self._snapshot)] = self._snapshot
+        self._views[id(self._work_snapshot)] = self._work_snapshot
+        if self._blocks:
+            self._tip_work = len(self._blocks), self._blocks[-1].hash, self.tree.tip_work
+            self.tip_feed.publish(len(self._blocks), self._blocks[-1].hash)
+        else:
+            self._tip_work = 0, None, 0
+
+    def _prune(self):
+        """
+        Replace the blocks that fell out of the retention window by their headers, so the memory
+        held by transactions is bounded by the window rather than the chain length. Snapshots
+        taken earlier see the pruned blocks without their transactions too.
+        """
+        if self.retention is None:
+            return
+        while self.pruned_height < len(self._blocks) - self.retention:
+            block = self._blocks[self.pruned_height]
+            if block.transactions is not None:
+                self.index.prune_block(block)
+            self._blocks[self.pruned_height] = block.header_only()
+            self.pruned_height += 1
+
+    def _write_snapshot(self):
+        """Write a state snapshot when the chain has moved the snapshot interval since the last one."""
+        if self.snapshots is not None and self.snapshots.due(len(self._blocks)):
+            self.snapshots.write(len(self._blocks), self._blocks[-1], self.accounts)
+
+    def restore_snapshot(self, snapshot, headers):
+        """
+        Start from a state snapshot instead of downloading and replaying every block from genesis.
+        Block headers do not commit to the account state, and the snapshot checksum only detects
+        corruption, so the snapshot must be at a checkpoint whose state digest it matches.
+        The blocks up to it are kept as headers only, so a node with a BlockStore also needs a
+        SnapshotStore, from which it restarts.
+        :param snapshot: Snapshot from decode_snapshot
+        :param headers: Our chain up to at least the snapshot height, as Blocks or dicts; transactions are not needed
+        :raises ValueError: If the snapshot is not at a checkpoint with a state digest, its balances
+            and nonces do not match the digest, the headers do not lead to it, or the chain is
+            persisted without a SnapshotStore
+        """
+        height, tip = snapshot['height'], snapshot['tip']
+        if self.store is not None and self.snapshots is None:
+            raise ValueError("Restoring a state snapshot into a BlockStore needs a SnapshotStore to restart from")
+        if self.checkpoints.get(height) != tip.hash or height not in self.state_checkpoints:
+            raise ValueError(f"State snapshot at height {height} is not at a state checkpoint")
+        try:
+            accounts = AccountState.restore(snapshot['balances'], snapshot['nonces'])
+            digest = accounts.digest()
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Malformed state snapshot: {e}")
+        if digest != self.state_checkpoints[height]:
+            raise ValueError(f"State snapshot at height {height} does not match the state checkpoint")
+        try:
+            headers = [Block.coerce(block).header_only() for block in headers[:height]]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Malformed header: {e}")
+        if len(headers) != height or self.verify_chain(headers, headers_only=True) is None:
+            raise ValueError("Headers do not lead to the state snapshot")
+
+        with self._lock:
+            if self.store is not None:
+                self.store.truncate(0)
+                headers = [self.store.append(block) for block in headers]
+            self.chain = headers
+            self.accounts = accounts
+            self.index = ChainIndex()
+            self.pruned_height = height
+            if self.snapshots is not None:
+                self.snapshots.write(height, tip, self.accounts)
+
+    @staticmethod
+    def make_transaction(sender, recipient, amount, fee=0, nonce=None):
+        """
+        Build the Transaction for new_transaction's arguments; a zero fee is left out so
+        that it does not change the transaction id. The sender's nonce is part of the id, so
+        a repeated payment is a new transaction and a confirmed one cannot be replayed.
+        :return: Transaction
+        """
+        extra = {}
+        if fee:
+            extra['fee'] = fee
+        if nonce is not None:
+            extra['nonce'] = nonce
+        return Transaction(sender, recipient, amount, extra)
+
+    def _nonce_for(self, sender, nonce, pooled):
+        """
+        Nonce of a new transaction: the one given, or the sender's next one after its confirmed
+        and pooled transactions. A given nonce may not skip ahead of that, so it never leaves a
+        gap that would hold its transaction in the pool, but may fill a gap left by a reorganization
+        :param pooled: Nonce following the sender's pooled transactions, None if it has none
+        :raises ValueError: If the given nonce is not an integer, is already used or skips ahead
+        """
+        expected = self.accounts.next_nonce(sender, pooled)
+        if nonce is None:
+            return expected
+        if type(nonce) is not int or nonce < self.accounts.get_nonce(sender):
+            raise ValueError(f"Nonce {nonce!r} of {sender} is invalid or already used")
+        if expected is not None and nonce > expected:
+            raise ValueError(f"Nonce {nonce} of {sender} skips ahead of its next one, {expected}")
+        return nonce
+
+    def add_transaction(self, sender, recipient, amount, fee=0, nonce=None):
+        """
+        Validate a new transaction and pool it for the next mined Blocks
+        :param nonce: Sender's nonce the transaction takes; by default its next one
+        :return: The pooled Transaction
+        :raises ValueError: As for new_transaction
+        """
+        with self._lock:
+            transaction = self.make_transaction(sender, recipient, amount, fee,
+                                                self._nonce_for(sender, nonce, self.mempool.next_nonce(sender)))
+            if not self.accounts.can_spend(sender, transaction_cost(transaction), self.mempool.pending_cost(sender)):
+                raise ValueError(f"Insufficient balance for {sender}")
+            self.mempool.add(transaction)
+            return transaction
+
+    def new_transaction(self, sender, recipient, amount, fee=0, nonce=None):
         """
         Creates a new transaction to go into the next mined Block
         :param sender: Address of the Sender
         :param recipient: Address of the Recipient
         :param amount: Amount
+        :param fee: Fee offered to the miner; higher fees per byte are mined first
+        :param nonce: Sender's nonce the transaction takes; by default its next one
         :return: The index of the Block that will hold this transaction
+        :raises ValueError: If the sender cannot cover amount and fee on top of its pending
+            transactions, the nonce is used or skips ahead, the transaction is a duplicate, or the
+            mempool rejects it
+        """
+        with self._lock:
+            self.add_transaction(sender, recipient, amount, fee, nonce)
+            return self.last_block['index'] + 1
+
+    def add_transactions(self, transactions):
         """
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        })
-        return self.last_block['index'] + 1
+        Creates a batch of transactions for the next mined Blocks. Each is checked like in
+        new_transaction, with the earlier transactions of the batch counted as pending, and the
+        accepted ones are inserted into the mempool in one bulk operation.
+        :param transactions: (sender, recipient, amount, fee) or (sender, recipient, amount, fee, nonce) tuples
+        :return: Per transaction, the pooled Transaction or the ValueError that rejected it
+        """
+        results = [None] * len(transactions)
+        accepted, positions = [], []
+        pending = {}
+        with self._lock:
+            for position, fields in enumerate(transactions):
+                sender, recipient, amount, fee, nonce = tuple(fields) + (None,) * (5 - len(fields))
+                try:
+                    sender_pending = pending.get(sender, (self.mempool.pending_cost(sender),
+                                                          self.mempool.next_nonce(sender)))
+                    nonce = self._nonce_for(sender, nonce, sender_pending[1])
+                    transaction = self.make_transaction(sender, recipient, amount, fee, nonce)
+                    cost = transaction_cost(transaction)
+                    if not self.accounts.can_spend(sender, cost, sender_pending[0]):
+                        raise ValueError(f"Insufficient balance for {sender}")
+                except (TypeError, ValueError) as e:
+                    results[position] = e if isinstance(e, ValueError) else ValueError(str(e))
+                    continue
+                pooled = sender_pending[1] if nonce is None else max(sender_pending[1] or 0, nonce + 1)
+                pending[sender] = sender_pending[0] + cost, pooled
+                accepted.append(transaction)
+                positions.append(position)
+
+            for position, transaction, result in zip(positions, accepted, self.mempool.add_many(accepted)):
+                results[position] = result if isinstance(result, ValueError) else transaction
+        return results
+
+    def new_transactions(self, transactions):
+        """
+        Creates a batch of transactions, like add_transactions
+        :return: Per transaction, its id or the ValueError that rejected it
+        """
+        return [result if isinstance(result, ValueError) else result.id
+                for result in self.add_transactions(transactions)]
+
+    def get_balance(self, address):
+        """
+        Balance of an address as of the last block
+        :param address: Address
+        :return: Balance
+        """
+        return self.accounts.get_balance(address)
+
+    def find_transaction(self, transaction_id):
+        """
+        Locate a transaction in the chain
+        :param transaction_id: Transaction id
+        :return: Dict with the block index, position and transaction, or None if not in the chain
+        """
+        with self._lock:  # The index and the chain must agree
+            location = self.index.find_transaction(transaction_id)
+            if location is None:
+                return None
+            block_index, position = location
+            transaction = self.chain[block_index - 1].transactions[position]
+        return {
+            'block_index': block_index,
+            'position': position,
+            'transaction': transaction.to_dict(),
+        }
+
+    def get_address_history(self, address, cursor=None, limit=50, newest_first=True):
+        """
+        Page through the confirmed transactions sent or received by an address
+        :param address: Address
+        :param cursor: Cursor returned with the previous page, None for the first page
+        :param limit: Maximum number of transactions per page
+        :param newest_first: Start from the most recent transaction
+        :return: (list of dicts like find_transaction returns, next cursor or None)
+        """
+        with self._lock:  # The index and the chain must agree
+            postings, next_cursor = self.index.address_history(address, cursor, limit, newest_first)
+            chain = self.chain
+        bodies = {}
+        page = []
+        for block_index, position in postings:
+            if block_index not in bodies:
+                bodies[block_index] = chain[block_index - 1].transactions
+            page.append({
+                'block_index': block_index,
+                'position': position,
+                'transaction': bodies[block_index][position].to_dict(),
+            })
+        return page, next_cursor
+
+    def get_nonce(self, address):
+        """
+        Number of confirmed transactions sent by an address
+        :param address: Address
+        :return: Nonce
+        """
+        return self.accounts.get_nonce(address)
+
+    @property
+    def current_transactions(self):
+        with self._lock:
+            transactions = self.mempool.transactions()
+        return [transaction.to_dict() for transaction in transactions]
 
     @property
     def last_block(self):
@@ -52,38 +390,113 @@ class Blockchain:
     @staticmethod
     def hash(block):
         """
-        Creates a SHA-256 hash of a Block
-        :param block: Block
+        Creates a SHA-256 hash of the canonical binary encoding of a Block
+        :param block: Block, or a block in dict form
         :return: Hash
         """
-        # Convert the block into a string and encode it
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        return Block.coerce(block).hash
 
     def proof_of_work(self, last_proof):
         """
         Simple Proof of Work Algorithm:
-         - Find a number p' such that hash(pp') contains 4 leading zeroes, where p is the previous p'
+         - Find a number p' such that hash(pp') is below the target of the next block's work
+           (4 leading hex zeroes at the fixed difficulty), where p is the previous p'
          - p is the previous proof, and p' is the new proof
         :param last_proof: Previous Proof
         :return: New Proof
         """
+        work = self.next_work()
+        if self.miner is not None:
+            return self.miner.proof_of_work(last_proof, work=work)
+
         proof = 0
-        while not self.valid_proof(last_proof, proof):
+        while not self.valid_proof(last_proof, proof, work):
             proof += 1
         return proof
 
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, work=DEFAULT_WORK):
         """
         Validates the Proof
         :param last_proof: Previous Proof
         :param proof: Current Proof
+        :param work: Work required of the block, i.e. the expected number of hashes to find its proof
         :return: True if correct, False if not
         """
         guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return meets_work(hashlib.sha256(guess).digest(), work)
+
+    def required_work(self, history):
+        """
+        Work a block must carry, which fork choice also counts it for
+        :param history: (timestamp, cumulative work) of its last ancestors, oldest first
+        :return: Work
+        """
+        return DEFAULT_WORK if self.retarget is None else self.retarget.next_work(history)
+
+    def valid_timestamp(self, history, timestamp):
+        """Check a block's timestamp against its ancestors; any timestamp goes at a fixed difficulty."""
+        return self.retarget is None or self.retarget.valid_timestamp(history, timestamp, time())
+
+    def _history(self, chain, main_work, height):
+        """
+        History retargeting looks at, up to a height of our chain
+        :param chain: Snapshot of our chain
+        :param main_work: Snapshot of the tree's cumulative work, taken together with the chain snapshot
+        :return: Deque of (timestamp, cumulative work), oldest first
+        """
+        length = 1 if self.retarget is None else self.retarget.history_length
+        start = max(0, height - length)
+        return deque(zip((block.timestamp for block in chain[start:height]), main_work[start:height]), maxlen=length)
+
+    def _consistent_chain(self):
+        """Snapshot of our chain and the cumulative work of its blocks, taken together."""
+        with self._lock:
+            return self.chain, self._work_snapshot
+
+    def _branch_works(self, shared, blocks):
+        """Work of each of blocks following the first shared blocks of our chain."""
+        if self.retarget is None:
+            return [DEFAULT_WORK] * len(blocks)
+        chain, main_work = self._consistent_chain() if shared else ((), ())
+        history = self._history(chain, main_work, shared)
+        works = []
+        for block in blocks:
+            work = self.required_work(history)
+            works.append(work)
+            history.append((block.timestamp, (history[-1][1] if history else 0) + work))
+        return works
+
+    def next_work(self):
+        """Work required of the next block on our chain."""
+        if self.retarget is None:
+            return DEFAULT_WORK
+        chain, main_work = self._consistent_chain()
+        return self.required_work(self._history(chain, main_work, len(chain)))
+
+    def mining_stats(self, window=100):
+        """
+        Difficulty and mining throughput over the last blocks, for capacity planning
+        :param window: Number of block intervals looked at
+        :return: Dict with the work required of the next block, the target block interval (None at a
+            fixed difficulty), the estimated network hash rate in hashes per second, the mean block
+            interval and a histogram of block intervals
+        """
+        chain, main_work = self._consistent_chain()
+        # At a fixed difficulty the histogram buckets are around the default target interval
+        retarget = self.retarget or DifficultyRetarget()
+        start = max(0, len(chain) - window - 1)
+        history = list(zip((block.timestamp for block in chain[start:]), main_work[start:len(chain)]))
+        timestamps = [timestamp for timestamp, _ in history]
+        intervals = len(timestamps) - 1
+        return {
+            'height': len(chain),
+            'next_work': self.required_work(self._history(chain, main_work, len(chain))),
+            'target_interval': None if self.retarget is None else self.retarget.target_interval,
+            'hash_rate': retarget.hash_rate(history),
+            'mean_interval': (timestamps[-1] - timestamps[0]) / intervals if intervals else None,
+            'intervals': retarget.interval_histogram(timestamps),
+        }
 
     def register_node(self, address):
         """
@@ -93,67 +506,407 @@ class Blockchain:
         parsed_url = urlparse(address)
         self.nodes.add(parsed_url.netloc)
 
-    def valid_chain(self, chain):
+    @property
+    def validated_height(self):
+        """
+        Number of blocks at the start of our chain whose hashes are cached and verified
+        """
+        return len(self.chain)
+
+    def shared_height(self, chain, ours=None):
+        """
+        Find how many leading blocks of a chain are identical to our validated blocks.
+        A block hash commits to its previous_hash, so one matching hash at height h
+        proves the whole prefix up to h; matches are therefore monotone and can be
+        found by binary search with O(log n) hashes.
+        :param chain: A blockchain
+        :param ours: Snapshot of our chain to compare with, by default the current one
+        :return: Height of the shared prefix
+        """
+        ours = self.chain if ours is None else ours
+        low, high = 0, min(len(chain), len(ours))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.hash(chain[mid - 1]) == ours[mid - 1].hash:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def trusted_height(self, chain):
+        """
+        Height of the highest checkpoint a chain passes. The hash links up to it commit to every
+        earlier block, so those blocks need no proof or transaction checks, and may be header-only.
+        :param chain: A blockchain, as Blocks or block dicts
+        :return: Height, 0 if the chain passes no checkpoint
+        :raises ValueError: If the chain has another block at a checkpointed height
+        """
+        trusted = 0
+        for height, checkpoint_hash in self.checkpoints.items():
+            if height <= len(chain):
+                if Block.coerce(chain[height - 1]).hash != checkpoint_hash:
+                    raise ValueError(f"Block at height {height} does not match the checkpoint")
+                trusted = max(trusted, height)
+        return trusted
+
+    def verify_chain(self, chain, incremental=False, headers_only=False):
+        """
+        Validate a chain and return its verified blocks
+        :param chain: A blockchain, as Blocks or block dicts
+        :param incremental: Only verify the blocks after the prefix shared with our chain
+        :param headers_only: Only verify block headers; transaction bodies may be absent
+        :return: (shared height, verified Blocks after it) if valid, None if not
+        """
+        if not chain:
+            return None
+
+        try:
+            trusted = self.trusted_height(chain)
+            ours, main_work = self._consistent_chain()
+            start = self.shared_height(chain, ours) if incremental else 0
+            history = self._history(ours, main_work, start)  # Of the blocks up to last_block
+            if start:
+                last_block = ours[start - 1]
+                blocks = []
+            else:
+                start = 1
+                last_block = Block.coerce(chain[0])
+                if not headers_only and not trusted and not last_block.valid_body():
+                    return None
+                blocks = [last_block]
+                history.append((last_block.timestamp, self.required_work(history)))
+
+            for height, block in enumerate(chain[start:], start + 1):
+                block = Block.coerce(block)
+                # Check that the hash of the block is correct
+                if block.previous_hash != last_block.hash:
+                    return None
+
+                work = self.required_work(history)
+                if height > trusted:
+                    # Check that the Proof of Work is correct, at the difficulty the chain asks for
+                    if not self.valid_proof(last_block.proof, block.proof, work):
+                        return None
+                    if not self.valid_timestamp(history, block.timestamp):
+                        return None
+
+                    # Check that the transactions match the Merkle root in the header
+                    if not headers_only and not block.valid_body():
+                        return None
+
+                last_block = block
+                blocks.append(block)
+                history.append((block.timestamp, history[-1][1] + work))
+        except (KeyError, TypeError, ValueError):
+            return None  # Malformed block
+
+        return len(chain) - len(blocks), blocks
+
+    def valid_chain(self, chain, incremental=False, headers_only=False):
         """
         Determine if a given blockchain is valid
         :param chain: A blockchain
+        :param incremental: Only verify the suffix after the prefix shared with our
+            validated chain. The shared prefix is then taken to be our own blocks,
+            which is what replace_chain adopts.
+        :param headers_only: Verify the hash links and proofs of the block headers
+            without touching transaction bodies
         :return: True if valid, False if not
         """
-        last_block = chain[0]
-        current_index = 1
+        return self.verify_chain(chain, incremental, headers_only) is not None
 
-        while current_index < len(chain):
-            block = chain[current_index]
-            # Check that the hash of the block is correct
-            if block['previous_hash'] != self.hash(last_block):
-                return False
+    def transaction_proof(self, block_index, position):
+        """
+        Build a Merkle inclusion proof for a transaction
+        :param block_index: Index of the block holding the transaction
+        :param position: Position of the transaction in the block
+        :return: Dict with the transaction, the block hash and Merkle root, and the proof
+        """
+        block = self.chain[block_index - 1]
+        return {
+            'transaction': block.transactions[position].to_dict(),
+            'block_index': block_index,
+            'block_hash': block.hash,
+            'merkle_root': block.merkle_root,
+            'proof': block.transaction_proof(position),
+        }
 
-            # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'], block['proof']):
+    @staticmethod
+    def verify_transaction_proof(transaction, proof, merkle_root):
+        """
+        Check a Merkle inclusion proof without the rest of the block
+        :param transaction: The transaction, as a dict or Transaction
+        :param proof: Proof from transaction_proof
+        :param merkle_root: Merkle root from the block header
+        :return: True if the transaction is included, False if not
+        """
+        if isinstance(transaction, dict):
+            transaction = Transaction.from_dict(transaction)
+        return verify_merkle_proof(transaction.leaf, proof, merkle_root)
+
+    def replace_chain(self, chain, verified=None, longer_only=False):
+        """
+        Replace our chain with a valid one, re-hashing only the blocks we have not validated.
+        Verification runs without the writer lock; the switch itself is atomic for readers.
+        Our blocks after the fork point are kept in the block tree as a side branch.
+        :param chain: A blockchain
+        :param verified: Result of verify_chain for this chain, if already known
+        :param longer_only: Only replace our chain if the new one has more cumulative work at
+            the time of the switch, which at a fixed difficulty means it is longer
+        :return: True if our chain was replaced, False if the chain is invalid (or has less work)
+        """
+        verified = verified or self.verify_chain(chain, incremental=True)
+        if verified is None:
+            return False
+
+        with self._lock:
+            shared, blocks = verified
+            if shared > len(self.chain) or shared and blocks and blocks[0].previous_hash != self.chain[shared - 1].hash:
+                # Our chain was replaced since verification; check the new blocks against it again
+                verified = self.verify_chain(chain, incremental=True)
+                if verified is None:
+                    return False
+                shared, blocks = verified
+            if longer_only and self.tree.branch_work(shared, self._branch_works(shared, blocks)) <= self.tree.tip_work:
                 return False
+            return self._reorganize(shared, blocks)
+
+    def add_block(self, block):
+        """
+        Add a block received from the network. It may extend our chain, extend or start a side
+        branch, or wait in the orphan pool until its parent arrives; orphans waiting for it are
+        connected right after it. Fork choice is by cumulative work: when a branch ends up with
+        more work than our chain, we reorganize onto it, reverting and applying only the blocks
+        after the fork point. On equal work the branch seen first is kept.
+        :param block: Block, or a block in dict form
+        :return: 'extended', 'reorganized', 'side', 'orphan' or 'duplicate'
+        :raises ValueError: If the block does not or can never follow from its parent, or completes a branch
+            that overdraws an account, has a nonce out of sequence or forks below the retention window (the branch
+            is then dropped from the tree)
+        """
+        try:
+            block = Block.coerce(block)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Malformed block: {e}")
+
+        if self.checkpoints.get(block.index, block.hash) != block.hash:
+            raise ValueError(f"Block {block.hash} conflicts with the checkpoint at height {block.index}")
+
+        with self._lock:
+            if self.tree.contains(self.chain, block):
+                return 'duplicate'
+            if self.tree.parent(self.chain, block) is None:
+                if not self.tree.may_link(block):
+                    raise ValueError(f"Block {block.hash} can never follow from its parent")
+                self.tree.add_orphan(block)
+                return 'orphan'
 
-            last_block = block
-            current_index += 1
+            best, best_work = None, self.tree.tip_work
+            pending = [block]
+            while pending:
+                candidate = pending.pop()
+                found = self.tree.parent(self.chain, candidate)
+                if found is None:
+                    continue  # An orphan whose height does not follow its parent's is dropped
+                parent, parent_work = found
+                history = () if self.retarget is None else self.tree.history(
+                    self.chain, parent, parent_work, self.retarget.history_length)
+                work = self.required_work(history)
+                if not self.valid_child(parent, candidate, work, history):
+                    if candidate is block:
+                        raise ValueError(f"Block {block.hash} does not follow from its parent")
+                    continue  # An orphan that turned out invalid is dropped
+                work += parent_work
+                self.tree.add_side(candidate, work)
+                if work > best_work:
+                    best, best_work = candidate, work
+                pending.extend(self.tree.pop_orphans(candidate.hash))
 
+            if best is None:
+                return 'side'
+            fork, blocks = self.tree.branch(self.chain, best.hash)
+            extended = fork == len(self.chain)
+            if fork < self.pruned_height:
+                self.tree.discard(blocks[0].hash)
+                raise ValueError(f"Branch ending in block {best.hash} forks below the retention window")
+            if not self._reorganize(fork, blocks):
+                self.tree.discard(blocks[0].hash)
+                raise ValueError(f"Branch ending in block {best.hash} overdraws an account "
+                                 "or has a nonce out of sequence")
+            return 'extended' if extended else 'reorganized'
+
+    def valid_child(self, parent, block, work=DEFAULT_WORK, history=()):
+        """
+        Check a block against its parent: height, hash link, proof, timestamp and transaction body
+        :param work: Work required of the block
+        :param history: (timestamp, cumulative work) of the parent and its last ancestors, when retargeting
+        :return: True if valid, False if not
+        """
+        return (block.index == parent.index + 1 and block.previous_hash == parent.hash
+                and self.valid_proof(parent.proof, block.proof, work)
+                and self.valid_timestamp(history, block.timestamp) and block.valid_body())
+
+    def _reorganize(self, shared, blocks):
+        """
+        Switch our chain after its first shared blocks to verified blocks, reverting and applying
+        the state of only the blocks after the fork point. The chain is truncated and extended in
+        place, so extending it at the tip costs no more than the new blocks. The caller holds the
+        writer lock.
+        :return: True if switched, False (with nothing changed) if the new blocks overdraw an
+            account or have a nonce out of sequence, or the fork point is below the retention
+            window, whose blocks cannot be reverted
+        """
+        if shared < self.pruned_height:
+            return False
+        abandoned = self.chain[shared:]
+        works = self._branch_works(shared, blocks)
+        if not self._switch_branch(abandoned, blocks):
+            return False
+
+        included = set()
+        for block in blocks:
+            included.update(transaction.id for transaction in block.transactions)
+        self.mempool.remove(included)
+        # Transactions of our abandoned blocks go back to the pool unless the new chain has them
+        for block in abandoned:
+            for transaction in block.transactions:
+                if transaction.id not in included:
+                    try:
+                        self.mempool.add(transaction)
+                    except ValueError:
+                        pass
+
+        if self.store is not None:
+            for block in abandoned:
+                # Older snapshots and the block tree may still read these blocks once the store drops them
+                block.transactions = block.transactions
+            self.store.truncate(shared)
+            blocks = [self.store.append(block) for block in blocks]
+        if abandoned:
+            for view in list(self._views.values()):  # Older snapshots keep the blocks and work being dropped
+                view.freeze(shared)
+        self.tree.switch(shared, abandoned, blocks, works)
+        del self._blocks[shared:]
+        self._blocks.extend(blocks)
+        self._publish()
+        self._prune()
+        self.tree.evict(len(self._blocks))
+        self._write_snapshot()
+        return True
+
+    def _apply_block(self, block, check=False):
+        """
+        Update the account state and indexes for a block joining the tip of the chain
+        :raises ValueError: If check is set and the block overdraws an account or has a nonce out of sequence
+        """
+        self.accounts.apply_block(block, check)
+        self.index.add_block(block)
+
+    def _revert_block(self, block):
+        """Undo _apply_block for the block at the tip of the chain."""
+        self.index.remove_block(block)
+        self.accounts.revert_block(block)
+
+    def _switch_branch(self, old_blocks, new_blocks):
+        """
+        Revert the state past old_blocks and apply new_blocks, rejecting overdrafts
+        :return: True if switched, False (with the state unchanged) if new_blocks are not applicable
+        """
+        for block in reversed(old_blocks):
+            self._revert_block(block)
+        applied = []
+        try:
+            for block in new_blocks:
+                self._apply_block(block, check=True)
+                applied.append(block)
+        except ValueError:
+            for block in reversed(applied):
+                self._revert_block(block)
+            for block in old_blocks:
+                self._apply_block(block)
+            return False
         return True
 
     def resolve_conflicts(self):
         """
-        Consensus Algorithm: resolves conflicts by replacing our chain with the longest one in the network
+        Consensus Algorithm: resolves conflicts by replacing our chain with the one with the most work in the network.
+        Peers are queried concurrently; only the chains of peers whose tips report more cumulative
+        work than ours are downloaded, and only the heaviest candidate is validated unless it turns out invalid.
         :return: True if our chain was replaced, False if not
         """
-        neighbors = self.nodes
-        new_chain = None
+        if self.peer_client is None:
+            self.peer_client = PeerClient()
 
-        # We're only looking for chains longer than ours
-        max_length = len(self.chain)
+        # We're only looking for chains with more work than ours, which may be shorter
+        length, _, work = self.get_tip_work()
+        candidates = self.peer_client.fetch_heavier_chains(self.nodes, length, work)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbors:
-            response = requests.get(f'http://{node}/chain')
+        # Replace our chain with the heaviest valid candidate
+        for length, chain, node in candidates:
+            verified = self.verify_chain(chain, incremental=True)
+            if verified is not None and self.replace_chain(chain, verified, longer_only=True):
+                return True
 
-            if response.status_code == 200:
-                length = response .json()['length']
-                chain = response.json()['chain']
+        return False
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+    def get_chain(self, start=0, end=None):
+        """
+        Returns the blockchain, or the blocks between two heights
+        :param start: Number of leading blocks to skip
+        :param end: Height to stop at, or None for the tip
+        :return: The blocks as a list of block dicts
+        """
+        return [block.to_dict() for block in self.chain[start:end]]
 
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
+    def get_chain_binary(self, start=0, end=None):
+        """
+        Returns the blockchain, or the blocks between two heights, in the compact binary encoding
+        :return: Encoded blocks
+        """
+        return encode_chain(self.chain[start:end])
 
-        return False
+    def get_tip(self):
+        """
+        Returns the height and hash of the last block, which is all a peer needs to tell
+        whether it is behind us
+        :return: (length, hash)
+        """
+        chain = self.chain
+        return len(chain), chain[-1].hash
+
+    def get_tip_work(self):
+        """
+        Returns the tip along with the cumulative work of the chain up to it, which tells a peer
+        whether our chain is better than its own even when it is shorter. Like the chain, it is
+        read without the writer lock.
+        :return: (length, hash, work)
+        """
+        return self._tip_work
+
+    def get_block_hash(self, height):
+        """
+        Returns the hash of the block at a height
+        :param height: Height, from 1 for the genesis block
+        :return: Hash, or None if the chain is not that long
+        """
+        chain = self.chain
+        if not 1 <= height <= len(chain):
+            return None
+        return chain[height - 1].hash
+
+    def get_headers(self, start=0, end=None):
+        """
+        Returns the headers of the blocks between two heights
+        :return: The headers as a list of dicts without transactions
+        """
+        return [block.header() for block in self.chain[start:end]]
 
-    def get_chain(self):
+    def get_headers_binary(self, start=0, end=None):
         """
-        Returns the full blockchain
-        :return: The blockchain
+        Returns the headers of the blocks between two heights in the compact binary encoding
+        :return: Encoded header-only blocks
         """
-        return self.chain
+        return encode_chain(block.header_only() for block in self.chain[start:end])
 
     def get_nodes(self):
         """
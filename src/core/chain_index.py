@@ -0,0 +1,106 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+# A posting packs (block index, position in block) into one unsigned 64-bit integer,
+# so an address history is a compact array that stays sorted in chain order.
+POSITION_BITS = 32
+POSITION_MASK = (1 << POSITION_BITS) - 1
+
+
+def pack_posting(block_index: int, position: int) -> int:
+    return (block_index << POSITION_BITS) | position
+
+
+def unpack_posting(posting: int) -> Tuple[int, int]:
+    return posting >> POSITION_BITS, posting & POSITION_MASK
+
+
+class ChainIndex:
+    """
+    Secondary indexes over the chain: transaction id -> (block index, position) and
+    address -> postings of every transaction it sent or received, in chain order.
+    Blocks are added as they join the chain and removed from the tip on reorganization,
+    so removal only ever pops postings from the end of each address history; pruning
+    removes the oldest blocks from the start.
+    """
+
+    def __init__(self):
+        self.transactions: Dict[str, int] = {}
+        self.addresses: Dict[str, array] = {}
+
+    def add_block(self, block):
+        for position, transaction in enumerate(block.transactions):
+            posting = pack_posting(block.index, position)
+            # The first inclusion wins if the same transaction appears in several blocks
+            self.transactions.setdefault(transaction.id, posting)
+            for address in self._addresses_of(transaction):
+                self.addresses.setdefault(address, array('Q')).append(posting)
+
+    def remove_block(self, block):
+        """Remove the most recently added block."""
+        for position in reversed(range(len(block.transactions))):
+            transaction = block.transactions[position]
+            posting = pack_posting(block.index, position)
+            if self.transactions.get(transaction.id) == posting:
+                del self.transactions[transaction.id]
+            for address in self._addresses_of(transaction):
+                history = self.addresses[address]
+                history.pop()
+                if not history:
+                    del self.addresses[address]
+
+    def prune_block(self, block):
+        """Remove the oldest indexed block, e.g. when its transactions are pruned from memory."""
+        end = pack_posting(block.index + 1, 0)
+        for transaction in block.transactions:
+            posting = self.transactions.get(transaction.id)
+            if posting is not None and posting < end:
+                del self.transactions[transaction.id]
+            for address in self._addresses_of(transaction):
+                history = self.addresses.get(address)
+                if history is None:
+                    continue
+                del history[:bisect_left(history, end)]
+                if not history:
+                    del self.addresses[address]
+
+    @staticmethod
+    def _addresses_of(transaction):
+        if transaction.sender == transaction.recipient:
+            return (transaction.sender,)
+        return transaction.sender, transaction.recipient
+
+    def find_transaction(self, transaction_id: str) -> Optional[Tuple[int, int]]:
+        """:return: (block index, position) of the transaction, or None if it is not in the chain"""
+        posting = self.transactions.get(transaction_id)
+        return None if posting is None else unpack_posting(posting)
+
+    def address_history(self, address: str, cursor: int = None, limit: int = 50,
+                        newest_first: bool = True) -> Tuple[List[Tuple[int, int]], Optional[int]]:
+        """
+        Page through the transactions of an address. The cursor is the last posting already
+        returned, so pages stay stable while new blocks are appended.
+        :param cursor: next cursor of the previous page, or None for the first page
+        :param limit: Maximum number of postings in the page
+        :param newest_first: Start from the most recent transaction
+        :return: ([(block index, position), ...], next cursor or None on the last page)
+        """
+        history = self.addresses.get(address)
+        if not history:
+            return [], None
+        if newest_first:
+            end = len(history) if cursor is None else bisect_left(history, cursor)
+            start = max(end - limit, 0)
+            page = history[start:end][::-1]
+            more = start > 0
+        else:
+            start = 0 if cursor is None else bisect_right(history, cursor)
+            page = history[start:start + limit]
+            more = start + limit < len(history)
+        next_cursor = page[-1] if page and more else None
+        return [unpack_posting(posting) for posting in page], next_cursor
+
+    def history_length(self, address: str) -> int:
+        history = self.addresses.get(address)
+        return len(history) if history else 0
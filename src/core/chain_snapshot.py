@@ -0,0 +1,84 @@
+from collections.abc import Sequence
+
+
+class ChainSnapshot(Sequence):
+    """
+    Immutable view of the chain as of one moment: the first `length` items of a list, the
+    blocks of the chain or their cumulative work. The list behind a snapshot is appended to
+    at the tip and truncated by a reorganization, which first freezes every live snapshot at
+    the fork point: the items a snapshot holds past it are copied out, in O(depth), and read
+    from that copy from then on. So a snapshot never changes after it is taken, except that
+    pruning replaces blocks below the retention window by their headers. Readers therefore
+    get a consistent chain from a single attribute read, without taking a lock; a read that
+    overlaps a freeze is retried.
+    """
+    __slots__ = ('_blocks', '_length', '_frozen', '__weakref__')
+
+    def __init__(self, blocks: list, length: int = None):
+        self._blocks = blocks
+        self._length = len(blocks) if length is None else length
+        # (fork, items from the fork up to the length): items below the fork are read from the list
+        self._frozen = (self._length, ())
+
+    def __len__(self):
+        return self._length
+
+    def freeze(self, fork: int):
+        """Copy out the items at and above a height before the list behind the snapshot is truncated to it."""
+        frozen_fork, tail = self._frozen
+        if fork < frozen_fork:
+            self._frozen = (fork, self._blocks[fork:frozen_fork] + list(tail))
+
+    def _slice(self, start: int, stop: int) -> list:
+        while True:
+            frozen = self._frozen
+            fork, tail = frozen
+            items = self._blocks[start:min(stop, fork)] if start < fork else []
+            if self._frozen is frozen:  # Otherwise the list may have been truncated while reading it
+                if stop > fork:
+                    items.extend(tail[max(start, fork) - fork:stop - fork])
+                return items
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step == 1:
+                return self._slice(start, stop)
+            return [self[i] for i in range(start, stop, step)]
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError('chain index out of range')
+        while True:
+            frozen = self._frozen
+            fork, tail = frozen
+            if key >= fork:
+                return tail[key - fork]
+            try:
+                item = self._blocks[key]
+            except IndexError:  # Truncated by a reorganization since the freeze was read
+                continue
+            if self._frozen is frozen:
+                return item
+
+    def __iter__(self):
+        for start in range(0, self._length, 1024):
+            yield from self._slice(start, min(start + 1024, self._length))
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, (ChainSnapshot, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"ChainSnapshot(length={self._length})"
+
+    @property
+    def tip(self):
+        """The last block."""
+        return self[-1]
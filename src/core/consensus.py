@@ -1,54 +1,90 @@
 import hashlib
 import random
 import time
+from core.difficulty import DEFAULT_WORK, meets_work
+from core.leader_schedule import EpochScheduler
+from core.stake_index import StakeIndex
 
 class Consensus:
     def __init__(self, blockchain):
         self.blockchain = blockchain
+        self.stakes = StakeIndex()  # Stakes of the validators for proof_of_stake
+        self.scheduler = EpochScheduler()
 
-    def proof_of_work(self, last_proof):
+    def proof_of_work(self, last_proof, work=DEFAULT_WORK):
         """
         Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains 4 leading zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
         :param last_proof: Previous Proof
+        :param work: Required work, e.g. Blockchain.next_work() when the chain retargets
         :return: New Proof
         """
         proof = 0
-        while not self.valid_proof(last_proof, proof):
+        while not self.valid_proof(last_proof, proof, work):
             proof += 1
         return proof
 
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, work=DEFAULT_WORK):
         """
         Validates the Proof
         :param last_proof: Previous Proof
         :param proof: Current Proof
+        :param work: Required work; the default asks for 4 leading hex zeroes
         :return: True if correct, False if not
         """
         guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return meets_work(hashlib.sha256(guess).digest(), work)
 
-    def proof_of_stake(self, stakes):
+    def proof_of_stake(self, stakes=None, rng=random):
         """
         Simple Proof of Stake Algorithm:
          - Randomly select a validator based on their stake
-        :param stakes: Dictionary of addresses and their stakes
+        :param stakes: Dictionary of addresses and their stakes, or a StakeIndex; our stake index if not given.
+            A dictionary is indexed on every call, so keep a StakeIndex to elect in O(log n)
+        :param rng: Source of randomness, e.g. a seeded random.Random
         :return: Selected validator
         """
-        total_stake = sum(stakes.values())
-        if total_stake == 0:
-            return None
+        if stakes is None:
+            stakes = self.stakes
+        elif not isinstance(stakes, StakeIndex):
+            stakes = StakeIndex(stakes)
+        return stakes.elect(rng)
 
-        # Randomly select a validator based on their stake
-        random_choice = random.uniform(0, total_stake)
-        current_sum = 0
-        for validator, stake in stakes.items():
-            current_sum += stake
-            if current_sum >= random_choice:
-                return validator
+    def set_stake(self, address, stake):
+        """
+        Register a validator or update its stake in O(log n)
+        :param address: Address of the validator
+        :param stake: New stake; 0 keeps the validator registered without any chance of election
+        """
+        self.stakes.set(address, stake)
+
+    def elect_validators(self, count, rng=random):
+        """
+        Draw a whole epoch's schedule at once: count independent stake-weighted elections
+        :param count: Number of slots
+        :param rng: Source of randomness, e.g. a seeded random.Random
+        :return: List of the validator of each slot
+        """
+        return self.stakes.elect_many(count, rng)
+
+    def leader_schedule(self, epoch):
+        """
+        Get the leader schedule of an epoch, seeded from the previous epoch's blocks of our chain
+        :param epoch: Number of the epoch
+        :return: LeaderSchedule, the same on every node with the same chain and stakes
+        :raises ValueError: If the previous epoch is not complete yet or no validator has stake
+        """
+        return self.scheduler.schedule(self.blockchain.chain, self.stakes, epoch)
+
+    def slot_leader(self, slot):
+        """
+        Get the validator that leads a slot, in O(1) once its epoch is scheduled
+        :param slot: Slot number; the block at height h fills slot h - 1
+        :return: Address of the leader
+        """
+        return self.leader_schedule(self.scheduler.epoch_of(slot)).leader(slot)
 
     def byzantine_fault_tolerance(self, proposals):
         """
@@ -76,31 +112,7 @@ class Consensus:
         Consensus Algorithm: resolves conflicts by replacing our chain with the longest one in the network
         :return: True if our chain was replaced, False if not
         """
-        neighbors = self.blockchain.nodes
-        new_chain = None
-
-        # We're only looking for chains longer than ours
-        max_length = len(self.blockchain.chain)
-
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbors:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.blockchain.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.blockchain.chain = new_chain
-            return True
-
-        return False
+        return self.blockchain.resolve_conflicts()
 
     def get_current_stakes(self):
         """
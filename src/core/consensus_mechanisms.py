@@ -1,6 +1,10 @@
 import hashlib
 import random
 from typing import List, Dict, Any
+from core.difficulty import work_target
+from core.leader_schedule import LeaderSchedule
+from core.pbft import PBFTCluster, Transport
+from core.stake_index import StakeIndex
 
 class Block:
     def __init__(self, index: int, previous_hash: str, transactions: List[Dict[str, Any]], nonce: int = 0):
@@ -15,58 +19,100 @@ class Block:
         block_string = f"{self.index}{self.previous_hash}{self.transactions}{self.nonce}".encode()
         return hashlib.sha256(block_string).hexdigest()
 
+    def hash_prefix(self) -> bytes:
+        """Encode the part of the hashed block string that does not change with the nonce."""
+        return f"{self.index}{self.previous_hash}{self.transactions}".encode()
+
+    def midstate(self):
+        """SHA-256 state after absorbing the hash prefix; copy it and add the nonce to finish a hash."""
+        return hashlib.sha256(self.hash_prefix())
+
 class ProofOfWork:
-    def __init__(self, difficulty: int):
-        self.difficulty = difficulty
+    def __init__(self, difficulty: int, miner=None, work: int = None):
+        self.difficulty = difficulty  # Leading hex zeroes asked for, unless work is set
+        self.work = work  # Expected hashes per block, which unlike difficulty need not be a power of 16
+        self.miner = miner  # Optional ParallelMiner to spread the nonce search over several cores
+
+    @property
+    def required_work(self) -> int:
+        """Expected hashes to mine a block."""
+        return 16 ** self.difficulty if self.work is None else self.work
 
     def mine_block(self, block: Block) -> Block:
-        """Perform the mining process to find a valid hash."""
-        while block.hash[:self.difficulty] != '0' * self.difficulty:
-            block.nonce += 1
-            block.hash = block.calculate_hash()
+        """Perform the mining process to find a hash below the target of the required work."""
+        if self.miner is not None:
+            return self.miner.mine_block(block, self.difficulty, work=self.work)
+        target = work_target(self.required_work)
+        if int(block.hash, 16) < target:
+            return block
+
+        # Hash the block prefix once; each attempt only copies the state and adds the nonce
+        midstate = block.midstate()
+        nonce = block.nonce
+        while True:
+            nonce += 1
+            attempt = midstate.copy()
+            attempt.update(str(nonce).encode())
+            if int.from_bytes(attempt.digest(), 'big') < target:
+                break
+        block.nonce = nonce
+        block.hash = attempt.hexdigest()
         return block
 
 class ProofOfStake:
     def __init__(self):
-        self.stakeholders = {}  # Maps node addresses to their stakes
+        self.stakes = StakeIndex()  # Node addresses and their stakes, with O(log n) updates and elections
+
+    @property
+    def stakeholders(self) -> Dict[str, float]:
+        """Maps node addresses to their stakes."""
+        return dict(self.stakes.items())
 
     def register_stakeholder(self, node: str, stake: float):
-        """Register a stakeholder with their stake."""
-        self.stakeholders[node] = stake
+        """Register a stakeholder with their stake, or update the stake of a registered one."""
+        self.stakes.set(node, stake)
+
+    def remove_stakeholder(self, node: str):
+        """Remove a stakeholder, e.g. once it has withdrawn its stake."""
+        self.stakes.remove(node)
 
-    def elect_validator(self) -> str:
+    def elect_validator(self, rng=random) -> str:
         """Elect a validator based on their stake."""
-        total_stake = sum(self.stakeholders.values())
-        random_choice = random.uniform(0, total_stake)
-        current_sum = 0
-        for node, stake in self.stakeholders.items():
-            current_sum += stake
-            if current_sum >= random_choice:
-                return node
-        return None
+        return self.stakes.elect(rng)
+
+    def elect_validators(self, count: int, rng=random) -> List[str]:
+        """Elect the validators of count slots at once, e.g. a whole epoch's schedule."""
+        return self.stakes.elect_many(count, rng)
+
+    def schedule_epoch(self, epoch: int, slots: int, seed: bytes) -> LeaderSchedule:
+        """Precompute the leader of every slot of an epoch from the current stakes and the epoch seed."""
+        return LeaderSchedule.compute(epoch, slots, seed, self.stakes)
 
 class PracticalByzantineFaultTolerance:
-    def __init__(self, nodes: List[str]):
+    def __init__(self, nodes: List[str], transport: Transport = None):
         self.nodes = nodes
         self.ledger = []  # Stores the confirmed transactions
+        # One block per pre-prepare; see PBFTCluster for batched, pipelined use
+        self.cluster = PBFTCluster(nodes=nodes, transport=transport, batch_size=1)
 
     def propose_block(self, block: Block) -> bool:
-        """Propose a block to the network."""
+        """Propose a block to the network and run the three-phase protocol until it commits."""
         print(f"Proposing block {block.index} with hash {block.hash}.")
-        votes = self.collect_votes(block)
-        if len(votes) > len(self.nodes) // 2:
+        committed = len(self.cluster.committed)
+        self.cluster.submit({'index': block.index, 'previous_hash': block.previous_hash, 'hash': block.hash})
+        self.cluster.run()
+        if len(self.cluster.committed) > committed:
             self.ledger.append(block)
             print(f"Block {block.index} has been added to the ledger.")
             return True
         return False
 
     def collect_votes(self, block: Block) -> List[str]:
-        """Simulate collecting votes from nodes."""
-        votes = []
-        for node in self.nodes:
-            if random.choice([True, False]):  # Randomly simulate voting
-                votes.append(node)
-        return votes
+        """Nodes that have executed a block of the ledger, i.e. saw a quorum commit it."""
+        if block not in self.ledger:
+            return []
+        sequence = self.ledger.index(block) + 1  # Each block is its own batch
+        return [replica.id for replica in self.cluster.replicas if replica.last_executed >= sequence]
 
 def main():
     # Example usage of the consensus mechanisms
@@ -0,0 +1,121 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+MAX_HASH = 2 ** 256
+DEFAULT_WORK = 16 ** 4  # Four leading hex zeroes: the fixed difficulty of the original proof of work
+
+
+def work_target(work: int) -> int:
+    """Bound a SHA-256 hash, read as a big-endian integer, must stay below to take work hashes on average."""
+    return MAX_HASH // work
+
+
+def meets_work(digest: bytes, work: int) -> bool:
+    """
+    Check a SHA-256 digest against a difficulty. For work = 16 ** d this is exactly the check
+    for d leading hex zeroes, so DEFAULT_WORK accepts the same proofs as the original "0000" test.
+    """
+    return int.from_bytes(digest, 'big') < MAX_HASH // work
+
+
+def work_digits(work: int) -> int:
+    """Nearest difficulty in leading hex zeroes, for miners such as ProofOfWork that count digits."""
+    return max(1, round(math.log(work, 16)))
+
+
+class DifficultyRetarget:
+    """
+    Moving-window difficulty retargeting. The work (expected hashes) asked of the next block is
+    the work done over the last `window` blocks divided by the time they took, i.e. the
+    estimated network hash rate, times the target interval. It is recomputed for every block,
+    so block times follow hash power changes within about one window instead of swinging with
+    them. The arithmetic is in integers and milliseconds, so every node computes the same
+    difficulty from the same headers.
+    """
+
+    def __init__(self, target_interval: float = 10, window: int = 20, initial_work: int = DEFAULT_WORK,
+                 min_work: int = 16, max_adjustment: int = 4, median_span: int = 11, max_future: float = 120):
+        """
+        :param target_interval: Seconds wanted between blocks
+        :param window: Block intervals averaged over; the first window blocks use initial_work
+        :param initial_work: Work of the blocks before a full window exists
+        :param min_work: Lowest work ever asked for
+        :param max_adjustment: Largest factor between the work of a block and of its parent,
+            which bounds what a burst of skewed timestamps can do
+        :param median_span: A block's timestamp must exceed the median of this many ancestors
+        :param max_future: Seconds a block's timestamp may be ahead of our clock
+        """
+        self.target_interval = target_interval
+        self.window = window
+        self.initial_work = initial_work
+        self.min_work = min_work
+        self.max_adjustment = max_adjustment
+        self.median_span = median_span
+        self.max_future = max_future
+
+    @property
+    def history_length(self) -> int:
+        """Ancestors next_work and valid_timestamp look at."""
+        return max(self.window, self.median_span) + 1
+
+    def next_work(self, history: Sequence[Tuple[float, int]]) -> int:
+        """
+        Work required of the next block
+        :param history: (timestamp, cumulative work) of the last history_length blocks up to the
+            parent, oldest first; fewer near the genesis block
+        """
+        if len(history) <= self.window:
+            return self.initial_work
+        (first_time, first_work), (last_time, last_work) = history[-self.window - 1], history[-1]
+        previous = last_work - history[-2][1]
+        span = max(1, round((last_time - first_time) * 1000))
+        work = (last_work - first_work) * round(self.target_interval * 1000) // span
+        work = min(max(work, previous // self.max_adjustment), previous * self.max_adjustment)
+        return max(work, self.min_work)
+
+    def valid_timestamp(self, history: Sequence[Tuple[float, int]], timestamp: float, now: float = None) -> bool:
+        """
+        Check that a block's timestamp is past the median of its recent ancestors and not far
+        ahead of our clock, so a miner cannot stretch the time span of the window to lower the
+        difficulty, while clocks may still disagree by a little
+        :param history: As for next_work
+        :param now: Our clock; the future bound is not checked without it
+        """
+        if now is not None and timestamp > now + self.max_future:
+            return False
+        recent = sorted(time for time, _ in list(history)[-self.median_span:])
+        return not recent or timestamp > recent[len(recent) // 2]
+
+    def hash_rate(self, history: Sequence[Tuple[float, int]]) -> Optional[float]:
+        """Estimated network hashes per second over a history, None if it spans no time."""
+        if len(history) < 2 or history[-1][0] <= history[0][0]:
+            return None
+        return (history[-1][1] - history[0][1]) / (history[-1][0] - history[0][0])
+
+    def interval_histogram(self, timestamps: Sequence[float],
+                           bounds: Sequence[float] = (0.25, 0.5, 1, 2, 4)) -> List[dict]:
+        """
+        Count block intervals in buckets
+        :param timestamps: Block timestamps in chain order
+        :param bounds: Upper bucket bounds in multiples of the target interval; a last bucket
+            without a bound counts longer intervals
+        :return: List of {'le': upper bound in seconds or None, 'count': intervals}
+        """
+        limits = [bound * self.target_interval for bound in bounds]
+        counts = [0] * (len(limits) + 1)
+        for earlier, later in zip(timestamps, timestamps[1:]):
+            interval = later - earlier
+            counts[next((bucket for bucket, limit in enumerate(limits) if interval <= limit), len(limits))] += 1
+        return [{'le': limit, 'count': count} for limit, count in zip(limits + [None], counts)]
+
+
+# Example usage
+if __name__ == "__main__":
+    retarget = DifficultyRetarget(target_interval=10, window=5)
+    hash_rate = 4 * DEFAULT_WORK / 10  # Four times the hash power the initial difficulty was set for
+    history = [(0.0, DEFAULT_WORK)]
+    for height in range(2, 17):
+        work = retarget.next_work(history[-retarget.history_length:])
+        history.append((history[-1][0] + work / hash_rate, history[-1][1] + work))
+        print(f"Block {height}: work {work} ({work_digits(work)} hex zeroes), {work / hash_rate:.1f}s")
+    print(f"Estimated hash rate: {retarget.hash_rate(history[-6:]):.0f} H/s")
@@ -0,0 +1,366 @@
+import hashlib
+import struct
+from core.merkle import leaf_hash, merkle_root, merkle_proof
+
+# Canonical binary encoding for blocks and transactions. Every value is written with a
+# one-byte type tag, containers are length-prefixed and dict keys are sorted, so equal
+# values always produce identical bytes and the encoding can be hashed directly.
+
+FORMAT_VERSION = 2
+
+_pack_length = struct.Struct('>I').pack
+_unpack_length = struct.Struct('>I').unpack_from
+_pack_int = struct.Struct('>q').pack
+_unpack_int = struct.Struct('>q').unpack_from
+_pack_float = struct.Struct('>d').pack
+_unpack_float = struct.Struct('>d').unpack_from
+
+_INT_MIN, _INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def encode_value(value, out: bytearray):
+    """Append the canonical encoding of a JSON-compatible value to out."""
+    kind = type(value)
+    if kind is str:
+        data = value.encode()
+        out += b's'
+        out += _pack_length(len(data))
+        out += data
+    elif kind is int:
+        if _INT_MIN <= value <= _INT_MAX:
+            out += b'i'
+            out += _pack_int(value)
+        else:
+            data = value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+            out += b'I'
+            out += _pack_length(len(data))
+            out += data
+    elif kind is float:
+        out += b'f'
+        out += _pack_float(value)
+    elif value is None:
+        out += b'N'
+    elif kind is bool:
+        out += b'T' if value else b'F'
+    elif kind is list or kind is tuple:
+        out += b'l'
+        out += _pack_length(len(value))
+        for item in value:
+            encode_value(item, out)
+    elif kind is dict:
+        out += b'd'
+        out += _pack_length(len(value))
+        for key in sorted(value):
+            if type(key) is not str:
+                raise TypeError(f"Dictionary keys must be strings, got {key!r}")
+            encode_value(key, out)
+            encode_value(value[key], out)
+    else:
+        raise TypeError(f"Cannot encode value of type {kind.__name__}")
+
+
+def decode_value(data, pos: int = 0):
+    """
+    Decode one value written by encode_value
+    :return: (value, position after the value)
+    """
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b's':
+        (length,) = _unpack_length(data, pos)
+        pos += 4
+        return bytes(data[pos:pos + length]).decode(), pos + length
+    if tag == b'i':
+        return _unpack_int(data, pos)[0], pos + 8
+    if tag == b'f':
+        return _unpack_float(data, pos)[0], pos + 8
+    if tag == b'N':
+        return None, pos
+    if tag == b'T':
+        return True, pos
+    if tag == b'F':
+        return False, pos
+    if tag == b'I':
+        (length,) = _unpack_length(data, pos)
+        pos += 4
+        return int.from_bytes(data[pos:pos + length], 'big', signed=True), pos + length
+    if tag == b'l':
+        (count,) = _unpack_length(data, pos)
+        pos += 4
+        items = []
+        for _ in range(count):
+            item, pos = decode_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == b'd':
+        (count,) = _unpack_length(data, pos)
+        pos += 4
+        result = {}
+        for _ in range(count):
+            key, pos = decode_value(data, pos)
+            result[key], pos = decode_value(data, pos)
+        return result, pos
+    raise ValueError(f"Unknown type tag {tag!r} at position {pos - 1}")
+
+
+class Transaction:
+    """Compact transaction. Keys beyond sender/recipient/amount are kept in `extra`."""
+    __slots__ = ('sender', 'recipient', 'amount', 'extra', '_leaf')
+
+    FIELDS = ('sender', 'recipient', 'amount')
+
+    def __init__(self, sender, recipient, amount, extra=None):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.extra = extra or None
+        self._leaf = None
+
+    @classmethod
+    def from_dict(cls, transaction: dict) -> 'Transaction':
+        extra = {key: value for key, value in transaction.items() if key not in cls.FIELDS}
+        return cls(transaction['sender'], transaction['recipient'], transaction['amount'], extra)
+
+    def to_dict(self) -> dict:
+        transaction = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount,
+        }
+        if self.extra:
+            transaction.update(self.extra)
+        return transaction
+
+    def encode_into(self, out: bytearray):
+        encode_value(self.sender, out)
+        encode_value(self.recipient, out)
+        encode_value(self.amount, out)
+        encode_value(self.extra, out)
+
+    def encode(self) -> bytes:
+        out = bytearray()
+        self.encode_into(out)
+        return bytes(out)
+
+    @property
+    def leaf(self) -> bytes:
+        """Merkle leaf hash of the transaction."""
+        if self._leaf is None:
+            self._leaf = leaf_hash(self.encode())
+        return self._leaf
+
+    @property
+    def id(self) -> str:
+        """Transaction id: the hex-encoded Merkle leaf hash."""
+        return self.leaf.hex()
+
+    @classmethod
+    def decode_from(cls, data, pos: int = 0):
+        """:return: (Transaction, position after it)"""
+        sender, pos = decode_value(data, pos)
+        recipient, pos = decode_value(data, pos)
+        amount, pos = decode_value(data, pos)
+        extra, pos = decode_value(data, pos)
+        return cls(sender, recipient, amount, extra), pos
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        return isinstance(other, Transaction) and self.encode() == other.encode()
+
+    def __repr__(self):
+        return f"Transaction({self.to_dict()!r})"
+
+
+class Block:
+    """
+    Compact, immutable block. Its hash covers only the header (index, timestamp, proof,
+    previous_hash and the Merkle root of the transactions), is computed once and cached.
+    Transaction bodies may be absent (transactions is None) when only headers are known.
+    Supports read access by key (block['proof']) like the original block dicts.
+    """
+    __slots__ = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'merkle_root', '_hash')
+
+    FIELDS = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash', 'merkle_root')
+
+    def __init__(self, index, timestamp, transactions, proof, previous_hash, merkle_root=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.transactions = None if transactions is None else tuple(transactions)
+        self.proof = proof
+        self.previous_hash = previous_hash
+        self.merkle_root = merkle_root or self.compute_merkle_root()
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, block: dict) -> 'Block':
+        """
+        Build a Block from its dict form. 'merkle_root' is computed when missing and
+        'transactions' may be left out for header-only blocks, but not both.
+        """
+        unknown = set(block) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"Unexpected block fields: {sorted(unknown)}")
+        transactions = block.get('transactions')
+        if transactions is None and block.get('merkle_root') is None:
+            raise ValueError("A block needs its transactions or their merkle_root")
+        return cls(
+            block['index'],
+            block['timestamp'],
+            None if transactions is None else [Transaction.from_dict(transaction) for transaction in transactions],
+            block['proof'],
+            block['previous_hash'],
+            block.get('merkle_root'),
+        )
+
+    @classmethod
+    def coerce(cls, block) -> 'Block':
+        """Return block as a Block, converting it from the dict shape if needed."""
+        return block if isinstance(block, cls) else cls.from_dict(block)
+
+    def to_dict(self) -> dict:
+        block = self.header()
+        if self.transactions is not None:
+            block['transactions'] = [transaction.to_dict() for transaction in self.transactions]
+        return block
+
+    def header(self) -> dict:
+        """The block in dict form without its transactions."""
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'proof': self.proof,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+        }
+
+    def header_only(self) -> 'Block':
+        """A copy of the block without its transactions, with the same hash."""
+        block = Block(self.index, self.timestamp, None, self.proof, self.previous_hash, self.merkle_root)
+        block._hash = self._hash
+        return block
+
+    @property
+    def has_body(self) -> bool:
+        return self.transactions is not None
+
+    def compute_merkle_root(self) -> str:
+        """Merkle root of the transactions carried by the block."""
+        if self.transactions is None:
+            raise ValueError("Block has no transactions to compute a Merkle root from")
+        return merkle_root([transaction.leaf for transaction in self.transactions])
+
+    def valid_body(self) -> bool:
+        """Check that the transactions carried by the block match its Merkle root."""
+        return self.transactions is not None and self.compute_merkle_root() == self.merkle_root
+
+    def transaction_proof(self, position: int) -> list:
+        """Merkle inclusion proof for the transaction at the given position."""
+        if self.transactions is None:
+            raise ValueError("Block has no transactions to build a proof from")
+        return merkle_proof([transaction.leaf for transaction in self.transactions], position)
+
+    def encode_header(self) -> bytes:
+        out = bytearray((FORMAT_VERSION,))
+        encode_value(self.index, out)
+        encode_value(self.timestamp, out)
+        encode_value(self.proof, out)
+        encode_value(self.previous_hash, out)
+        encode_value(self.merkle_root, out)
+        return bytes(out)
+
+    def encode(self) -> bytes:
+        """Header followed by the transactions, if present."""
+        out = bytearray(self.encode_header())
+        if self.transactions is None:
+            out += b'H'
+        else:
+            out += b'B'
+            out += _pack_length(len(self.transactions))
+            for transaction in self.transactions:
+                transaction.encode_into(out)
+        return bytes(out)
+
+    @staticmethod
+    def decode_header(data):
+        """
+        Decode the header written by encode_header
+        :return: (index, timestamp, proof, previous_hash, merkle_root, position after the header)
+        """
+        if data[0] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported block format version {data[0]}")
+        index, pos = decode_value(data, 1)
+        timestamp, pos = decode_value(data, pos)
+        proof, pos = decode_value(data, pos)
+        previous_hash, pos = decode_value(data, pos)
+        root, pos = decode_value(data, pos)
+        return index, timestamp, proof, previous_hash, root, pos
+
+    @staticmethod
+    def decode_body(data, pos: int):
+        """Decode the transactions following a header at pos, or None for a header-only encoding."""
+        if data[pos:pos + 1] != b'B':
+            return None
+        (count,) = _unpack_length(data, pos + 1)
+        pos += 5
+        transactions = []
+        for _ in range(count):
+            transaction, pos = Transaction.decode_from(data, pos)
+            transactions.append(transaction)
+        return transactions
+
+    @classmethod
+    def decode(cls, data) -> 'Block':
+        index, timestamp, proof, previous_hash, root, pos = cls.decode_header(data)
+        return cls(index, timestamp, cls.decode_body(data, pos), proof, previous_hash, root)
+
+    @property
+    def hash(self) -> str:
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.encode_header()).hexdigest()
+        return self._hash
+
+    def __getitem__(self, key):
+        if key == 'transactions':
+            if self.transactions is None:
+                raise KeyError(key)
+            return [transaction.to_dict() for transaction in self.transactions]
+        if key in self.FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        return isinstance(other, Block) and self.hash == other.hash
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __repr__(self):
+        return f"Block(index={self.index}, hash={self.hash[:16]}...)"
+
+
+def encode_chain(blocks) -> bytes:
+    """Encode a sequence of blocks as length-prefixed canonical block encodings."""
+    out = bytearray()
+    for block in blocks:
+        data = Block.coerce(block).encode()
+        out += _pack_length(len(data))
+        out += data
+    return bytes(out)
+
+
+def decode_chain(data) -> list:
+    """Decode the output of encode_chain into a list of Blocks."""
+    blocks = []
+    pos = 0
+    while pos < len(data):
+        (length,) = _unpack_length(data, pos)
+        pos += 4
+        blocks.append(Block.decode(memoryview(data)[pos:pos + length]))
+        pos += length
+    return blocks
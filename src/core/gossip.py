@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List
+from core.encoding import Transaction
+from core.peers import PeerClient
+
+
+class PeerQueue:
+    """Outbound transactions for one peer, and the send statistics of that peer."""
+    __slots__ = ('transactions', 'in_flight', 'sent', 'failed', 'dropped', 'latencies')
+
+    def __init__(self, max_queue: int):
+        self.transactions = deque(maxlen=max_queue)  # Oldest transactions are dropped when full
+        self.in_flight = False
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=256)  # Seconds taken by recent batches
+
+
+class GossipEngine:
+    """
+    Background transaction gossip. Each published transaction is queued for up to `fanout`
+    randomly chosen peers and flushed once per time window as one POST /transactions/batch
+    per peer. Every peer has its own bounded queue and at most one request in flight, so a
+    slow peer only delays itself. A seen-cache of transaction ids keeps a transaction that
+    comes back from the network from being flooded again.
+    """
+
+    def __init__(self, nodes, peer_client: PeerClient = None, fanout: int = 8, window: float = 0.05,
+                 max_batch: int = 1000, max_queue: int = 10000, seen_size: int = 100000):
+        """
+        :param nodes: Set of peer addresses, read at every publish so newly registered peers are included
+        :param peer_client: PeerClient whose pooled session and workers send the batches
+        :param fanout: Number of peers each transaction is sent to; None for all of them
+        :param window: Seconds to collect transactions before a flush
+        :param max_batch: Maximum transactions per request
+        :param max_queue: Maximum transactions queued per peer; the oldest are dropped beyond it
+        :param seen_size: Number of transaction ids remembered by the seen-cache
+        """
+        self.nodes = nodes
+        self.peer_client = peer_client or PeerClient()
+        self.fanout = fanout
+        self.window = window
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.seen_size = seen_size
+        self.seen: OrderedDict = OrderedDict()  # Transaction id -> None, least recently seen first
+        self.queues: Dict[str, PeerQueue] = {}
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = None
+        self._driven_by_loop = False  # Set by run_async, which replaces the background thread
+
+    def mark_seen(self, transaction_id: str) -> bool:
+        """
+        Record a transaction id in the seen-cache
+        :return: True if it was not seen before
+        """
+        with self._condition:
+            if transaction_id in self.seen:
+                self.seen.move_to_end(transaction_id)
+                return False
+            self.seen[transaction_id] = None
+            if len(self.seen) > self.seen_size:
+                self.seen.popitem(last=False)
+            return True
+
+    def publish(self, transactions: Iterable[Transaction]) -> int:
+        """
+        Queue transactions for gossip, skipping those already seen
+        :return: Number of transactions queued
+        """
+        fresh = [transaction for transaction in transactions if self.mark_seen(transaction.id)]
+        nodes = list(self.nodes)
+        if not fresh or not nodes:
+            return 0
+
+        with self._condition:
+            for transaction in fresh:
+                targets = nodes if self.fanout is None or self.fanout >= len(nodes) \
+                    else random.sample(nodes, self.fanout)
+                data = transaction.to_dict()
+                for node in targets:
+                    queue = self.queues.get(node)
+                    if queue is None:
+                        queue = self.queues[node] = PeerQueue(self.max_queue)
+                    if len(queue.transactions) == self.max_queue:
+                        queue.dropped += 1
+                    queue.transactions.append(data)
+            if self._thread is None and not self._driven_by_loop:
+                self._thread = threading.Thread(target=self._run, name='gossip', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return len(fresh)
+
+    def _ready(self):
+        return [node for node, queue in self.queues.items() if queue.transactions and not queue.in_flight]
+
+    def flush(self):
+        """Start sending one batch to every peer that has queued transactions and no request in flight."""
+        with self._condition:
+            batches = []
+            for node in self._ready():
+                queue = self.queues[node]
+                count = min(len(queue.transactions), self.max_batch)
+                batches.append((node, [queue.transactions.popleft() for _ in range(count)]))
+                queue.in_flight = True
+        for node, batch in batches:
+            self.peer_client.executor.submit(self._send, node, batch)
+
+    def _send(self, node: str, batch: List[dict]):
+        start = time.perf_counter()
+        results = self.peer_client.post_transactions(node, batch)
+        with self._condition:
+            queue = self.queues[node]
+            queue.in_flight = False
+            queue.latencies.append(time.perf_counter() - start)
+            if results is None:
+                queue.failed += len(batch)
+                print(f"Error gossiping transactions to {node}: {self.peer_client.errors.get(node)}")
+            else:
+                queue.sent += len(batch)
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._ready():
+                    self._condition.wait()
+                if not self._running:
+                    return
+            time.sleep(self.window)  # Let more transactions join the batch
+            self.flush()
+
+    async def run_async(self):
+        """Flush once per window from an asyncio task, instead of from a background thread."""
+        self._driven_by_loop = True
+        while self._running:
+            await asyncio.sleep(self.window)
+            with self._condition:
+                ready = bool(self._ready())
+            if ready:
+                self.flush()
+
+    def queue_depth(self) -> int:
+        """Number of transactions waiting to be sent, over all peers."""
+        with self._condition:
+            return sum(len(queue.transactions) for queue in self.queues.values())
+
+    def metrics(self) -> dict:
+        """Queue depth, delivery counts and send latency of every peer."""
+        with self._condition:
+            peers = {}
+            for node, queue in self.queues.items():
+                latencies = sorted(queue.latencies)
+                peers[node] = {
+                    'queue_depth': len(queue.transactions),
+                    'in_flight': queue.in_flight,
+                    'sent': queue.sent,
+                    'failed': queue.failed,
+                    'dropped': queue.dropped,
+                    'latency_ms': {
+                        'last': queue.latencies[-1] * 1000 if latencies else None,
+                        'p50': latencies[len(latencies) // 2] * 1000 if latencies else None,
+                        'p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+                    },
+                }
+            return {
+                'queue_depth': sum(peer['queue_depth'] for peer in peers.values()),
+                'seen': len(self.seen),
+                'fanout': self.fanout,
+                'peers': peers,
+            }
+
+    def drain(self, timeout: float = 10):
+        """
+        Send everything queued and wait for the requests to finish
+        :return: True if every queue is empty, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.flush()
+            with self._condition:
+                if not any(queue.transactions or queue.in_flight for queue in self.queues.values()):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+    def close(self):
+        """Send what is queued and stop the background thread."""
+        self.drain()
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
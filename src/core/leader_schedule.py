@@ -0,0 +1,146 @@
+import hashlib
+import random
+from array import array
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+from core.stake_index import StakeIndex
+
+
+def epoch_seed(epoch: int, block_hashes) -> bytes:
+    """
+    Seed of an epoch's leader schedule: SHA-256 over the epoch number and the hashes of the
+    previous epoch's blocks, so every node with the same chain derives the same seed and no
+    one can know it before that epoch is complete
+    :param epoch: Number of the epoch being scheduled
+    :param block_hashes: Hex hashes of the previous epoch's blocks, in chain order
+    """
+    seed = hashlib.sha256(epoch.to_bytes(8, 'big'))
+    for block_hash in block_hashes:
+        seed.update(bytes.fromhex(block_hash))
+    return seed.digest()
+
+
+class LeaderSchedule:
+    """
+    The leader of every slot of an epoch, precomputed from a stake snapshot and the epoch seed.
+    Validators are numbered in address order and the schedule stores one small integer per
+    slot, so a schedule of n slots takes 2 or 4 bytes per slot and a lookup is O(1).
+    """
+    __slots__ = ('epoch', 'first_slot', 'seed', 'validators', 'leaders')
+
+    def __init__(self, epoch: int, first_slot: int, seed: bytes, validators: Tuple[Hashable, ...], leaders: array):
+        self.epoch = epoch
+        self.first_slot = first_slot
+        self.seed = seed
+        self.validators = validators  # Validator number -> address
+        self.leaders = leaders  # Slot - first_slot -> validator number
+
+    @classmethod
+    def compute(cls, epoch: int, slots: int, seed: bytes, stakes) -> 'LeaderSchedule':
+        """
+        Draw the leader of each slot with probability proportional to its stake
+        :param epoch: Number of the epoch; its first slot is epoch * slots
+        :param slots: Slots per epoch
+        :param seed: Seed from epoch_seed
+        :param stakes: Stake snapshot, a dict of addresses and stakes or a StakeIndex
+        :raises ValueError: If no validator has any stake
+        """
+        # Index the validators in address order, so the schedule does not depend on the order
+        # in which a node happened to learn about them
+        items = sorted((node, stake) for node, stake in stakes.items() if stake > 0)
+        if not items:
+            raise ValueError("No stake to schedule leaders from")
+        validators = tuple(node for node, _ in items)
+        numbers = {node: number for number, node in enumerate(validators)}
+        index = StakeIndex(dict(items))
+        rng = random.Random(int.from_bytes(seed, 'big'))
+        leaders = array('H' if len(validators) <= 0xFFFF else 'I',
+                        (numbers[node] for node in index.elect_many(slots, rng)))
+        return cls(epoch, epoch * slots, seed, validators, leaders)
+
+    def __len__(self) -> int:
+        return len(self.leaders)
+
+    def __contains__(self, slot: int) -> bool:
+        return self.first_slot <= slot < self.first_slot + len(self.leaders)
+
+    def leader(self, slot: int) -> Hashable:
+        """
+        :param slot: Slot number, counted from the first slot of epoch 0
+        :return: Address of the slot's leader
+        """
+        if slot not in self:
+            raise ValueError(f"Slot {slot} is not in epoch {self.epoch}")
+        return self.validators[self.leaders[slot - self.first_slot]]
+
+    def slots_of(self, node: Hashable) -> list:
+        """Slots led by a validator, e.g. to prepare its blocks ahead of time."""
+        try:
+            number = self.validators.index(node)
+        except ValueError:
+            return []
+        return [self.first_slot + offset for offset, leader in enumerate(self.leaders) if leader == number]
+
+
+class EpochScheduler:
+    """
+    Leader schedules of the epochs of a chain, where the block at height h fills slot h - 1.
+    The schedule of epoch e is seeded from the blocks of epoch e - 1 (epoch 0 from the
+    genesis block), so it is known to every node as soon as the previous epoch is complete.
+    Recent schedules are cached by epoch and seed; a reorganization that changes the previous
+    epoch changes the seed, and with it the schedule.
+    """
+
+    def __init__(self, slots_per_epoch: int = 32, cache_size: int = 4):
+        """
+        :param slots_per_epoch: Slots in an epoch
+        :param cache_size: Number of schedules kept
+        """
+        self.slots_per_epoch = slots_per_epoch
+        self.cache_size = cache_size
+        self.schedules: OrderedDict = OrderedDict()  # (epoch, seed) -> LeaderSchedule, least recently used first
+
+    def epoch_of(self, slot: int) -> int:
+        return slot // self.slots_per_epoch
+
+    def seed(self, chain, epoch: int) -> bytes:
+        """
+        :param chain: The chain, as a list of blocks
+        :raises ValueError: If the previous epoch is not complete in the chain
+        """
+        if epoch == 0:
+            return epoch_seed(0, [chain[0].hash])
+        start, end = (epoch - 1) * self.slots_per_epoch, epoch * self.slots_per_epoch
+        if len(chain) < end:
+            raise ValueError(f"Epoch {epoch - 1} is not complete: the chain has {len(chain)} of {end} blocks")
+        return epoch_seed(epoch, [block.hash for block in chain[start:end]])
+
+    def schedule(self, chain, stakes, epoch: int) -> LeaderSchedule:
+        """
+        Get the leader schedule of an epoch, computing it on first use
+        :param stakes: Stake snapshot the schedule is drawn from; all nodes must use the same one,
+            e.g. the stakes as of the end of the previous epoch. A cached schedule keeps the
+            stakes it was first computed from
+        """
+        seed = self.seed(chain, epoch)
+        key = (epoch, seed)
+        schedule = self.schedules.get(key)
+        if schedule is None:
+            schedule = self.schedules[key] = LeaderSchedule.compute(epoch, self.slots_per_epoch, seed, stakes)
+            while len(self.schedules) > self.cache_size:
+                self.schedules.popitem(last=False)
+        else:
+            self.schedules.move_to_end(key)
+        return schedule
+
+    def leader(self, chain, stakes, slot: int) -> Hashable:
+        """Leader of a slot, from its epoch's schedule."""
+        return self.schedule(chain, stakes, self.epoch_of(slot)).leader(slot)
+
+
+# Example usage
+if __name__ == "__main__":
+    stakes: Dict[str, float] = {'NodeA': 50, 'NodeB': 30, 'NodeC': 20}
+    schedule = LeaderSchedule.compute(1, 16, epoch_seed(1, [hashlib.sha256(b'block').hexdigest()]), stakes)
+    print(f"Epoch {schedule.epoch}: {[schedule.leader(slot) for slot in range(16, 32)]}")
+    print(f"Slots of NodeC: {schedule.slots_of('NodeC')}")
@@ -0,0 +1,255 @@
+import heapq
+import itertools
+from typing import Callable, Dict, List, Optional
+from core.account_state import transaction_cost, transaction_nonce
+from core.encoding import Transaction
+
+
+class MempoolEntry:
+    __slots__ = ('transaction', 'fee', 'size', 'fee_rate', 'sequence')
+
+    def __init__(self, transaction: Transaction, fee, size: int, sequence: int):
+        self.transaction = transaction
+        self.fee = fee
+        self.size = size
+        self.fee_rate = fee / size
+        self.sequence = sequence
+
+
+class Mempool:
+    """
+    Pool of pending transactions, bounded by count and encoded size.
+    Transactions are ranked by fee rate (fee per encoded byte). When the pool is full the
+    lowest-ranked transactions are evicted to make room for better ones, duplicates are
+    rejected by transaction id, and block selection takes the best transactions first, each
+    sender's in nonce order.
+    Both orderings are kept in heaps with lazy deletion, so every operation is O(log n).
+    """
+
+    def __init__(self, max_transactions: int = 50000, max_bytes: int = 32 * 2 ** 20):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.entries: Dict[str, MempoolEntry] = {}
+        self.total_bytes = 0
+        self.pending_costs: Dict[str, float] = {}  # Sender -> amount plus fees of its pooled transactions
+        self.pending_nonces: Dict[str, Dict[int, int]] = {}  # Sender -> nonce -> its pooled transactions with it
+        self._best_first = []  # (-fee_rate, sequence, id): highest fee rate, then oldest
+        self._worst_first = []  # (fee_rate, -sequence, id): lowest fee rate, then newest
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self.entries
+
+    @staticmethod
+    def fee_of(transaction: Transaction):
+        fee = transaction.extra.get('fee', 0) if transaction.extra else 0
+        if isinstance(fee, bool) or not isinstance(fee, (int, float)) or fee < 0:
+            raise ValueError("Transaction fee must be a non-negative number")
+        return fee
+
+    def add(self, transaction: Transaction) -> str:
+        """
+        Add a transaction, evicting lower fee-rate transactions if the pool is full
+        :param transaction: The transaction
+        :return: The transaction id
+        :raises ValueError: If the transaction is a duplicate or does not pay enough to enter a full pool
+        """
+        transaction_id = transaction.id
+        if transaction_id in self.entries:
+            raise ValueError(f"Duplicate transaction {transaction_id}")
+
+        transaction_cost(transaction)  # Rejects non-numeric or negative amounts and fees
+        size = len(transaction.encode())
+        if size > self.max_bytes:
+            raise ValueError("Transaction is larger than the mempool")
+        entry = MempoolEntry(transaction, self.fee_of(transaction), size, next(self._sequence))
+
+        evicted, evicted_bytes = [], 0
+        while (len(self.entries) - len(evicted) >= self.max_transactions
+               or self.total_bytes - evicted_bytes + size > self.max_bytes):
+            worst = self._pop_worst()
+            evicted.append(worst)
+            evicted_bytes += worst.size
+            if worst.fee_rate >= entry.fee_rate:
+                # Not worth more than what it would displace; keep the pool as it was
+                for kept in evicted:
+                    heapq.heappush(self._worst_first, (kept.fee_rate, -kept.sequence, kept.transaction.id))
+                raise ValueError("Mempool is full and the transaction fee is too low")
+
+        for worst in evicted:
+            self._discard(worst.transaction.id)
+        self.entries[transaction_id] = entry
+        self.total_bytes += size
+        self._add_pending(transaction, transaction_cost(transaction), 1)
+        heapq.heappush(self._best_first, (-entry.fee_rate, entry.sequence, transaction_id))
+        heapq.heappush(self._worst_first, (entry.fee_rate, -entry.sequence, transaction_id))
+        return transaction_id
+
+    def add_many(self, transactions: List[Transaction]) -> List:
+        """
+        Add a batch of transactions. While the whole batch fits in the pool the heaps are
+        extended once and re-heapified, instead of sifting in every transaction.
+        :param transactions: The transactions
+        :return: Per transaction, its id or the ValueError that rejected it
+        """
+        sizes = []
+        for transaction in transactions:
+            try:
+                sizes.append(len(transaction.encode()))
+            except TypeError as e:
+                sizes.append(ValueError(str(e)))
+        batch_bytes = sum(size for size in sizes if not isinstance(size, ValueError))
+        if (len(self.entries) + len(transactions) > self.max_transactions
+                or self.total_bytes + batch_bytes > self.max_bytes):
+            return [self._try_add(transaction) for transaction in transactions]
+
+        results, best, worst = [], [], []
+        for transaction, size in zip(transactions, sizes):
+            try:
+                if isinstance(size, ValueError):
+                    raise size
+                transaction_id = transaction.id
+                if transaction_id in self.entries:
+                    raise ValueError(f"Duplicate transaction {transaction_id}")
+                cost = transaction_cost(transaction)
+                entry = MempoolEntry(transaction, self.fee_of(transaction), size, next(self._sequence))
+            except ValueError as e:
+                results.append(e)
+                continue
+            self.entries[transaction_id] = entry
+            self.total_bytes += size
+            self._add_pending(transaction, cost, 1)
+            best.append((-entry.fee_rate, entry.sequence, transaction_id))
+            worst.append((entry.fee_rate, -entry.sequence, transaction_id))
+            results.append(transaction_id)
+
+        for heap, items in ((self._best_first, best), (self._worst_first, worst)):
+            if len(items) > len(heap) // 8:
+                heap.extend(items)
+                heapq.heapify(heap)
+            else:
+                for item in items:
+                    heapq.heappush(heap, item)
+        return results
+
+    def _try_add(self, transaction):
+        try:
+            return self.add(transaction)
+        except ValueError as e:
+            return e
+        except TypeError as e:
+            return ValueError(str(e))
+
+    def _pop_worst(self) -> MempoolEntry:
+        while True:
+            _, _, transaction_id = heapq.heappop(self._worst_first)
+            entry = self.entries.get(transaction_id)
+            if entry is not None:
+                return entry
+
+    def _discard(self, transaction_id: str) -> Optional[MempoolEntry]:
+        entry = self.entries.pop(transaction_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+            self._add_pending(entry.transaction, -transaction_cost(entry.transaction), -1)
+            self._compact()
+        return entry
+
+    def _add_pending(self, transaction: Transaction, cost: float, count: int):
+        sender = transaction.sender
+        pending = self.pending_costs.get(sender, 0) + cost
+        if pending:
+            self.pending_costs[sender] = pending
+        else:
+            self.pending_costs.pop(sender, None)
+        nonce = transaction_nonce(transaction)
+        if type(nonce) is int:
+            nonces = self.pending_nonces.setdefault(sender, {})
+            count += nonces.get(nonce, 0)
+            if count:
+                nonces[nonce] = count
+            else:
+                del nonces[nonce]
+                if not nonces:
+                    del self.pending_nonces[sender]
+
+    def pending_cost(self, sender: str) -> float:
+        """Amount plus fees of the transactions a sender has waiting in the pool."""
+        return self.pending_costs.get(sender, 0)
+
+    def next_nonce(self, sender: str) -> Optional[int]:
+        """Nonce following the highest of a sender's pooled transactions, None if it has none."""
+        nonces = self.pending_nonces.get(sender)
+        return max(nonces) + 1 if nonces else None
+
+    def _compact(self):
+        """Rebuild the heaps once removed entries make up most of them."""
+        if len(self._best_first) > 2 * len(self.entries) + 64:
+            self._best_first = [item for item in self._best_first if item[2] in self.entries]
+            heapq.heapify(self._best_first)
+        if len(self._worst_first) > 2 * len(self.entries) + 64:
+            self._worst_first = [item for item in self._worst_first if item[2] in self.entries]
+            heapq.heapify(self._worst_first)
+
+    def remove(self, transaction_ids) -> int:
+        """
+        Drop transactions, e.g. because they were included in a block from a peer
+        :return: Number of transactions removed
+        """
+        return sum(self._discard(transaction_id) is not None for transaction_id in transaction_ids)
+
+    def select(self, max_bytes: int, max_transactions: int = None, max_skipped: int = 64,
+               next_nonce: Callable[[str], int] = None) -> List[Transaction]:
+        """
+        Remove and return the highest fee-rate transactions that fit in a block. A transaction
+        waits until its sender's transaction with the previous nonce is taken, so a block never
+        skips a nonce; the ones still waiting stay pooled.
+        :param max_bytes: Block size limit, in encoded transaction bytes
+        :param max_transactions: Optional limit on the number of transactions
+        :param max_skipped: Give up after this many transactions too large for the remaining space
+        :param next_nonce: Gives a sender's next confirmed nonce, e.g. AccountState.get_nonce; by
+            default a sender's lowest pooled nonce is taken to be its next one
+        :return: Transactions, best first
+        """
+        selected, skipped = [], []
+        expected: Dict[str, int] = {}  # Sender -> nonce of its next transaction that may be taken
+        waiting: Dict[tuple, list] = {}  # (sender, nonce) -> heap items waiting for the previous nonce
+        remaining = max_bytes
+        while self._best_first and len(skipped) <= max_skipped:
+            if max_transactions is not None and len(selected) >= max_transactions:
+                break
+            item = heapq.heappop(self._best_first)
+            entry = self.entries.get(item[2])
+            if entry is None:
+                continue
+            sender, nonce = entry.transaction.sender, transaction_nonce(entry.transaction)
+            if type(nonce) is int:
+                if sender not in expected:
+                    expected[sender] = min(self.pending_nonces[sender]) if next_nonce is None else next_nonce(sender)
+                if nonce > expected[sender]:
+                    waiting.setdefault((sender, nonce), []).append(item)
+                    continue
+            if entry.size > remaining:
+                skipped.append(item)
+                continue
+            remaining -= entry.size
+            selected.append(entry.transaction)
+            self._discard(item[2])
+            if type(nonce) is int:
+                expected[sender] = max(expected[sender], nonce + 1)
+                for following in waiting.pop((sender, nonce + 1), ()):
+                    heapq.heappush(self._best_first, following)
+
+        for item in skipped:
+            heapq.heappush(self._best_first, item)
+        for items in waiting.values():
+            for item in items:
+                heapq.heappush(self._best_first, item)
+        return selected
+
+    def transactions(self) -> List[Transaction]:
+        """Pending transactions in arrival order."""
+        return [entry.transaction for entry in self.entries.values()]
@@ -0,0 +1,85 @@
+import hashlib
+from typing import List, Tuple
+
+# Leaves and interior nodes are hashed with different prefixes so that an interior node
+# can never be passed off as a transaction. An odd node at the end of a level is carried
+# up unchanged rather than paired with itself, so two different transaction lists can
+# never share a root.
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def leaf_hash(data: bytes) -> bytes:
+    """Hash an encoded transaction into a Merkle leaf."""
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    """Hash two child nodes into their parent."""
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _next_level(level: List[bytes]) -> List[bytes]:
+    parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves: List[bytes]) -> str:
+    """
+    Compute the Merkle root of a list of leaf hashes
+    :param leaves: Leaf hashes, as returned by leaf_hash
+    :return: Hex-encoded root
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+
+def merkle_proof(leaves: List[bytes], position: int) -> List[Tuple[str, str]]:
+    """
+    Build an inclusion proof for one leaf
+    :param leaves: Leaf hashes of the block
+    :param position: Position of the leaf to prove
+    :return: List of (side, sibling hash) pairs from the leaf up to the root, side being 'L' or 'R'
+    """
+    if not 0 <= position < len(leaves):
+        raise IndexError(f"No leaf at position {position}")
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append(('L' if sibling < position else 'R', level[sibling].hex()))
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf: bytes, proof: List[Tuple[str, str]], root: str) -> bool:
+    """
+    Check that a leaf is included under a Merkle root
+    :param leaf: Leaf hash
+    :param proof: Proof from merkle_proof
+    :param root: Hex-encoded Merkle root
+    :return: True if the proof is valid, False if not
+    """
+    current = leaf
+    try:
+        for side, sibling in proof:
+            sibling = bytes.fromhex(sibling)
+            if side == 'L':
+                current = node_hash(sibling, current)
+            elif side == 'R':
+                current = node_hash(current, sibling)
+            else:
+                return False
+    except (TypeError, ValueError):
+        return False
+    return current.hex() == root
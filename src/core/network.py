@@ -1,23 +1,251 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-import requests
 import json
 from threading import Thread
 import time
+import zlib
+from core.account_state import MINT_ADDRESS
+from core.admission import Overloaded, RateLimiter, WorkQueue
+from core.encoding import encode_chain
+from core.gossip import GossipEngine
+from core.peers import BINARY_CHAIN_MIMETYPE, BLOCK_EVENTS_MIMETYPE, CHAIN_LENGTH_HEADER, NEXT_CURSOR_HEADER
+from core.sync import BlockSubscriber, HeaderSync
+
+STREAM_CHUNK_BLOCKS = 64  # Blocks serialized per chunk of a streamed response
+EVENT_KEEPALIVE = 5  # Seconds between keep-alive comments on an idle /blocks/events stream
+MAX_TIP_WAIT = 60  # Longest long-poll on /chain/tip, in seconds
+MAX_STATS_WINDOW = 10000  # Most block intervals /mining/stats looks at
+
+
+class StaleCursor(ValueError):
+    """A pagination cursor points at a block that is no longer in the chain."""
+
+
+def stream_json_blocks(key, blocks, to_dict, fields):
+    """
+    Serialize {key: [blocks...], **fields} as JSON in chunks, so a response never holds
+    more than STREAM_CHUNK_BLOCKS serialized blocks at once
+    """
+    yield f'{{"{key}": ['
+    for i in range(0, len(blocks), STREAM_CHUNK_BLOCKS):
+        chunk = ', '.join(json.dumps(to_dict(block)) for block in blocks[i:i + STREAM_CHUNK_BLOCKS])
+        yield f', {chunk}' if i else chunk
+    yield ']'
+    for name, value in fields.items():
+        yield f', "{name}": {json.dumps(value)}'
+    yield '}'
+
+
+def stream_binary_blocks(blocks, convert):
+    """Encode blocks with encode_chain, in chunks."""
+    for i in range(0, len(blocks), STREAM_CHUNK_BLOCKS):
+        yield encode_chain(convert(block) for block in blocks[i:i + STREAM_CHUNK_BLOCKS])
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress a stream of str or bytes chunks into a gzip stream."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def make_cursor(chain, height):
+    """A cursor names the last block of a page by height and hash, so a reorganization invalidates it."""
+    return f'{height}:{chain[height - 1].hash if height else ""}'
+
+
+def resolve_cursor(blockchain, cursor):
+    """
+    :return: Height the page after the cursor starts from
+    :raises ValueError: If the cursor is malformed
+    :raises StaleCursor: If the block the cursor points at is no longer in the chain
+    """
+    height, _, block_hash = cursor.partition(':')
+    try:
+        height = int(height)
+    except ValueError:
+        raise ValueError('Malformed cursor')
+    if height < 0:
+        raise ValueError('Malformed cursor')
+    if height and blockchain.get_block_hash(height) != block_hash:
+        raise StaleCursor('The chain was reorganized past the cursor')
+    return height
+
+
+def select_block_range(blockchain, args, max_blocks=None):
+    """
+    Select the blocks named by the range query parameters of /chain and /headers: either
+    start (number of blocks to skip) or cursor (next_cursor of the previous page), and limit
+    :param args: Mapping of query parameters
+    :param max_blocks: Cap on the number of blocks, if any
+    :return: (blocks, chain length, tip hash, next cursor or None at the tip)
+    :raises ValueError: If the parameters are malformed
+    :raises StaleCursor: If the block the cursor points at is no longer in our chain
+    """
+    try:
+        start = int(args.get('start', 0))
+        limit = args.get('limit')
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        raise ValueError('start and limit must be integers')
+    cursor = args.get('cursor')
+    if cursor is not None:
+        start = resolve_cursor(blockchain, cursor)
+    if start < 0 or limit is not None and limit < 0:
+        raise ValueError('start and limit must not be negative')
+    if max_blocks is not None:
+        limit = max_blocks if limit is None else min(limit, max_blocks)
+
+    chain = blockchain.chain  # Appends do not move blocks, and replacements swap in a new list
+    length = len(chain)
+    blocks = chain[start:length if limit is None else min(length, start + limit)]
+    end = start + len(blocks)
+    next_cursor = make_cursor(chain, end) if end < length else None
+    return blocks, length, chain[length - 1].hash, next_cursor
+
+
+def block_event(length, tip_hash):
+    """Server-sent event announcing a new tip by height and hash; the height is the event id."""
+    return f'id: {length}\nevent: block\ndata: {json.dumps({"height": length, "hash": tip_hash})}\n\n'
+
+
+def stream_block_events(tip_feed, keepalive=EVENT_KEEPALIVE):
+    """
+    Server-sent events for the current tip and every new one, with a keep-alive comment
+    whenever the chain is idle for keepalive seconds
+    """
+    yield f'retry: {keepalive * 1000}\n\n'
+    known = None
+    while True:
+        length, tip_hash = tip_feed.wait(known, keepalive)
+        if tip_hash == known:
+            yield ': keep-alive\n\n'
+        else:
+            known = tip_hash
+            yield block_event(length, tip_hash)
+
+
+def tip_wait_args(args):
+    """
+    Read the long-poll query parameters of /chain/tip: known (the tip hash the client has)
+    and wait (seconds to wait for a different tip, at most MAX_TIP_WAIT)
+    :return: (known hash or None, seconds to wait)
+    :raises ValueError: If wait is not a number
+    """
+    try:
+        wait = float(args.get('wait', 0))
+    except ValueError:
+        raise ValueError('wait must be a number')
+    return args.get('known'), min(max(wait, 0), MAX_TIP_WAIT)
+
+
+def address_history_args(args):
+    """
+    Read the query parameters of /accounts/<address>/transactions: cursor (from the previous
+    page), limit (1-500, default 50) and order ('desc' or 'asc')
+    :return: (cursor or None, limit, newest first)
+    :raises ValueError: If cursor or limit is not an integer
+    """
+    try:
+        cursor = args.get('cursor')
+        cursor = None if cursor is None else int(cursor)
+        limit = min(max(int(args.get('limit', 50)), 1), 500)
+    except ValueError:
+        raise ValueError('cursor and limit must be integers')
+    return cursor, limit, args.get('order', 'desc') != 'asc'
+
+
+def mining_stats_args(args):
+    """
+    Read the query parameter of /mining/stats: window (block intervals looked at, 1 to MAX_STATS_WINDOW, default 100)
+    :raises ValueError: If window is not an integer
+    """
+    try:
+        window = int(args.get('window', 100))
+    except ValueError:
+        raise ValueError('window must be an integer')
+    return min(max(window, 1), MAX_STATS_WINDOW)
+
+
+def latest_snapshot(blockchain):
+    """:return: Bytes of the blockchain's newest state snapshot file, or None if there is none"""
+    if blockchain.snapshots is None:
+        return None
+    heights = blockchain.snapshots.heights()
+    return blockchain.snapshots.read(heights[-1]) if heights else None
+
+
+def submit_transactions(blockchain, items):
+    """
+    Validate and pool a batch of transactions in API form
+    :param items: List of transaction dicts with sender, recipient, amount and optional fee and nonce
+    :return: (one result dict per item, accepted Transactions)
+    """
+    required = ['sender', 'recipient', 'amount']
+    results = [None] * len(items)
+    batch, positions = [], []
+    for position, values in enumerate(items):
+        if not isinstance(values, dict) or not all(k in values for k in required):
+            results[position] = {'status': 'rejected', 'message': 'Missing values'}
+        elif values['sender'] == MINT_ADDRESS:
+            results[position] = {'status': 'rejected', 'message': 'Sender address is reserved'}
+        else:
+            batch.append((values['sender'], values['recipient'], values['amount'], values.get('fee', 0),
+                          values.get('nonce')))
+            positions.append(position)
+
+    index = blockchain.last_block['index'] + 1
+    accepted = []
+    for position, result in zip(positions, blockchain.add_transactions(batch)):
+        if isinstance(result, ValueError):
+            results[position] = {'status': 'rejected', 'message': str(result)}
+        else:
+            results[position] = {'status': 'accepted', 'id': result.id, 'block_index': index}
+            accepted.append(result)
+    return results, accepted
+
 
 class Network:
-    def __init__(self, blockchain):
+    def __init__(self, blockchain, rate_limits=None):
+        """
+        :param blockchain: Blockchain to serve
+        :param rate_limits: Route -> (requests per second, burst) per client, DEFAULT_RATE_LIMITS
+            if not given; {} disables rate limiting
+        """
         self.blockchain = blockchain
         self.app = Flask(__name__)
         CORS(self.app)  # Enable CORS for all routes
         self.port = 5000  # Default port for the node
         self.nodes = set()
+        self.header_sync = HeaderSync(blockchain)
+        self.block_subscriber = BlockSubscriber(self.header_sync)
+        self._gossip = None
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.work_queue = WorkQueue()  # Runs expensive operations such as resolves, rejecting when full
+        self.app.before_request(self.admit)
 
         # Define routes
         self.app.add_url_rule('/chain', 'get_chain', self.get_chain, methods=['GET'])
+        self.app.add_url_rule('/chain/tip', 'get_tip', self.get_tip, methods=['GET'])
+        self.app.add_url_rule('/blocks/<int:height>/hash', 'get_block_hash', self.get_block_hash, methods=['GET'])
+        self.app.add_url_rule('/headers', 'get_headers', self.get_headers, methods=['GET'])
+        self.app.add_url_rule('/blocks', 'new_block', self.new_block, methods=['POST'])
+        self.app.add_url_rule('/blocks/events', 'get_block_events', self.get_block_events, methods=['GET'])
+        self.app.add_url_rule('/snapshot', 'get_snapshot', self.get_snapshot, methods=['GET'])
         self.app.add_url_rule('/transactions/new', 'new_transaction', self.new_transaction, methods=['POST'])
+        self.app.add_url_rule('/transactions/batch', 'new_transactions', self.new_transactions, methods=['POST'])
         self.app.add_url_rule('/nodes/register', 'register_nodes', self.register_nodes, methods=['POST'])
         self.app.add_url_rule('/nodes/resolve', 'resolve_conflicts', self.resolve_conflicts, methods=['GET'])
+        self.app.add_url_rule('/accounts/<address>', 'get_account', self.get_account, methods=['GET'])
+        self.app.add_url_rule('/accounts/<address>/transactions', 'get_address_history',
+                              self.get_address_history, methods=['GET'])
+        self.app.add_url_rule('/gossip/metrics', 'get_gossip_metrics', self.get_gossip_metrics, methods=['GET'])
+        self.app.add_url_rule('/mining/stats', 'get_mining_stats', self.get_mining_stats, methods=['GET'])
+        self.app.add_url_rule('/transactions/<transaction_id>', 'get_transaction', self.get_transaction,
+                              methods=['GET'])
 
     def start(self):
         """
@@ -25,20 +253,140 @@ class Network:
         """
         self.app.run(host='0.0.0.0', port=self.port)
 
+    def admit(self):
+        """
+        Rate-limit every request by client address and route before it is handled
+        :return: 429 response with Retry-After if the client is over its limit, None to proceed
+        """
+        if request.endpoint is None:
+            return None  # Not found: nothing to protect
+        delay = self.rate_limiter.check(request.remote_addr, request.endpoint)
+        if delay:
+            return jsonify({'message': 'Too many requests'}), 429, {'Retry-After': RateLimiter.retry_after(delay)}
+        return None
+
+    def _blocks_response(self, key, blocks, to_dict, convert, length, tip_hash, next_cursor):
+        """
+        Stream a range of blocks as JSON or, with ?format=binary, in the compact binary encoding.
+        The body is produced in chunks from a generator and gzip-compressed when the client
+        accepts it. The ETag is the tip hash, so an unchanged chain is answered with 304.
+        """
+        etag = tip_hash
+        headers = {CHAIN_LENGTH_HEADER: str(length), 'Vary': 'Accept-Encoding'}
+        if next_cursor is not None:
+            headers[NEXT_CURSOR_HEADER] = next_cursor
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag, weak=True)
+            return response
+
+        if request.args.get('format') == 'binary':
+            mimetype = BINARY_CHAIN_MIMETYPE
+            chunks = stream_binary_blocks(blocks, convert)
+        else:
+            mimetype = 'application/json'
+            chunks = stream_json_blocks(key, blocks, to_dict, {'length': length, 'next_cursor': next_cursor})
+        if 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        response = Response(chunks, mimetype=mimetype, headers=headers)
+        response.set_etag(etag, weak=True)
+        return response
+
+    def _serve_range(self, key, to_dict, convert, max_blocks=None):
+        try:
+            blocks, length, tip_hash, next_cursor = select_block_range(self.blockchain, request.args, max_blocks)
+        except StaleCursor as e:
+            return jsonify({'message': str(e)}), 409
+        except ValueError as e:
+            return f'Error: {e}', 400
+        return self._blocks_response(key, blocks, to_dict, convert, length, tip_hash, next_cursor)
+
     def get_chain(self):
         """
-        Get the full blockchain
-        :return: JSON representation of the blockchain
+        Get the blockchain, streamed in chunks
+        Query parameters: start (number of blocks to skip) or cursor (next_cursor of the previous
+        page), and limit, to page through the chain; format=binary for the compact encoding
+        :return: JSON with the blocks, chain length and next cursor, or the binary encoding with the
+            cursor in the X-Next-Cursor header; 304 if the ETag (keyed on the tip hash) still matches
         """
-        response = {
-            'chain': self.blockchain.get_chain(),
-            'length': len(self.blockchain.chain),
-        }
-        return jsonify(response), 200
+        return self._serve_range('chain', lambda block: block.to_dict(), lambda block: block)
+
+    def get_tip(self):
+        """
+        Get the length of the chain, the hash of its last block and its cumulative work
+        Query parameters for a long-poll: known (the tip hash the client has) and wait (seconds,
+        at most 60) to answer only once the tip differs from known, or when the wait is over
+        :return: JSON response with the tip
+        """
+        try:
+            known, wait = tip_wait_args(request.args)
+        except ValueError as e:
+            return f'Error: {e}', 400
+        if known is not None and wait:
+            self.blockchain.tip_feed.wait(known, wait)
+        length, tip_hash, work = self.blockchain.get_tip_work()
+        return jsonify({'length': length, 'hash': tip_hash, 'work': work}), 200
+
+    def get_block_events(self):
+        """
+        Subscribe to new blocks: a server-sent event stream announcing the height and hash of
+        the current tip and of every new one as soon as it is added
+        :return: text/event-stream response that stays open
+        """
+        return Response(stream_block_events(self.blockchain.tip_feed), mimetype=BLOCK_EVENTS_MIMETYPE,
+                        headers={'Cache-Control': 'no-cache'})
+
+    def get_block_hash(self, height):
+        """
+        Get the hash of the block at a height, counting the genesis block as height 1
+        :return: JSON response with the hash
+        """
+        block_hash = self.blockchain.get_block_hash(height)
+        if block_hash is None:
+            return jsonify({'message': 'No block at that height'}), 404
+        return jsonify({'height': height, 'hash': block_hash}), 200
+
+    def get_headers(self, max_headers=2000):
+        """
+        Get block headers without transactions
+        Query parameters: the same as /chain, with at most 2000 headers per page
+        :return: JSON list of headers, or the compact binary encoding with ?format=binary
+        """
+        return self._serve_range('headers', lambda block: block.header(),
+                                 lambda block: block.header_only(), max_headers)
+
+    def get_snapshot(self):
+        """
+        Get our newest state snapshot, for a new node to start from instead of replaying the
+        chain from genesis; the node checks its checksum and that it is at a checkpoint
+        :return: The snapshot file, or 404 if we do not write snapshots or have none yet
+        """
+        data = latest_snapshot(self.blockchain)
+        if data is None:
+            return jsonify({'message': 'No state snapshot'}), 404
+        return Response(data, mimetype=BINARY_CHAIN_MIMETYPE)
+
+    def new_block(self):
+        """
+        Add a block mined by a peer, which may extend our chain, go to a side branch or wait
+        for its parent in the orphan pool
+        Body: the block as a JSON dict, like the blocks of /chain
+        :return: JSON response with what happened to the block and our tip after it
+        """
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            return 'Error: Please supply a block', 400
+        try:
+            status = self.blockchain.add_block(values)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        length, tip_hash = self.blockchain.get_tip()
+        return jsonify({'status': status, 'length': length, 'hash': tip_hash}), 200
 
     def new_transaction(self):
         """
-        Create a new transaction
+        Create a new transaction and gossip it to our peers
         :return: JSON response with the index of the block that will hold the transaction
         """
         values = request.get_json()
@@ -46,11 +394,81 @@ class Network:
 
         if not all(k in values for k in required):
             return 'Missing values', 400
+        if values['sender'] == MINT_ADDRESS:
+            return 'Sender address is reserved', 400
 
-        index = self.blockchain.new_transaction(values['sender'], values['recipient'], values['amount'])
+        try:
+            transaction = self.blockchain.add_transaction(values['sender'], values['recipient'], values['amount'],
+                                                          values.get('fee', 0), values.get('nonce'))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        index = self.blockchain.last_block['index'] + 1
+        self.broadcast_transaction(transaction)
         response = {'message': f'Transaction will be added to Block {index}'}
         return jsonify(response), 201
 
+    def new_transactions(self, max_batch=10000):
+        """
+        Create a batch of transactions and gossip the accepted ones to our peers
+        Body: a JSON list of transactions, or {"transactions": [...]}, of at most 10000 items
+        :return: JSON response with one result per transaction, in order: accepted with its id
+            and the block that will hold it, or rejected with the reason
+        """
+        values = request.get_json(silent=True)
+        items = values.get('transactions') if isinstance(values, dict) else values
+        if not isinstance(items, list):
+            return 'Error: Please supply a list of transactions', 400
+        if len(items) > max_batch:
+            return f'Error: At most {max_batch} transactions per batch', 413
+
+        results, accepted = submit_transactions(self.blockchain, items)
+        self.gossip.publish(accepted)
+        response = {
+            'results': results,
+            'accepted': sum(result['status'] == 'accepted' for result in results),
+        }
+        return jsonify(response), 200
+
+    def get_account(self, address):
+        """
+        Get the balance and nonce of an address
+        :return: JSON response with the account state
+        """
+        response = {
+            'address': address,
+            'balance': self.blockchain.get_balance(address),
+            'nonce': self.blockchain.get_nonce(address),
+        }
+        return jsonify(response), 200
+
+    def get_address_history(self, address):
+        """
+        Page through the transactions of an address
+        Query parameters: cursor (from the previous page), limit (1-500, default 50), order ('desc' or 'asc')
+        :return: JSON response with the page of transactions and the next cursor
+        """
+        try:
+            cursor, limit, newest_first = address_history_args(request.args)
+        except ValueError as e:
+            return f'Error: {e}', 400
+        transactions, next_cursor = self.blockchain.get_address_history(address, cursor, limit, newest_first)
+        response = {
+            'address': address,
+            'transactions': transactions,
+            'next_cursor': next_cursor,
+        }
+        return jsonify(response), 200
+
+    def get_transaction(self, transaction_id):
+        """
+        Find where a transaction landed in the chain
+        :return: JSON response with the block index, position and transaction
+        """
+        found = self.blockchain.find_transaction(transaction_id)
+        if found is None:
+            return jsonify({'message': 'Transaction not found'}), 404
+        return jsonify(found), 200
+
     def register_nodes(self):
         """
         Register new nodes in the network
@@ -73,49 +491,75 @@ class Network:
 
     def resolve_conflicts(self):
         """
-        Consensus Algorithm: resolves conflicts by replacing our chain with the longest one in the network
-        :return: JSON response indicating whether the chain was replaced
+        Consensus Algorithm: resolves conflicts by replacing our chain with the longest one in the network.
+        Concurrent requests share a single run, which goes through the work queue.
+        :return: JSON response indicating whether the chain was replaced, with the new tip; the
+            chain itself is left to /chain so that a resolve does not echo every block.
+            429 if the work queue is full.
         """
-        replaced = self.blockchain.resolve_conflicts()
-        if replaced:
-            response = {
-                'message': 'Our chain was replaced',
-                'new_chain': self.blockchain.chain,
-            }
-        else:
-            response = {
-                'message': 'Our chain is authoritative',
-                'chain': self.blockchain.chain,
-            }
+        try:
+            replaced = self.work_queue.submit(self.blockchain.resolve_conflicts, key='resolve').result()
+        except Overloaded as e:
+            return jsonify({'message': str(e)}), 429, {'Retry-After': '1'}
+        length, tip_hash = self.blockchain.get_tip()
+        response = {
+            'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+            'replaced': replaced,
+            'length': length,
+            'hash': tip_hash,
+        }
         return jsonify(response), 200
 
+    @property
+    def gossip(self):
+        """GossipEngine to the registered nodes, created on first use."""
+        if self._gossip is None:
+            self._gossip = GossipEngine(self.blockchain.nodes, self.header_sync.client)
+        return self._gossip
+
+    def get_gossip_metrics(self):
+        """
+        Get the gossip queue depths, delivery counts and send latencies per peer
+        :return: JSON response with the metrics
+        """
+        return jsonify(self.gossip.metrics()), 200
+
+    def get_mining_stats(self):
+        """
+        Get the current difficulty, the estimated network hash rate and a histogram of recent block
+        intervals, for capacity planning
+        Query parameters: window (block intervals looked at, default 100)
+        :return: JSON response with the statistics
+        """
+        try:
+            window = mining_stats_args(request.args)
+        except ValueError as e:
+            return f'Error: {e}', 400
+        return jsonify(self.blockchain.mining_stats(window)), 200
+
     def broadcast_transaction(self, transaction):
         """
-        Broadcast a new transaction to all nodes
-        :param transaction: The transaction to broadcast
+        Broadcast a new transaction to the network in the background. It is gossiped to a
+        bounded number of peers, batched per peer, and never re-flooded once seen.
+        :param transaction: The Transaction to broadcast
         """
-        for node in self.nodes:
-            url = f'http://{node}/transactions/new'
-            try:
-                requests.post(url, json=transaction)
-            except requests.exceptions.RequestException as e:
-                print(f"Error broadcasting transaction to {node}: {e}")
+        self.gossip.publish([transaction])
 
-    def sync_chain(self):
+    def sync_chain(self, interval=60):
         """
-        Periodically sync the blockchain with other nodes
+        Keep the blockchain in sync with other nodes. Every registered node is followed over its
+        /blocks/events stream, and we sync with it as soon as it announces a block ahead of us.
+        Polling remains as a fallback for missed announcements: a round only exchanges tips
+        unless a peer is ahead, in which case just the blocks after our common ancestor are fetched.
+        :param interval: Seconds between fallback sync rounds
         """
         while True:
-            for node in self.nodes:
-                url = f'http://{node}/chain'
-                try:
-                    response = requests.get(url)
-                    if response.status_code == 200:
-                        chain = response.json()['chain']
-                        self.blockchain.resolve_conflicts(chain)
-                except requests.exceptions.RequestException as e:
-                    print(f"Error syncing with {node}: {e}")
-            time.sleep(10)  # Sync every 10 seconds
+            self.block_subscriber.start()  # Follow newly registered nodes
+            if self.header_sync.sync():
+                print(f"Synced chain to height {len(self.blockchain.chain)}")
+            for node, error in list(self.header_sync.client.errors.items()):
+                print(f"Error syncing with {node}: {error}")
+            time.sleep(interval)  # Poll every 60 seconds by default
 
 # Example usage
 if __name__ == "__main__":
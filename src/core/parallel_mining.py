@@ -0,0 +1,120 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from core.difficulty import work_target
+
+NO_SOLUTION = 2 ** 63 - 1
+
+_best_nonce = None  # Shared lowest solution found so far, set in every worker process
+
+
+def _init_worker(best_nonce):
+    global _best_nonce
+    _best_nonce = best_nonce
+
+
+def _scan(prefix, target, start, worker, workers, chunk_size):
+    """
+    Scan this worker's share of the nonce space: chunks worker, worker + workers, ...
+    A worker stops as soon as a solution lower than its next chunk is known, so the
+    lowest solution overall is always found, exactly as a sequential scan would.
+    :param target: Bound the hash, read as a big-endian integer, must stay below
+    :return: Number of hashes computed
+    """
+    midstate = hashlib.sha256(prefix)
+    hashes = 0
+    chunk = worker
+    while True:
+        first = start + chunk * chunk_size
+        if _best_nonce.value <= first:
+            return hashes
+        for nonce in range(first, first + chunk_size):
+            hashes += 1
+            attempt = midstate.copy()
+            attempt.update(str(nonce).encode())
+            if int.from_bytes(attempt.digest(), 'big') < target:
+                with _best_nonce.get_lock():
+                    if nonce < _best_nonce.value:
+                        _best_nonce.value = nonce
+                return hashes
+        chunk += workers
+
+
+class ParallelMiner:
+    """Proof of Work miner that splits the nonce space across a process pool."""
+
+    def __init__(self, workers: int = None, chunk_size: int = 4096):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.last_report = None
+        self._best_nonce = None
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._best_nonce = multiprocessing.Value('q', NO_SOLUTION)
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self._best_nonce,))
+        return self._pool
+
+    def search(self, prefix: bytes, difficulty: int = 4, start: int = 0, work: int = None) -> int:
+        """
+        Find the lowest nonce >= start such that sha256(prefix + str(nonce)) has `difficulty` leading zeroes.
+        :param work: Required work instead of a number of leading hex zeroes, i.e. the expected number of hashes
+        :return: The nonce; hash rate statistics are stored in last_report
+        """
+        target = work_target(16 ** difficulty if work is None else work)
+        pool = self._get_pool()
+        self._best_nonce.value = NO_SOLUTION
+        began = time.perf_counter()
+        jobs = [
+            pool.apply_async(_scan, (prefix, target, start, worker, self.workers, self.chunk_size))
+            for worker in range(self.workers)
+        ]
+        hashes = sum(job.get() for job in jobs)
+        elapsed = time.perf_counter() - began
+        nonce = self._best_nonce.value
+        self.last_report = {
+            'workers': self.workers,
+            'nonce': nonce,
+            'hashes': hashes,
+            'elapsed': elapsed,
+            'hashes_per_second': hashes / elapsed if elapsed else 0.0,
+        }
+        return nonce
+
+    def proof_of_work(self, last_proof, difficulty: int = 4, work: int = None) -> int:
+        """
+        Parallel equivalent of Blockchain.proof_of_work
+        :param last_proof: Previous Proof
+        :param work: Required work, overriding difficulty
+        :return: New Proof
+        """
+        return self.search(f'{last_proof}'.encode(), difficulty, work=work)
+
+    def mine_block(self, block, difficulty: int, work: int = None):
+        """Parallel equivalent of ProofOfWork.mine_block: set the block's nonce and hash."""
+        block.nonce = self.search(block.hash_prefix(), difficulty, start=block.nonce, work=work)
+        block.hash = block.calculate_hash()
+        return block
+
+    def report(self) -> str:
+        """Human readable summary of the last search."""
+        if self.last_report is None:
+            return "No mining performed yet."
+        r = self.last_report
+        return (f"{r['hashes']} hashes in {r['elapsed']:.3f}s on {r['workers']} workers "
+                f"({r['hashes_per_second']:.0f} H/s)")
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,405 @@
+import hashlib
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set
+from core.encoding import encode_value
+
+# Message kinds of the normal-case protocol
+REQUEST = 'request'
+PRE_PREPARE = 'pre-prepare'
+PREPARE = 'prepare'
+COMMIT = 'commit'
+CHECKPOINT = 'checkpoint'
+
+CLIENT = 'client'  # Sender of requests submitted through a PBFTCluster
+
+
+def batch_digest(batch: list) -> str:
+    """SHA-256 of the canonical encoding of a batch of requests (JSON-compatible values)."""
+    out = bytearray()
+    encode_value(batch, out)
+    return hashlib.sha256(out).hexdigest()
+
+
+class Message:
+    """A protocol message; payload is the batch of a pre-prepare or the operation of a request."""
+    __slots__ = ('kind', 'view', 'sequence', 'digest', 'sender', 'payload')
+
+    def __init__(self, kind: str, view: int, sequence: int, digest: Optional[str], sender: Hashable, payload=None):
+        self.kind = kind
+        self.view = view
+        self.sequence = sequence
+        self.digest = digest
+        self.sender = sender
+        self.payload = payload
+
+    def __repr__(self):
+        return f"Message({self.kind}, view={self.view}, sequence={self.sequence}, sender={self.sender})"
+
+
+class Transport:
+    """
+    Delivers messages between the replicas of a cluster. Replicas only call send and broadcast,
+    and the transport calls replica.receive, so a cluster runs unchanged in one process, over a
+    simulated network or over sockets. Messages are not signed: the transport is trusted to
+    report the true sender. A transport that holds messages until its caller delivers them also
+    implements deliver and pending, which PBFTCluster.run drives it with; one that delivers by
+    itself, e.g. from a simulator or a socket loop, need not.
+    """
+
+    def __init__(self):
+        self.replicas: Dict[Hashable, 'Replica'] = {}
+        self.sent = 0
+
+    def register(self, replica: 'Replica'):
+        self.replicas[replica.id] = replica
+
+    def send(self, recipient: Hashable, message: Message):
+        raise NotImplementedError
+
+    def broadcast(self, message: Message):
+        """Send a message to every replica but its sender."""
+        for recipient in self.replicas:
+            if recipient != message.sender:
+                self.send(recipient, message)
+
+    def deliver(self, limit: int = None) -> int:
+        """
+        Deliver held messages, including the ones sent while delivering
+        :param limit: Maximum messages delivered; None until none are held
+        :return: Number of messages delivered
+        """
+        raise NotImplementedError
+
+    def pending(self) -> int:
+        """Number of messages held for delivery."""
+        raise NotImplementedError
+
+
+class LocalTransport(Transport):
+    """
+    In-process transport: messages wait in one FIFO queue and are delivered by calling deliver,
+    so a cluster runs deterministically in a single thread. Crashed replicas neither send nor
+    receive anything.
+    """
+
+    def __init__(self, crashed: Iterable[Hashable] = ()):
+        super().__init__()
+        self.queue = deque()  # (recipient, message)
+        self.crashed: Set[Hashable] = set(crashed)
+        self.delivered = 0
+
+    def send(self, recipient: Hashable, message: Message):
+        self.sent += 1
+        if recipient not in self.crashed and message.sender not in self.crashed:
+            self.queue.append((recipient, message))
+
+    def deliver(self, limit: int = None) -> int:
+        delivered = 0
+        while self.queue and (limit is None or delivered < limit):
+            recipient, message = self.queue.popleft()
+            self.replicas[recipient].receive(message)
+            delivered += 1
+        self.delivered += delivered
+        return delivered
+
+    def pending(self) -> int:
+        return len(self.queue)
+
+
+class Slot:
+    """Protocol state of one sequence number at one replica."""
+    __slots__ = ('digest', 'batch', 'prepares', 'commits', 'prepared', 'committed')
+
+    def __init__(self):
+        self.digest = None  # Digest of the accepted pre-prepare
+        self.batch = None
+        self.prepares: Dict[str, Set[Hashable]] = {}  # Digest -> backups that sent a prepare for it
+        self.commits: Dict[str, Set[Hashable]] = {}  # Digest -> replicas that sent a commit for it
+        self.prepared = False
+        self.committed = False
+
+
+class Replica:
+    """
+    A PBFT replica (Castro and Liskov) in the normal case: the primary of the view assigns
+    sequence numbers to batches of requests in pre-prepares, and a batch is committed once a
+    quorum of 2f + 1 replicas has prepared and then committed it, with f = (n - 1) // 3. Any
+    sequence number between the low watermark h and h + window may be in flight at once, so
+    the primary pipelines batches instead of waiting for each commit; batches are executed in
+    sequence order. Every checkpoint_interval batches the replicas exchange checkpoints of
+    their state, and once 2f + 1 agree, the checkpoint is stable: the log below it is discarded
+    and the watermarks move up. View changes are not implemented, so the primary must be correct.
+    """
+
+    def __init__(self, replica_id: Hashable, replica_ids: List[Hashable], transport: Transport,
+                 batch_size: int = 64, window: int = 32, checkpoint_interval: int = 8,
+                 on_execute: Callable = None):
+        """
+        :param replica_id: Id of this replica, one of replica_ids
+        :param replica_ids: Ids of all replicas, in the order primaries take turns
+        :param transport: Transport the replica sends through and is registered with
+        :param batch_size: Maximum requests per pre-prepare
+        :param window: Sequence numbers that may be in flight, from the low watermark
+        :param checkpoint_interval: Batches between checkpoints, at most window
+        :param on_execute: Called as on_execute(replica, sequence, batch) for every executed batch
+        """
+        if checkpoint_interval > window:
+            raise ValueError("The checkpoint interval cannot exceed the window")
+        self.id = replica_id
+        self.replica_ids = list(replica_ids)
+        self.f = (len(self.replica_ids) - 1) // 3
+        self.transport = transport
+        self.batch_size = batch_size
+        self.window = window
+        self.checkpoint_interval = checkpoint_interval
+        self.on_execute = on_execute
+        self.view = 0
+        self.low = 0  # Low watermark: sequence number of the last stable checkpoint
+        self.next_sequence = 1  # Next sequence number the primary assigns
+        self.pending = deque()  # Requests the primary has not put in a pre-prepare yet
+        self.log: Dict[int, Slot] = {}
+        self.last_executed = 0
+        self.state = hashlib.sha256().hexdigest()  # Hash chain of the executed batch digests
+        self.checkpoints: Dict[int, Dict[str, Set[Hashable]]] = {}  # Sequence -> state digest -> senders
+        self.handlers = {
+            REQUEST: self.on_request,
+            PRE_PREPARE: self.on_pre_prepare,
+            PREPARE: self.on_prepare,
+            COMMIT: self.on_commit,
+            CHECKPOINT: self.on_checkpoint,
+        }
+        transport.register(self)
+
+    @property
+    def primary(self) -> Hashable:
+        return self.replica_ids[self.view % len(self.replica_ids)]
+
+    @property
+    def quorum(self) -> int:
+        return 2 * self.f + 1
+
+    def in_window(self, sequence: int) -> bool:
+        return self.low < sequence <= self.low + self.window
+
+    def _slot(self, sequence: int) -> Slot:
+        slot = self.log.get(sequence)
+        if slot is None:
+            slot = self.log[sequence] = Slot()
+        return slot
+
+    def _broadcast(self, kind: str, sequence: int, digest: str, payload=None):
+        self.transport.broadcast(Message(kind, self.view, sequence, digest, self.id, payload))
+
+    def receive(self, message: Message):
+        handler = self.handlers.get(message.kind)
+        if handler is not None:
+            handler(message)
+
+    def on_request(self, message: Message):
+        if self.id != self.primary:
+            return  # Clients send to the primary; without view changes there is nothing to forward to
+        self.pending.append(message.payload)
+        if len(self.pending) >= self.batch_size:
+            self.propose(full_only=True)
+
+    def propose(self, full_only: bool = False) -> int:
+        """
+        Put pending requests into pre-prepares, as far as the window allows
+        :param full_only: Only send full batches, leaving the rest for a later flush
+        :return: Number of pre-prepares sent
+        """
+        sent = 0
+        while self.pending and self.in_window(self.next_sequence):
+            if full_only and len(self.pending) < self.batch_size:
+                break
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            digest = batch_digest(batch)
+            slot = self._slot(sequence)
+            slot.digest, slot.batch = digest, batch
+            self._broadcast(PRE_PREPARE, sequence, digest, batch)
+            sent += 1
+            self._advance(sequence, slot)
+        return sent
+
+    def on_pre_prepare(self, message: Message):
+        if message.view != self.view or message.sender != self.primary or not self.in_window(message.sequence):
+            return
+        slot = self.log.get(message.sequence)
+        if slot is not None and slot.digest is not None:
+            return  # Already accepted one for this sequence number; a different one is equivocation
+        if batch_digest(message.payload) != message.digest:
+            return
+        slot = self._slot(message.sequence)
+        slot.digest, slot.batch = message.digest, message.payload
+        slot.prepares.setdefault(message.digest, set()).add(self.id)
+        self._broadcast(PREPARE, message.sequence, message.digest)
+        self._advance(message.sequence, slot)
+
+    def on_prepare(self, message: Message):
+        if message.view != self.view or message.sender == self.primary or not self.in_window(message.sequence):
+            return
+        slot = self._slot(message.sequence)
+        slot.prepares.setdefault(message.digest, set()).add(message.sender)
+        self._advance(message.sequence, slot)
+
+    def on_commit(self, message: Message):
+        if message.view != self.view or not self.in_window(message.sequence):
+            return
+        slot = self._slot(message.sequence)
+        slot.commits.setdefault(message.digest, set()).add(message.sender)
+        self._advance(message.sequence, slot)
+
+    def _advance(self, sequence: int, slot: Slot):
+        """Move a sequence number through prepared and committed as its quorums complete."""
+        if slot.digest is None:
+            return
+        if not slot.prepared and len(slot.prepares.get(slot.digest, ())) >= 2 * self.f:
+            slot.prepared = True
+            slot.commits.setdefault(slot.digest, set()).add(self.id)
+            self._broadcast(COMMIT, sequence, slot.digest)
+        if slot.prepared and not slot.committed and len(slot.commits[slot.digest]) >= self.quorum:
+            slot.committed = True
+            self._execute()
+
+    def _execute(self):
+        """Execute committed batches in sequence order, stopping at the first gap."""
+        while True:
+            slot = self.log.get(self.last_executed + 1)
+            if slot is None or not slot.committed:
+                return
+            self.last_executed += 1
+            self.state = hashlib.sha256((self.state + slot.digest).encode()).hexdigest()
+            if self.on_execute is not None:
+                self.on_execute(self, self.last_executed, slot.batch)
+            if self.last_executed % self.checkpoint_interval == 0:
+                self._broadcast(CHECKPOINT, self.last_executed, self.state)
+                self._record_checkpoint(self.last_executed, self.state, self.id)
+
+    def on_checkpoint(self, message: Message):
+        self._record_checkpoint(message.sequence, message.digest, message.sender)
+
+    def _record_checkpoint(self, sequence: int, state: str, sender: Hashable):
+        if sequence <= self.low:
+            return
+        senders = self.checkpoints.setdefault(sequence, {}).setdefault(state, set())
+        senders.add(sender)
+        # Stable once a quorum agrees and we have reached the same state ourselves; a replica
+        # that fell behind would need a state transfer, which is not implemented
+        if len(senders) >= self.quorum and self.last_executed >= sequence and self.id in senders:
+            self._stabilize(sequence)
+
+    def _stabilize(self, sequence: int):
+        """Discard the log up to a stable checkpoint and move the watermarks up."""
+        self.low = sequence
+        for old in [old for old in self.log if old <= sequence]:
+            del self.log[old]
+        for old in [old for old in self.checkpoints if old <= sequence]:
+            del self.checkpoints[old]
+        if self.id == self.primary:
+            self.propose(full_only=True)
+
+    def flush(self) -> int:
+        """Send the pending requests even if they do not fill a batch, e.g. when a batch timer fires."""
+        return self.propose() if self.id == self.primary else 0
+
+    @property
+    def in_flight(self) -> int:
+        """Sequence numbers assigned but not executed yet, as seen by this replica."""
+        return max(0, self.next_sequence - 1 - self.last_executed) if self.id == self.primary else 0
+
+
+class PBFTCluster:
+    """
+    A PBFT cluster and its client: requests are sent to the primary, and a batch counts as
+    committed when f + 1 replicas have executed it, as a client needs f + 1 matching replies.
+    Records the commit latency of every request and the number of messages per batch.
+    """
+
+    def __init__(self, size: int = 4, nodes: List[Hashable] = None, transport: Transport = None,
+                 batch_size: int = 64, window: int = 32, checkpoint_interval: int = 8,
+                 replica_class=Replica, clock: Callable = time.perf_counter):
+        """
+        :param size: Number of replicas, numbered from 0; ignored if nodes is given
+        :param nodes: Ids of the replicas
+        :param transport: Transport of the cluster; a LocalTransport if not given
+        :param replica_class: Replica or a subclass, e.g. a faulty replica for tests
+        :param clock: Time source for latencies, e.g. the clock of a simulated network
+        """
+        nodes = list(nodes) if nodes is not None else list(range(size))
+        self.transport = transport if transport is not None else LocalTransport()
+        self.replicas = [replica_class(node, nodes, self.transport, batch_size=batch_size, window=window,
+                                       checkpoint_interval=checkpoint_interval, on_execute=self._executed)
+                         for node in nodes]
+        self.f = self.replicas[0].f
+        self.clock = clock
+        self.next_request = 0
+        self.submitted: Dict[int, float] = {}  # Request id -> submission time, until committed
+        self.replies: Dict[int, int] = {}  # Sequence -> replicas that executed it
+        self.committed: List[tuple] = []  # (sequence, batch of operations), in commit order
+        self.latencies: List[float] = []  # Seconds from submission to commit, per request
+
+    @property
+    def primary(self) -> Replica:
+        replica = self.replicas[0]
+        return next(other for other in self.replicas if other.id == replica.primary)
+
+    def submit(self, operation) -> int:
+        """
+        Send a request to the primary
+        :param operation: JSON-compatible value
+        :return: Request id
+        """
+        request_id = self.next_request
+        self.next_request += 1
+        self.submitted[request_id] = self.clock()
+        self.transport.send(self.primary.id, Message(REQUEST, 0, 0, None, CLIENT, [request_id, operation]))
+        return request_id
+
+    def _executed(self, replica: Replica, sequence: int, batch: list):
+        replies = self.replies[sequence] = self.replies.get(sequence, 0) + 1
+        if replies != self.f + 1:
+            return
+        now = self.clock()
+        for request_id, _ in batch:
+            self.latencies.append(now - self.submitted.pop(request_id))
+        self.committed.append((sequence, [operation for _, operation in batch]))
+
+    def run(self) -> int:
+        """
+        Deliver messages until every submitted request is committed or nothing can progress; the
+        primary flushes a partial batch whenever the network goes quiet
+        :return: Number of batches committed so far
+        :raises TypeError: If the transport delivers by itself, without deliver and pending
+        """
+        if type(self.transport).deliver is Transport.deliver or type(self.transport).pending is Transport.pending:
+            raise TypeError(f"{type(self.transport).__name__} delivers by itself and cannot be run by the cluster; "
+                            "drive the transport instead")
+        while True:
+            self.transport.deliver()
+            if not (self.submitted and self.primary.flush()) and not self.transport.pending():
+                return len(self.committed)
+
+    def metrics(self, elapsed: float) -> dict:
+        """Throughput and latency over the run so far, which took elapsed seconds."""
+        latencies = sorted(self.latencies)
+        return {
+            'replicas': len(self.replicas),
+            'blocks': len(self.committed),
+            'blocks_per_second': len(self.committed) / elapsed if elapsed else 0,
+            'p50_latency': latencies[len(latencies) // 2] if latencies else None,
+            'p99_latency': latencies[int(len(latencies) * 0.99)] if latencies else None,
+            'messages_per_block': self.transport.sent / len(self.committed) if self.committed else None,
+        }
+
+
+# Example usage
+if __name__ == "__main__":
+    cluster = PBFTCluster(size=4, batch_size=10)
+    start = time.perf_counter()
+    for i in range(1000):
+        cluster.submit({'from': 'Alice', 'to': 'Bob', 'amount': i})
+    cluster.run()
+    print(cluster.metrics(time.perf_counter() - start))
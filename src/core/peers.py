@@ -0,0 +1,237 @@
+import json
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from core.encoding import decode_chain
+from core.state_snapshot import decode_snapshot
+
+BINARY_CHAIN_MIMETYPE = 'application/octet-stream'
+CHAIN_LENGTH_HEADER = 'X-Chain-Length'
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+BLOCK_EVENTS_MIMETYPE = 'text/event-stream'
+
+
+def parse_chain_response(response):
+    """
+    Read a peer's /chain response in either the binary or the JSON format
+    :param response: Response of GET /chain
+    :return: (length, chain)
+    """
+    if response.headers.get('Content-Type', '').startswith(BINARY_CHAIN_MIMETYPE):
+        chain = decode_chain(response.content)
+        return len(chain), chain
+    values = response.json()
+    return values['length'], values['chain']
+
+
+class PeerClient:
+    """
+    Fetches chains from peers concurrently over a pooled keep-alive session. Every request
+    has a timeout, and a response advertising a chain no longer than ours is closed before
+    its body is downloaded. Chains are requested with the ETag of the last download from the
+    same peer, so an unchanged chain costs a 304. The latency of the last request to each
+    peer is recorded.
+    """
+
+    def __init__(self, timeout=(3.05, 10), max_workers: int = 16, session: requests.Session = None):
+        """
+        :param timeout: Per-peer (connect, read) timeout in seconds
+        :param max_workers: Maximum number of peers contacted at once
+        :param session: Session to use instead of a new pooled one
+        """
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='peer-fetch')
+        self.latencies: Dict[str, float] = {}  # Node -> seconds taken by its last request
+        self.errors: Dict[str, str] = {}  # Node -> last error, cleared on success
+        self.bytes_received: Dict[str, int] = {}  # Node -> response body bytes read from it
+        self.etags: Dict[str, str] = {}  # Node -> ETag of the last chain downloaded from it
+
+    def fetch_chain(self, node: str, min_length: int):
+        """
+        Download a peer's chain if it advertises more than min_length blocks
+        :return: (length, chain, node), or None if the peer failed or is not ahead of us
+        """
+        start = time.perf_counter()
+        try:
+            etag = self.etags.get(node)
+            headers = {'If-None-Match': etag} if etag else None
+            with self.session.get(f'http://{node}/chain', params={'format': 'binary'}, headers=headers,
+                                  timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304:
+                    self.errors.pop(node, None)
+                    return None  # Unchanged since our last download
+                if response.status_code != 200:
+                    self.errors[node] = f'HTTP {response.status_code}'
+                    return None
+                advertised = response.headers.get(CHAIN_LENGTH_HEADER)
+                if advertised is not None and int(advertised) <= min_length:
+                    self.errors.pop(node, None)
+                    return None  # Not ahead of us: skip the body
+                length, chain = parse_chain_response(response)
+                if response.headers.get('ETag'):
+                    self.etags[node] = response.headers['ETag']
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.errors[node] = str(e)
+            return None
+        finally:
+            self.latencies[node] = time.perf_counter() - start
+
+        self.errors.pop(node, None)
+        if length <= min_length or length != len(chain):
+            return None
+        return length, chain, node
+
+    def _get(self, node: str, path: str, params: dict = None):
+        """
+        GET a small resource from a peer, recording latency, errors and bytes received
+        :return: The response, or None if the request failed or did not return 200
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.get(f'http://{node}{path}', params=params, timeout=self.timeout)
+            self.bytes_received[node] = self.bytes_received.get(node, 0) + len(response.content)
+        except requests.exceptions.RequestException as e:
+            self.errors[node] = str(e)
+            return None
+        finally:
+            self.latencies[node] = time.perf_counter() - start
+
+        if response.status_code != 200:
+            self.errors[node] = f'HTTP {response.status_code}'
+            return None
+        self.errors.pop(node, None)
+        return response
+
+    def fetch_tip(self, node: str) -> Optional[Tuple[int, str, Optional[int]]]:
+        """
+        :return: (length, hash of the last block, cumulative work) of a peer's chain, with None for
+            the work of a peer that does not report it, or None if it failed
+        """
+        response = self._get(node, '/chain/tip')
+        try:
+            values = response.json()
+            work = values.get('work')
+            return int(values['length']), values['hash'], None if work is None else int(work)
+        except (AttributeError, ValueError, KeyError, TypeError):
+            return None
+
+    def fetch_block_hash(self, node: str, height: int) -> Optional[str]:
+        """:return: Hash of the peer's block at a height, or None if it failed or has no such block"""
+        response = self._get(node, f'/blocks/{height}/hash')
+        try:
+            return response.json()['hash']
+        except (AttributeError, ValueError, KeyError, TypeError):
+            return None
+
+    def fetch_headers(self, node: str, start: int, limit: int) -> Optional[list]:
+        """:return: Header-only Blocks after the first start blocks of a peer's chain, or None if it failed"""
+        return self._fetch_blocks(node, '/headers', start, limit)
+
+    def fetch_blocks(self, node: str, start: int, limit: int) -> Optional[list]:
+        """:return: Full Blocks after the first start blocks of a peer's chain, or None if it failed"""
+        return self._fetch_blocks(node, '/chain', start, limit)
+
+    def fetch_snapshot(self, node: str) -> Optional[dict]:
+        """:return: A peer's newest state snapshot with a verified checksum, or None if it failed"""
+        response = self._get(node, '/snapshot')
+        if response is None:
+            return None
+        try:
+            return decode_snapshot(response.content)
+        except ValueError as e:
+            self.errors[node] = str(e)
+            return None
+
+    def _fetch_blocks(self, node, path, start, limit):
+        response = self._get(node, path, {'start': start, 'limit': limit, 'format': 'binary'})
+        if response is None:
+            return None
+        try:
+            return parse_chain_response(response)[1]
+        except (ValueError, KeyError, IndexError, struct.error):
+            self.errors[node] = 'Malformed block range'
+            return None
+
+    def iter_block_events(self, node: str) -> Iterator[Tuple[int, str]]:
+        """
+        Follow a peer's /blocks/events stream. The read timeout covers the gaps between the
+        peer's keep-alive comments, so a silent peer ends the stream.
+        :return: Iterator of (height, hash) announcements, starting with the peer's current tip;
+            it ends when the stream fails or closes
+        """
+        try:
+            with self.session.get(f'http://{node}/blocks/events', timeout=self.timeout, stream=True) as response:
+                if response.status_code != 200:
+                    self.errors[node] = f'HTTP {response.status_code}'
+                    return
+                self.errors.pop(node, None)
+                event, data = None, None
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if line.startswith('event:'):
+                        event = line[6:].strip()
+                    elif line.startswith('data:'):
+                        data = line[5:].strip()
+                    elif not line:
+                        if event == 'block' and data is not None:
+                            values = json.loads(data)
+                            yield int(values['height']), values['hash']
+                        event, data = None, None
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            self.errors[node] = str(e)
+
+    def post_transactions(self, node: str, transactions: List[dict]) -> Optional[List[dict]]:
+        """
+        Submit a batch of transactions to a peer's /transactions/batch
+        :return: The per-transaction results, or None if the request failed
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f'http://{node}/transactions/batch', json={'transactions': transactions},
+                                         timeout=self.timeout)
+            results = response.json()['results'] if response.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.errors[node] = str(e)
+            return None
+        finally:
+            self.latencies[node] = time.perf_counter() - start
+
+        if results is None:
+            self.errors[node] = f'HTTP {response.status_code}'
+            return None
+        self.errors.pop(node, None)
+        return results
+
+    def fetch_heavier_chains(self, nodes, length: int, work: int) -> List[Tuple[int, list, str]]:
+        """
+        Fetch the chains of the peers whose tips report more cumulative work than ours, concurrently.
+        The other peers only cost a tip; a peer that does not report its work is compared by length.
+        :param length: Length of our chain
+        :param work: Cumulative work of our chain
+        :return: The chains as (length, chain, node), most work first
+        """
+        def fetch(node):
+            tip = self.fetch_tip(node)
+            if tip is None:
+                return None
+            peer_length, _, peer_work = tip
+            if peer_work is None:
+                result = self.fetch_chain(node, length)
+            else:
+                result = self.fetch_chain(node, 0) if peer_work > work else None
+            return None if result is None else (peer_work or 0, result)
+
+        results = self.executor.map(fetch, list(nodes))
+        ranked = sorted((result for result in results if result is not None),
+                        key=lambda result: (-result[0], -result[1][0]))
+        return [result for _, result in ranked]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
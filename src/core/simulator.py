@@ -0,0 +1,532 @@
+import hashlib
+import heapq
+import itertools
+import random
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+from core.blockchain import Blockchain
+from core.consensus import Consensus
+from core.consensus_mechanisms import ProofOfStake, ProofOfWork
+from core.leader_schedule import epoch_seed
+from core.pbft import CLIENT, COMMIT, PRE_PREPARE, PREPARE, REQUEST, Message, PBFTCluster, Replica, Transport
+from core.stake_index import StakeIndex
+
+MESSAGE_OVERHEAD = 100  # Bytes of headers, signature and framing in every simulated message
+
+
+class Simulator:
+    """
+    Discrete-event scheduler: callbacks run in order of their simulated time (ties in the order
+    they were scheduled), and time jumps from one event to the next, so a simulated hour of an
+    idle network costs nothing.
+    """
+
+    def __init__(self, seed: int = 0):
+        """
+        :param seed: Seed of the random source every model of the simulation draws from
+        """
+        self.now = 0.0
+        self.rng = random.Random(seed)
+        self.events = 0
+        self._queue = []  # (time, order, callback, args)
+        self._order = itertools.count()
+
+    def schedule(self, delay: float, callback: Callable, *args):
+        """Run callback(*args) delay seconds from now."""
+        heapq.heappush(self._queue, (self.now + delay, next(self._order), callback, args))
+
+    def run(self, until: float = None, max_events: int = None) -> int:
+        """
+        Process events in time order
+        :param until: Simulated time to stop at; None to run until no events are left
+        :param max_events: Maximum events processed
+        :return: Number of events processed
+        """
+        processed = 0
+        queue = self._queue
+        while queue and (max_events is None or processed < max_events):
+            if until is not None and queue[0][0] > until:
+                break
+            self.now, _, callback, args = heapq.heappop(queue)
+            callback(*args)
+            processed += 1
+        if until is not None and self.now < until:
+            self.now = until
+        self.events += processed
+        return processed
+
+
+class NetworkModel:
+    """
+    Link characteristics: a one-way latency of latency plus up to jitter seconds, an uplink of
+    bandwidth bytes per second per node over which a node's messages are sent one after the
+    other, and a probability of losing each message. Subclass link_latency for topologies,
+    e.g. regions with longer links between them.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, bandwidth: float = None, loss: float = 0,
+                 retransmit_timeout: float = 0.2):
+        """
+        :param latency: Minimum one-way latency in seconds
+        :param jitter: Maximum extra latency, drawn uniformly per message
+        :param bandwidth: Uplink of every node in bytes per second; None for no limit
+        :param loss: Probability that a message is lost
+        :param retransmit_timeout: Seconds before a lost message of a reliable connection is sent again
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.retransmit_timeout = retransmit_timeout
+
+    def link_latency(self, sender: Hashable, recipient: Hashable, rng: random.Random) -> float:
+        return self.latency + rng.uniform(0, self.jitter) if self.jitter else self.latency
+
+
+class SimulatedNetwork:
+    """
+    Nodes exchanging messages over a NetworkModel inside a Simulator. Crashed nodes neither
+    send nor receive, and messages in flight to a node that crashes are lost. Counts messages
+    by kind, bytes, and lost messages.
+    """
+
+    def __init__(self, simulator: Simulator, model: NetworkModel = None):
+        self.simulator = simulator
+        self.model = model or NetworkModel()
+        self.handlers: Dict[Hashable, Callable] = {}  # Node -> handler(sender, message)
+        self.uplinks: Dict[Hashable, float] = {}  # Node -> time its uplink is free
+        self.down = set()
+        self.messages = Counter()  # Kind -> messages sent
+        self.bytes = 0
+        self.lost = 0
+
+    def register(self, node: Hashable, handler: Callable):
+        self.handlers[node] = handler
+
+    def send(self, sender: Hashable, recipient: Hashable, kind: str, message, size: int = MESSAGE_OVERHEAD,
+             reliable: bool = False):
+        """
+        :param kind: Kind of the message, for the message counts
+        :param size: Bytes of the message, for the bandwidth model
+        :param reliable: Send as over TCP: a lost message arrives a retransmission timeout later
+            instead of never
+        """
+        if sender in self.down:
+            return
+        self.messages[kind] += 1
+        self.bytes += size
+        simulator, model = self.simulator, self.model
+        delay = 0
+        while model.loss and simulator.rng.random() < model.loss:
+            self.lost += 1
+            if not reliable:
+                return
+            delay += model.retransmit_timeout
+        if model.bandwidth:
+            start = max(simulator.now, self.uplinks.get(sender, 0))
+            self.uplinks[sender] = start + size / model.bandwidth
+            delay += self.uplinks[sender] - simulator.now
+        simulator.schedule(delay + model.link_latency(sender, recipient, simulator.rng),
+                           self._deliver, sender, recipient, message)
+
+    def _deliver(self, sender, recipient, message):
+        if recipient in self.down:
+            self.lost += 1
+            return
+        self.handlers[recipient](sender, message)
+
+    def crash(self, node: Hashable, at: float = 0, recover: float = None):
+        """
+        Crash a node at a simulated time
+        :param recover: Time at which it comes back, keeping its state; None for never
+        """
+        self.simulator.schedule(max(0, at - self.simulator.now), self.down.add, node)
+        if recover is not None:
+            self.simulator.schedule(max(0, recover - self.simulator.now), self.down.discard, node)
+
+    @property
+    def total_messages(self) -> int:
+        return sum(self.messages.values())
+
+
+def random_peers(count: int, degree: int, rng: random.Random) -> List[List[int]]:
+    """Random undirected overlay in which every node has at least degree peers."""
+    peers = [set() for _ in range(count)]
+    for node in range(count):
+        while len(peers[node]) < min(degree, count - 1):
+            other = rng.randrange(count)
+            if other != node:
+                peers[node].add(other)
+                peers[other].add(node)
+    return [sorted(node_peers) for node_peers in peers]
+
+
+def _summary(mechanism: str, nodes: int, duration: float, blocks: int, finality: List[float],
+             network: SimulatedNetwork, started: float, **extra) -> dict:
+    finality = sorted(finality)
+    report = {
+        'mechanism': mechanism,
+        'nodes': nodes,
+        'blocks': blocks,
+        'throughput': blocks / duration,
+        'finality_p50': finality[len(finality) // 2] if finality else None,
+        'finality_p99': finality[int(len(finality) * 0.99)] if finality else None,
+        'messages': network.total_messages,
+        'messages_per_block': network.total_messages / blocks if blocks else None,
+        'lost': network.lost,
+        'events': network.simulator.events,
+        'wall_time': time.perf_counter() - started,
+    }
+    report.update(extra)
+    return report
+
+
+class SimBlock:
+    """A block of a simulated longest-chain network; only its place in the tree matters."""
+    __slots__ = ('id', 'parent', 'height', 'producer', 'created', 'hash')
+
+    def __init__(self, block_id: int, parent: Optional['SimBlock'], producer: int, created: float):
+        self.id = block_id
+        self.parent = parent
+        self.height = parent.height + 1 if parent is not None else 1
+        self.producer = producer
+        self.created = created
+        self.hash = hashlib.sha256(f'{block_id}:{parent.hash if parent else ""}'.encode()).hexdigest()
+
+
+class LongestChainSimulation:
+    """
+    Nodes that produce blocks on their best tip, flood them over a random overlay and adopt
+    any higher block they receive (the first one seen wins a tie). Forks happen when a block
+    is produced before the previous one has reached its producer. A block is final once
+    `confirmations` blocks are built on it on the final main chain; its finality latency is
+    the time from its creation to the creation of that last confirming block. Byzantine nodes
+    withhold their blocks and relay nothing. Subclasses decide who produces blocks and when.
+    """
+    mechanism = None
+
+    def __init__(self, nodes: int, model: NetworkModel = None, degree: int = 8, block_size: int = 1000000,
+                 confirmations: int = 6, byzantine: Iterable[int] = (), seed: int = 0):
+        """
+        :param nodes: Number of nodes
+        :param degree: Minimum peers of each node in the overlay
+        :param block_size: Bytes of a block message
+        :param confirmations: Blocks built on a block before it is final
+        :param byzantine: Nodes that withhold blocks and do not relay
+        """
+        self.simulator = Simulator(seed)
+        self.network = SimulatedNetwork(self.simulator, model)
+        self.nodes = nodes
+        self.peers = random_peers(nodes, degree, self.simulator.rng)
+        self.block_size = block_size
+        self.confirmations = confirmations
+        self.byzantine = set(byzantine)
+        self.genesis = SimBlock(0, None, -1, 0.0)
+        self.blocks: List[SimBlock] = []  # Published blocks
+        self._block_ids = itertools.count(1)
+        self.tips = [self.genesis] * nodes
+        self.known = [set() for _ in range(nodes)]
+        for node in range(nodes):
+            self.network.register(node, self._receive(node))
+
+    def _receive(self, node):
+        def receive(sender, block):
+            self._accept(node, block, sender)
+        return receive
+
+    def _accept(self, node: int, block: SimBlock, sender: int = None):
+        known = self.known[node]
+        if block.id in known:
+            return
+        known.add(block.id)
+        if block.height > self.tips[node].height:
+            self.tips[node] = block
+        if node in self.byzantine and block.producer != node:
+            return
+        for peer in self.peers[node]:
+            if peer != sender:
+                self.network.send(node, peer, 'block', block, self.block_size)
+
+    def produce(self, node: int) -> Optional[SimBlock]:
+        """Have a node build a block on its tip and, unless it is Byzantine, publish it."""
+        if node in self.network.down:
+            return None
+        block = SimBlock(next(self._block_ids), self.tips[node], node, self.simulator.now)
+        if node in self.byzantine:
+            self.tips[node] = block  # Withheld: only the producer builds on it
+            return block
+        self.blocks.append(block)
+        self._accept(node, block)
+        return block
+
+    def main_chain(self) -> List[SimBlock]:
+        """Blocks of the main chain after the genesis block, up to the highest block published first."""
+        if not self.blocks:
+            return []
+        block = max(self.blocks, key=lambda block: (block.height, -block.created))
+        chain = []
+        while block is not self.genesis:
+            chain.append(block)
+            block = block.parent
+        chain.reverse()
+        return chain
+
+    def start(self):
+        raise NotImplementedError
+
+    def run(self, duration: float) -> dict:
+        """
+        Simulate duration seconds
+        :return: Report of the blocks, throughput, finality latency and messages
+        """
+        started = time.perf_counter()
+        self.start()
+        self.simulator.run(until=duration)
+        main = self.main_chain()
+        finality = [main[height + self.confirmations].created - block.created
+                    for height, block in enumerate(main[:-self.confirmations])]
+        stale = len(self.blocks) - len(main)
+        return _summary(self.mechanism, self.nodes, duration, len(main), finality, self.network, started,
+                        stale_rate=stale / len(self.blocks) if self.blocks else 0)
+
+
+class ProofOfWorkSimulation(LongestChainSimulation):
+    """
+    Proof of Work: each node finds a block after an exponentially distributed time, at a rate
+    of its hash rate over the 16 ** difficulty hashes a ProofOfWork block takes on average.
+    Hash rates are set so that the whole network finds a block every block_interval seconds.
+    """
+    mechanism = 'proof_of_work'
+
+    def __init__(self, nodes: int, block_interval: float = 10, proof_of_work: ProofOfWork = None, **kwargs):
+        super().__init__(nodes, **kwargs)
+        self.proof_of_work = proof_of_work or ProofOfWork(difficulty=4)
+        self.expected_hashes = self.proof_of_work.required_work
+        self.hash_rates = StakeIndex({node: self.expected_hashes / (block_interval * nodes) for node in range(nodes)})
+
+    def start(self):
+        self._schedule_next()
+
+    def _schedule_next(self):
+        # The next block of the whole network comes at the total rate; its finder is drawn in
+        # proportion to hash rate, which is the same as racing one exponential timer per node
+        rate = self.hash_rates.total / self.expected_hashes
+        self.simulator.schedule(self.simulator.rng.expovariate(rate), self._found)
+
+    def _found(self):
+        self.produce(self.hash_rates.elect(self.simulator.rng))
+        self._schedule_next()
+
+
+class ProofOfStakeSimulation(LongestChainSimulation):
+    """
+    Proof of Stake: time is divided into slots, and the leader of each slot, from the epoch's
+    LeaderSchedule, builds a block on its tip. The schedule of an epoch is seeded from the main
+    chain's blocks of the previous one. A slot whose leader is down or Byzantine stays empty.
+    """
+    mechanism = 'proof_of_stake'
+
+    def __init__(self, nodes: int, slot_time: float = 2, slots_per_epoch: int = 32, stakes: Dict[int, float] = None,
+                 **kwargs):
+        super().__init__(nodes, **kwargs)
+        self.slot_time = slot_time
+        self.slots_per_epoch = slots_per_epoch
+        self.proof_of_stake = ProofOfStake()
+        for node in range(nodes):
+            self.proof_of_stake.register_stakeholder(node, stakes[node] if stakes else 1)
+        self.schedule = None
+        self.missed = 0
+
+    def start(self):
+        self.simulator.schedule(self.slot_time, self._slot, 1)
+
+    def _slot(self, slot: int):
+        epoch = slot // self.slots_per_epoch
+        if self.schedule is None or self.schedule.epoch != epoch:
+            previous = [block.hash for block in self.main_chain()
+                        if (epoch - 1) * self.slots_per_epoch * self.slot_time <= block.created]
+            self.schedule = self.proof_of_stake.schedule_epoch(epoch, self.slots_per_epoch,
+                                                               epoch_seed(epoch, previous))
+        leader = self.schedule.leader(slot)
+        if leader in self.byzantine or self.produce(leader) is None:
+            self.missed += 1
+        self.simulator.schedule(self.slot_time, self._slot, slot + 1)
+
+    def run(self, duration: float) -> dict:
+        report = super().run(duration)
+        report['missed_slots'] = self.missed
+        return report
+
+
+class ByzantineReplica(Replica):
+    """PBFT replica that prepares and commits digests of its own, trying to split the others' votes."""
+
+    def _broadcast(self, kind, sequence, digest, payload=None):
+        if kind in (PREPARE, COMMIT):
+            digest = hashlib.sha256(f'{self.id}:{sequence}'.encode()).hexdigest()
+        super()._broadcast(kind, sequence, digest, payload)
+
+
+class SimulatedTransport(Transport):
+    """
+    PBFT transport over reliable connections of a SimulatedNetwork: a replica that missed a
+    message could only catch up by a state transfer, which the engine does not implement.
+    The size of a message grows with its batch.
+    """
+
+    def __init__(self, network: SimulatedNetwork, request_size: int = 250):
+        super().__init__()
+        self.network = network
+        self.request_size = request_size
+
+    def register(self, replica: Replica):
+        super().register(replica)
+        self.network.register(replica.id, lambda sender, message: replica.receive(message))
+
+    def send(self, recipient: Hashable, message: Message):
+        size = MESSAGE_OVERHEAD
+        if message.kind == PRE_PREPARE:
+            size += len(message.payload) * self.request_size
+        elif message.kind == REQUEST:
+            size += self.request_size
+        self.sent += 1
+        self.network.send(message.sender, recipient, message.kind, message, size, reliable=True)
+
+
+class PBFTSimulation:
+    """
+    The PBFT engine of core.pbft over a simulated network: a client sends requests to the
+    primary at a steady rate, and the primary flushes a partial batch every batch_timeout.
+    A block is a committed batch, and its finality latency is the commit latency of its requests.
+    """
+    mechanism = 'pbft'
+
+    def __init__(self, nodes: int, model: NetworkModel = None, request_rate: float = 1000, batch_size: int = 100,
+                 batch_timeout: float = 0.05, window: int = 32, checkpoint_interval: int = 8,
+                 byzantine: Iterable[int] = (), seed: int = 0):
+        """
+        :param request_rate: Requests per second sent by the client
+        :param byzantine: Replicas that send forged prepares and commits; must not include the primary, 0
+        """
+        self.simulator = Simulator(seed)
+        self.network = SimulatedNetwork(self.simulator, model)
+        self.nodes = nodes
+        self.request_rate = request_rate
+        self.batch_timeout = batch_timeout
+        self.cluster = PBFTCluster(size=nodes, transport=SimulatedTransport(self.network), batch_size=batch_size,
+                                   window=window, checkpoint_interval=checkpoint_interval,
+                                   clock=lambda: self.simulator.now)
+        for node in byzantine:
+            self.cluster.replicas[node] = ByzantineReplica(
+                node, range(nodes), self.cluster.transport, batch_size=batch_size, window=window,
+                checkpoint_interval=checkpoint_interval, on_execute=self.cluster._executed)
+        self.network.register(CLIENT, lambda sender, message: None)
+
+    def _request(self):
+        self.cluster.submit(self.cluster.next_request)
+        self.simulator.schedule(self.simulator.rng.expovariate(self.request_rate), self._request)
+
+    def _flush(self):
+        primary = self.cluster.primary
+        if primary.id not in self.network.down:
+            primary.flush()
+        self.simulator.schedule(self.batch_timeout, self._flush)
+
+    def run(self, duration: float) -> dict:
+        started = time.perf_counter()
+        self.simulator.schedule(0, self._request)
+        self.simulator.schedule(self.batch_timeout, self._flush)
+        self.simulator.run(until=duration)
+        return _summary(self.mechanism, self.nodes, duration, len(self.cluster.committed), self.cluster.latencies,
+                        self.network, started, pending_requests=len(self.cluster.submitted))
+
+
+class VoteSimulation:
+    """
+    One-round voting with Consensus.byzantine_fault_tolerance: every round, each node sends its
+    proposal to all others, and after round_timeout decides on the value more than 2/3 of the
+    nodes proposed, if any. Byzantine nodes propose a different value to each recipient. A
+    round produces a block if every live honest node decided the honest proposal; its finality
+    latency is the time the last of them received the proposal that completed its supermajority.
+    """
+    mechanism = 'byzantine_fault_tolerance'
+
+    def __init__(self, nodes: int, model: NetworkModel = None, round_time: float = 1, round_timeout: float = 0.5,
+                 byzantine: Iterable[int] = (), seed: int = 0):
+        self.simulator = Simulator(seed)
+        self.network = SimulatedNetwork(self.simulator, model)
+        self.nodes = nodes
+        self.round_time = round_time
+        self.round_timeout = round_timeout
+        self.byzantine = set(byzantine)
+        blockchain = Blockchain()
+        blockchain.nodes.update(str(node) for node in range(nodes))
+        self.consensus = Consensus(blockchain)
+        self.threshold = nodes * 2 / 3
+        self.proposals: List[List] = [[] for _ in range(nodes)]  # Proposals received this round, per node
+        self.counts: List[Counter] = [Counter() for _ in range(nodes)]  # The same, counted by value
+        self.supermajority: Dict[int, float] = {}  # Node -> time its honest proposal count passed 2/3
+        self.round = 0
+        self.round_start = 0.0
+        self.decided = 0
+        self.finality: List[float] = []
+        for node in range(nodes):
+            self.network.register(node, self._receive(node))
+
+    def _receive(self, node):
+        def receive(sender, message):
+            round_number, proposal = message
+            if round_number != self.round:
+                return
+            self.proposals[node].append(proposal)
+            counts = self.counts[node]
+            counts[proposal] += 1
+            if node not in self.supermajority and counts[proposal] > self.threshold:
+                self.supermajority[node] = self.simulator.now
+        return receive
+
+    def _start_round(self):
+        self.round += 1
+        self.round_start = self.simulator.now
+        self.supermajority.clear()
+        honest = f'block-{self.round}'
+        for node in range(self.nodes):
+            self.proposals[node] = []
+            self.counts[node] = Counter()
+        for node in range(self.nodes):
+            if node in self.network.down:
+                continue
+            for recipient in range(self.nodes):
+                proposal = f'forged-{node}-{recipient}' if node in self.byzantine else honest
+                if recipient == node:
+                    self.proposals[node].append(proposal)
+                    self.counts[node][proposal] += 1
+                else:
+                    self.network.send(node, recipient, 'proposal', (self.round, proposal))
+        self.simulator.schedule(self.round_timeout, self._decide, honest)
+        self.simulator.schedule(self.round_time, self._start_round)
+
+    def _decide(self, honest: str):
+        deciders = [node for node in range(self.nodes) if node not in self.network.down and node not in self.byzantine]
+        if deciders and all(self.consensus.byzantine_fault_tolerance(self.proposals[node]) == honest
+                            for node in deciders):
+            self.decided += 1
+            self.finality.append(max(self.supermajority[node] for node in deciders) - self.round_start)
+
+    def run(self, duration: float) -> dict:
+        started = time.perf_counter()
+        self.simulator.schedule(0, self._start_round)
+        self.simulator.run(until=duration)
+        return _summary(self.mechanism, self.nodes, duration, self.decided, self.finality, self.network, started,
+                        rounds=self.round)
+
+
+# Example usage
+if __name__ == "__main__":
+    model = NetworkModel(latency=0.05, jitter=0.05, bandwidth=12.5e6, loss=0.01)
+    for simulation in (ProofOfWorkSimulation(1000, model=model, byzantine=range(50)),
+                       ProofOfStakeSimulation(1000, model=model, byzantine=range(50)),
+                       PBFTSimulation(16, model=model, byzantine=[15]),
+                       VoteSimulation(64, model=model, byzantine=[63])):
+        print(simulation.run(duration=60))
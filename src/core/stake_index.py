@@ -0,0 +1,177 @@
+import random
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class StakeIndex:
+    """
+    Stakes of validators in a Fenwick tree (binary indexed tree) over their registration order.
+    Each tree entry holds the sum of a power-of-two run of stakes, so a stake update and a
+    prefix sum both touch O(log n) entries, and a weighted draw descends the tree in O(log n)
+    instead of walking every validator.
+
+    A draw takes one random.uniform(0, total) and returns the first validator, in registration
+    order, whose cumulative stake reaches it: the same rule as the linear walk over a stakes
+    dict, so with the same random state the same validators are elected (exactly for integer
+    stakes; float stakes may round differently at the boundaries).
+    """
+
+    def __init__(self, stakes: Dict[Hashable, float] = None):
+        """
+        :param stakes: Initial stakes, registered in the dict's order
+        """
+        self.nodes: List[Optional[Hashable]] = []  # Slot -> validator, None for a removed one
+        self.stakes: List[float] = []  # Slot -> stake
+        self.slots: Dict[Hashable, int] = {}  # Validator -> slot
+        self._tree = [0]  # 1-based Fenwick tree over self.stakes
+        self._removed = 0
+        self._updates = 0
+        if stakes:
+            for node, stake in stakes.items():
+                self.slots[node] = len(self.nodes)
+                self.nodes.append(node)
+                self.stakes.append(stake)
+            self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __contains__(self, node) -> bool:
+        return node in self.slots
+
+    def get(self, node, default: float = 0) -> float:
+        slot = self.slots.get(node)
+        return default if slot is None else self.stakes[slot]
+
+    def items(self) -> Iterator[Tuple[Hashable, float]]:
+        """Validators and their stakes in registration order."""
+        return ((node, self.stakes[slot]) for node, slot in self.slots.items())
+
+    @property
+    def total(self) -> float:
+        return self._prefix(len(self.stakes))
+
+    def _prefix(self, count: int) -> float:
+        """Sum of the stakes in the first count slots."""
+        total = 0
+        while count:
+            total += self._tree[count]
+            count &= count - 1
+        return total
+
+    def _add(self, slot: int, delta: float):
+        position = slot + 1
+        while position < len(self._tree):
+            self._tree[position] += delta
+            position += position & -position
+
+    def _rebuild(self):
+        """Build the tree from self.stakes in O(n), dropping the error float updates accumulated."""
+        tree = [0] + self.stakes
+        for position in range(1, len(tree)):
+            parent = position + (position & -position)
+            if parent < len(tree):
+                tree[parent] += tree[position]
+        self._tree = tree
+        self._updates = 0
+
+    def _compact(self):
+        """Drop the slots of removed validators, keeping the order of the others."""
+        live = [(node, self.stakes[slot]) for node, slot in self.slots.items()]
+        self.nodes = [node for node, _ in live]
+        self.stakes = [stake for _, stake in live]
+        self.slots = {node: slot for slot, node in enumerate(self.nodes)}
+        self._removed = 0
+        self._rebuild()
+
+    def set(self, node, stake: float):
+        """
+        Register a validator, or change its stake; a validator keeps its place in the order
+        :param stake: New stake, at least 0
+        """
+        if stake < 0:
+            raise ValueError("Stake cannot be negative")
+        slot = self.slots.get(node)
+        if slot is None:
+            slot = self.slots[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.stakes.append(stake)
+            # The new entry covers the slots from position - lowbit(position) + 1 to position
+            position = slot + 1
+            self._tree.append(stake + self._prefix(slot) - self._prefix(position - (position & -position)))
+            return
+        delta = stake - self.stakes[slot]
+        self.stakes[slot] = stake
+        self._add(slot, delta)
+        self._updates += 1
+        if self._updates > max(1024, len(self.stakes)):
+            self._rebuild()
+
+    def remove(self, node) -> float:
+        """
+        Unregister a validator
+        :return: Its stake
+        """
+        slot = self.slots.pop(node)
+        stake = self.stakes[slot]
+        self._add(slot, -stake)
+        self.stakes[slot] = 0
+        self.nodes[slot] = None
+        self._removed += 1
+        if self._removed > len(self.nodes) // 2:
+            self._compact()
+        return stake
+
+    def select(self, point: float) -> Optional[Hashable]:
+        """
+        Find the first validator whose cumulative stake reaches a point
+        :param point: Value from 0 to the total stake
+        :return: The validator, or None if no stake is registered
+        """
+        count = len(self.stakes)
+        slot = 0  # Slots before this one sum to less than point
+        remaining = point
+        step = 1 << count.bit_length()
+        while step:
+            position = slot + step
+            if position <= count and self._tree[position] < remaining:
+                slot = position
+                remaining -= self._tree[position]
+            step >>= 1
+        if slot >= count or self.stakes[slot] <= 0:
+            # Only reached through rounding, or for a point of 0: take the nearest staked validator
+            staked = [other for other in range(count) if self.stakes[other] > 0]
+            if not staked:
+                return None
+            slot = min(staked, key=lambda other: abs(other - slot))
+        return self.nodes[slot]
+
+    def elect(self, rng=random) -> Optional[Hashable]:
+        """
+        Elect a validator with probability proportional to its stake
+        :param rng: Source of randomness with a uniform method, e.g. a seeded random.Random
+        :return: The validator, or None if the total stake is 0
+        """
+        total = self.total
+        if total <= 0:
+            return None
+        return self.select(rng.uniform(0, total))
+
+    def elect_many(self, count: int, rng=random) -> List[Hashable]:
+        """
+        Elect count validators independently, e.g. the leaders of every slot of an epoch, in
+        O(count log n); the result equals count calls of elect with the same random state
+        """
+        total = self.total
+        if total <= 0:
+            return [None] * count
+        return [self.select(rng.uniform(0, total)) for _ in range(count)]
+
+
+# Example usage
+if __name__ == "__main__":
+    index = StakeIndex({'NodeA': 50, 'NodeB': 30, 'NodeC': 20})
+    index.set('NodeD', 100)
+    index.remove('NodeB')
+    print(f"Total stake: {index.total}")
+    print(f"Validator elected: {index.elect()}")
+    print(f"Epoch schedule: {index.elect_many(10, random.Random(42))}")
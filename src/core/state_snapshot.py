@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import struct
+from typing import List, Optional
+from core.encoding import Block, decode_value, encode_value
+
+# A snapshot file is SNAPSHOT_MAGIC, the SHA-256 of the payload, then the payload: the
+# canonical encoding of {'height', 'tip' (header dict), 'balances', 'nonces'}.
+
+SNAPSHOT_MAGIC = b'CHSNAP1\n'
+SNAPSHOT_NAME = 'snapshot-{:010d}.dat'
+SNAPSHOT_PATTERN = re.compile(r'^snapshot-(\d{10})\.dat$')
+
+
+def encode_snapshot(height: int, tip: Block, accounts) -> bytes:
+    """
+    Serialize the account state as of a block with a checksum
+    :param height: Height of the tip block
+    :param tip: The block the state is as of
+    :param accounts: AccountState after applying the block
+    """
+    payload = bytearray()
+    encode_value({
+        'height': height,
+        'tip': tip.header(),
+        'balances': accounts.balances,
+        'nonces': accounts.nonces,
+    }, payload)
+    return SNAPSHOT_MAGIC + hashlib.sha256(payload).digest() + bytes(payload)
+
+
+def decode_snapshot(data: bytes) -> dict:
+    """
+    Check and decode a snapshot written by encode_snapshot
+    :return: Dict with the height, the tip as a header-only Block, balances and nonces
+    :raises ValueError: If the data is not a snapshot, its checksum does not match, or the
+        checksummed payload does not decode
+    """
+    start = len(SNAPSHOT_MAGIC) + 32
+    if len(data) < start or data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a state snapshot")
+    payload = data[start:]
+    if hashlib.sha256(payload).digest() != data[len(SNAPSHOT_MAGIC):start]:
+        raise ValueError("State snapshot checksum mismatch")
+    try:
+        values, _ = decode_value(payload)
+        snapshot = {
+            'height': values['height'],
+            'tip': Block.from_dict(values['tip']),
+            'balances': values['balances'],
+            'nonces': values['nonces'],
+        }
+    except (KeyError, TypeError, IndexError, struct.error) as e:
+        raise ValueError(f"Malformed state snapshot: {e}")
+    if snapshot['tip'].index != snapshot['height']:
+        raise ValueError("Malformed state snapshot: tip does not match height")
+    return snapshot
+
+
+class SnapshotStore:
+    """
+    Directory of periodic state snapshots, one file per height. Files are written to a
+    temporary name and renamed into place, so a crash never leaves a torn snapshot under a
+    valid name, and the checksum catches any later corruption. Only the newest few are kept.
+    """
+
+    def __init__(self, directory: str, interval: int = 1000, keep: int = 2):
+        """
+        :param directory: Directory of the snapshot files; created if missing
+        :param interval: Blocks between snapshots
+        :param keep: Number of snapshots kept, at least 1; older ones are deleted
+        """
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        heights = self.heights()
+        self.last_height = heights[-1] if heights else 0
+
+    def _path(self, height: int) -> str:
+        return os.path.join(self.directory, SNAPSHOT_NAME.format(height))
+
+    def heights(self) -> List[int]:
+        """Heights of the snapshots on disk, oldest first."""
+        matches = (SNAPSHOT_PATTERN.match(name) for name in os.listdir(self.directory))
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    def due(self, height: int) -> bool:
+        """Check whether a chain of this height has moved interval blocks past the last snapshot."""
+        return abs(height - self.last_height) >= self.interval
+
+    def write(self, height: int, tip: Block, accounts) -> str:
+        """
+        Write a snapshot and delete the ones beyond keep
+        :return: Path of the snapshot
+        """
+        path = self._path(height)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(encode_snapshot(height, tip, accounts))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        self.last_height = height
+        for old in self.heights()[:-self.keep]:
+            os.remove(self._path(old))
+        return path
+
+    def read(self, height: int) -> bytes:
+        with open(self._path(height), 'rb') as f:
+            return f.read()
+
+    def latest(self, chain=None) -> Optional[dict]:
+        """
+        Load the newest intact snapshot
+        :param chain: If given, only snapshots of blocks in this chain are considered
+        :return: Snapshot dict from decode_snapshot, or None if there is none
+        """
+        for height in reversed(self.heights()):
+            try:
+                snapshot = decode_snapshot(self.read(height))
+            except (OSError, ValueError) as e:
+                print(f"Skipping state snapshot at height {height}: {e}")
+                continue
+            if chain is None or height <= len(chain) and chain[height - 1].hash == snapshot['tip'].hash:
+                return snapshot
+        return None
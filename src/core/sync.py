@@ -0,0 +1,193 @@
+import threading
+import time
+from typing import Dict, Optional
+from core.peers import PeerClient
+
+
+class HeaderSync:
+    """
+    Headers-first delta sync with peers. Each round asks a peer for its tip only, so an idle
+    round costs a constant number of bytes. When the peer's tip reports more cumulative work
+    than ours, as it may with a shorter chain after a difficulty change, the last block we
+    share is found by binary search over heights (one hash per probe), the headers after it
+    are checked for valid links and proofs, and only then are the missing blocks downloaded.
+    """
+
+    def __init__(self, blockchain, peer_client: PeerClient = None, header_batch: int = 2000,
+                 block_batch: int = 500):
+        """
+        :param blockchain: Blockchain to keep in sync
+        :param peer_client: PeerClient for the requests; the blockchain's is used if not given
+        :param header_batch: Maximum headers per request
+        :param block_batch: Maximum blocks per request
+        """
+        self.blockchain = blockchain
+        self.peer_client = peer_client
+        self.header_batch = header_batch
+        self.block_batch = block_batch
+
+    @property
+    def client(self) -> PeerClient:
+        if self.peer_client is None:
+            if self.blockchain.peer_client is None:
+                self.blockchain.peer_client = PeerClient()
+            self.peer_client = self.blockchain.peer_client
+        return self.peer_client
+
+    def sync(self) -> bool:
+        """
+        Run one sync round against every registered node
+        :return: True if our chain was extended or replaced
+        """
+        changed = False
+        for node in list(self.blockchain.nodes):
+            changed = self.sync_with(node) or changed
+        return changed
+
+    def sync_with(self, node: str) -> bool:
+        """
+        Catch up with a peer whose chain has more cumulative work than ours; a peer that does not
+        report its work is compared by length
+        :param node: Address of the peer, e.g. '192.168.0.5:5000'
+        :return: True if our chain was extended or replaced
+        """
+        tip = self.client.fetch_tip(node)
+        if tip is None:
+            return False
+        length, tip_hash, work = tip
+        our_length, our_hash, our_work = self.blockchain.get_tip_work()
+        if tip_hash == our_hash or (length <= our_length if work is None else work <= our_work):
+            return False  # Not ahead of us: nothing more is requested
+
+        fork = self.find_fork_point(node, length)
+        if fork is None or fork >= length:
+            return False
+        headers = self._fetch_range(self.client.fetch_headers, node, fork, length, self.header_batch)
+        if headers is None or headers[-1].hash != tip_hash:
+            return False
+        # Reject bad links and proofs before downloading any transactions
+        if not self.blockchain.valid_chain(self.blockchain.chain[:fork] + headers, incremental=True,
+                                           headers_only=True):
+            return False
+
+        blocks = self._fetch_range(self.client.fetch_blocks, node, fork, length, self.block_batch)
+        if blocks is None or [block.hash for block in blocks] != [header.hash for header in headers]:
+            return False
+        # Our chain may have grown while we were downloading; only a chain with more work is adopted
+        return self.blockchain.replace_chain(self.blockchain.chain[:fork] + blocks, longer_only=True)
+
+    def bootstrap(self, node: str) -> bool:
+        """
+        Start from a peer's state snapshot instead of downloading and replaying every block:
+        only the headers up to the snapshot are fetched and checked against our checkpoints,
+        the balances and nonces must match the checkpoint's state digest, then the blocks
+        after it are synced as usual
+        :return: True if we now start from the snapshot
+        """
+        snapshot = self.client.fetch_snapshot(node)
+        if snapshot is None:
+            return False
+        headers = self._fetch_range(self.client.fetch_headers, node, 0, snapshot['height'], self.header_batch)
+        if headers is None:
+            return False
+        try:
+            self.blockchain.restore_snapshot(snapshot, headers)
+        except ValueError as e:
+            self.client.errors[node] = str(e)
+            return False
+        self.sync_with(node)
+        return True
+
+    def find_fork_point(self, node: str, length: int) -> Optional[int]:
+        """
+        Find the height of the last block our chain shares with a peer's. Shared prefixes
+        are monotone in height, as each block hash commits to the previous one, so this
+        takes one hash request when the peer extends our tip and O(log n) otherwise.
+        :param length: Length of the peer's chain
+        :return: Height of the common ancestor, 0 if not even the genesis blocks match,
+            or None if the peer stopped answering
+        """
+        chain = self.blockchain.chain
+        high = min(len(chain), length)
+        remote = self.client.fetch_block_hash(node, high)
+        if remote is None:
+            return None
+        if remote == chain[high - 1].hash:
+            return high
+
+        low, high = 0, high - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            remote = self.client.fetch_block_hash(node, mid)
+            if remote is None:
+                return None
+            if remote == chain[mid - 1].hash:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    @staticmethod
+    def _fetch_range(fetch, node, start, end, batch):
+        blocks = []
+        while start + len(blocks) < end:
+            page = fetch(node, start + len(blocks), min(batch, end - start - len(blocks)))
+            if not page:
+                return None
+            blocks.extend(page)
+        return blocks[:end - start]
+
+
+class BlockSubscriber:
+    """
+    Follows the new-block announcements of every registered peer over its /blocks/events
+    stream, and syncs with a peer as soon as it announces a tip we do not have. A block thus
+    reaches us one round trip after it is added, instead of half a polling interval later
+    on average, and an idle peer costs a keep-alive line every few seconds.
+    """
+
+    def __init__(self, header_sync: HeaderSync, retry: float = 5):
+        """
+        :param header_sync: HeaderSync used to catch up with a peer that announced a new tip
+        :param retry: Seconds to wait before reconnecting to a peer whose stream ended
+        """
+        self.header_sync = header_sync
+        self.retry = retry
+        self.threads: Dict[str, threading.Thread] = {}  # Node -> thread following it
+        self._sync_lock = threading.Lock()  # Several peers usually announce the same block
+        self._running = True
+
+    def start(self):
+        """Follow every registered node that is not followed yet."""
+        for node in list(self.header_sync.blockchain.nodes):
+            if node not in self.threads and self._running:
+                thread = threading.Thread(target=self._follow, args=(node,), name=f'follow-{node}', daemon=True)
+                self.threads[node] = thread
+                thread.start()
+
+    def _follow(self, node):
+        while self._running:
+            for height, tip_hash in self.header_sync.client.iter_block_events(node):
+                if not self._running:
+                    return
+                self.on_block(node, height, tip_hash)
+            time.sleep(self.retry)  # The stream failed or closed: reconnect
+
+    def on_block(self, node: str, height: int, tip_hash: str) -> bool:
+        """
+        Handle a peer's announcement of its tip
+        :return: True if our chain was extended or replaced
+        """
+        with self._sync_lock:
+            chain = self.header_sync.blockchain.chain
+            if height <= len(chain) and chain[height - 1].hash == tip_hash:
+                return False  # Already ours, e.g. synced from another peer
+            # A tip we do not have may still be on a lighter chain; sync_with compares the work
+            if not self.header_sync.sync_with(node):
+                return False
+        print(f"Synced chain to height {len(self.header_sync.blockchain.chain)} from {node}")
+        return True
+
+    def close(self):
+        """Stop following; each thread exits at its stream's next event or keep-alive."""
+        self._running = False
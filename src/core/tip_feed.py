@@ -0,0 +1,45 @@
+import threading
+from typing import Callable, Optional, Tuple
+
+
+class TipFeed:
+    """
+    Announces every change of the chain tip as (length, hash). Blocking readers wait on a
+    condition, for long-polls and server-sent event streams served from threads; listeners
+    are called by the writer that changed the tip, e.g. to wake an event loop, and must not block.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.tip: Tuple[int, Optional[str]] = (0, None)
+        self._listeners = ()  # Replaced rather than mutated, so publish can iterate without the lock
+
+    def publish(self, length: int, tip_hash: str):
+        with self._condition:
+            if self.tip == (length, tip_hash):
+                return
+            self.tip = (length, tip_hash)
+            self._condition.notify_all()
+            listeners = self._listeners
+        for listener in listeners:
+            listener(length, tip_hash)
+
+    def wait(self, known_hash: Optional[str], timeout: float) -> Tuple[int, Optional[str]]:
+        """
+        Wait until the tip hash differs from known_hash
+        :param known_hash: Tip hash the caller already has; None to return at once
+        :param timeout: Maximum seconds to wait
+        :return: (length, hash) of the tip, which is still known_hash on timeout
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.tip[1] != known_hash, timeout)
+            return self.tip
+
+    def subscribe(self, listener: Callable):
+        """Call listener(length, hash) on every tip change."""
+        with self._condition:
+            self._listeners = self._listeners + (listener,)
+
+    def unsubscribe(self, listener: Callable):
+        with self._condition:
+            self._listeners = tuple(other for other in self._listeners if other is not listener)
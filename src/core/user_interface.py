@@ -1,12 +1,16 @@
 import json
+from time import time
 from typing import List, Dict, Any
-from consensus_mechanisms import Block, ProofOfWork, ProofOfStake, PracticalByzantineFaultTolerance
+from core.consensus_mechanisms import Block, ProofOfWork, ProofOfStake, PracticalByzantineFaultTolerance
+from core.difficulty import DEFAULT_WORK, DifficultyRetarget, work_digits
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, retarget: DifficultyRetarget = None):
         self.chain: List[Block] = []
-        self.difficulty = 4
-        self.pow = ProofOfWork(difficulty=self.difficulty)
+        self.retarget = retarget or DifficultyRetarget(initial_work=DEFAULT_WORK)
+        self.history = []  # (timestamp, cumulative work) of each block, for retargeting
+        self.pow = ProofOfWork(difficulty=4, work=self.retarget.initial_work)
+        self.difficulty = work_digits(self.pow.work)  # Nearest number of leading hex zeroes, for display
         self.pos = ProofOfStake()
         self.pbft = PracticalByzantineFaultTolerance(nodes=["NodeA", "NodeB", "NodeC", "NodeD"])
         self.create_genesis_block()
@@ -15,6 +19,7 @@ class Blockchain:
         """Create the genesis block and add it to the chain."""
         genesis_block = Block(index=0, previous_hash="0", transactions=[])
         self.chain.append(genesis_block)
+        self.history.append((time(), self.pow.work))
 
     def add_block(self, block: Block):
         """Add a block to the blockchain."""
@@ -30,8 +35,25 @@ class Blockchain:
         new_block = Block(index=len(self.chain), previous_hash=last_block.hash, transactions=transactions)
         mined_block = self.pow.mine_block(new_block)
         self.add_block(mined_block)
+        self.history.append((time(), self.history[-1][1] + self.pow.work))
+        self.retarget_difficulty()
         print(f"Block {mined_block.index} mined with hash: {mined_block.hash}")
 
+    def retarget_difficulty(self):
+        """Set the work of the next block from the recent block times."""
+        self.pow.work = self.retarget.next_work(self.history[-self.retarget.history_length:])
+        self.difficulty = work_digits(self.pow.work)
+
+    def mining_stats(self) -> Dict[str, Any]:
+        """Difficulty, estimated hash rate and block interval histogram over the recent blocks."""
+        recent = self.history[-self.retarget.window - 1:]
+        return {
+            'work': self.pow.work,
+            'difficulty': self.difficulty,
+            'hash_rate': self.retarget.hash_rate(recent),
+            'intervals': self.retarget.interval_histogram([timestamp for timestamp, _ in recent]),
+        }
+
     def create_transaction(self, from_address: str, to_address: str, amount: float):
         """Create a new transaction."""
         transaction = {"from": from_address, "to": to_address, "amount": amount}
@@ -50,7 +72,8 @@ def main():
         print("1. Create Transaction")
         print("2. Mine Block")
         print("3. Display Blockchain")
-        print("4. Exit")
+        print("4. Mining Statistics")
+        print("5. Exit")
         
         choice = input("Select an option: ")
         
@@ -76,6 +99,9 @@ def main():
             blockchain.display_chain()
         
         elif choice == '4':
+            print(json.dumps(blockchain.mining_stats(), indent=2))
+
+        elif choice == '5':
             print("Exiting the user interface.")
             break
         
@@ -0,0 +1,300 @@
+import random
+import unittest
+from core.account_state import MINT_ADDRESS
+from core.blockchain import Blockchain
+from core.consensus import Consensus
+from core.consensus_mechanisms import Block, PracticalByzantineFaultTolerance, ProofOfStake, ProofOfWork
+from core.difficulty import DifficultyRetarget, work_target
+from core.leader_schedule import EpochScheduler, LeaderSchedule, epoch_seed
+from core.parallel_mining import ParallelMiner
+from core.pbft import COMMIT, PREPARE, LocalTransport, Message, PBFTCluster, Replica, Transport
+from core.stake_index import StakeIndex
+from core.user_interface import Blockchain as UserInterfaceBlockchain
+
+
+class TestProofOfWork(unittest.TestCase):
+    def test_midstate_hash_matches_full_hash(self):
+        """Test that mining from the midstate yields the hash calculate_hash produces."""
+        transactions = [{"from": f"sender{i}", "to": "Bob", "amount": i} for i in range(50)]
+        block = ProofOfWork(3).mine_block(Block(1, "0", transactions))
+        self.assertEqual(block.hash, block.calculate_hash())
+        self.assertTrue(block.hash.startswith("000"))
+
+    def test_work_between_hex_digits(self):
+        """Test that a work that is not a power of 16 is mined against its exact target."""
+        block = ProofOfWork(3, work=3 * 16 ** 3).mine_block(Block(1, "0", []))
+        self.assertLess(int(block.hash, 16), work_target(3 * 16 ** 3))
+        self.assertEqual(block.hash, block.calculate_hash())
+
+    def test_user_interface_retargets(self):
+        """Test that the interactive node's difficulty follows its block times in both directions."""
+        node = UserInterfaceBlockchain(DifficultyRetarget(target_interval=1000, window=2, initial_work=16))
+        for _ in range(5):
+            node.mine_block([])
+        self.assertEqual(node.pow.work, 16 * 4 ** 4)  # Blocks far too fast: up 4 times per block
+        self.assertEqual(node.difficulty, 3)
+
+        node = UserInterfaceBlockchain(DifficultyRetarget(target_interval=0.001, window=2, initial_work=16 ** 3))
+        for _ in range(5):
+            node.mine_block([])
+        self.assertLess(node.pow.work, 16 ** 3)
+        self.assertEqual(node.mining_stats()['work'], node.pow.work)
+
+
+class TestParallelMiner(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.miner = ParallelMiner(workers=3, chunk_size=500)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.miner.close()
+
+    def test_proof_of_work_matches_sequential(self):
+        """Test that the parallel miner finds the same proof as Blockchain.proof_of_work."""
+        expected = Blockchain().proof_of_work(100)
+        self.assertEqual(Blockchain(miner=self.miner).proof_of_work(100), expected)
+        self.assertTrue(Blockchain.valid_proof(100, expected))
+        self.assertGreater(self.miner.last_report['hashes'], 0)
+
+    def test_mine_block_matches_sequential(self):
+        """Test that ProofOfWork.mine_block returns the same block with a parallel miner."""
+        transactions = [{"from": "Alice", "to": "Bob", "amount": 10}]
+        expected = ProofOfWork(3).mine_block(Block(1, "0", transactions))
+        mined = ProofOfWork(3, miner=self.miner).mine_block(Block(1, "0", transactions))
+        self.assertEqual((mined.nonce, mined.hash), (expected.nonce, expected.hash))
+
+
+def linear_election(stakes, rng):
+    """The original election: walk the stakes until the cumulative stake reaches a uniform draw."""
+    random_choice = rng.uniform(0, sum(stakes.values()))
+    current_sum = 0
+    for node, stake in stakes.items():
+        current_sum += stake
+        if current_sum >= random_choice:
+            return node
+
+
+class TestStakeIndex(unittest.TestCase):
+    def test_matches_linear_election(self):
+        """Test that the index elects the same validators as the linear walk from the same random state."""
+        generator = random.Random(1)
+        stakes = {f'validator{i}': generator.randint(0, 1000) for i in range(300)}
+        index = StakeIndex(stakes)
+        expected = [linear_election(stakes, random.Random(seed)) for seed in range(500)]
+        self.assertEqual([index.elect(random.Random(seed)) for seed in range(500)], expected)
+
+        rng = random.Random(7)
+        schedule = index.elect_many(200, rng)
+        rng = random.Random(7)
+        self.assertEqual(schedule, [linear_election(stakes, rng) for _ in range(200)])
+
+    def test_stake_updates(self):
+        """Test that new stakes, changed stakes and removals are reflected in the elections."""
+        index = StakeIndex()
+        self.assertIsNone(index.elect())
+        stakes = {}
+        generator = random.Random(2)
+        for step in range(2000):
+            node = f'validator{generator.randrange(100)}'
+            if node in stakes and generator.random() < 0.3:
+                self.assertEqual(index.remove(node), stakes.pop(node))
+            else:
+                stakes[node] = generator.randint(0, 50)
+                index.set(node, stakes[node])
+            if step % 100 == 0:
+                self.assertEqual(list(index.items()), list(stakes.items()))
+                self.assertEqual(index.total, sum(stakes.values()))
+                self.assertEqual(index.elect(random.Random(step)), linear_election(stakes, random.Random(step)))
+        self.assertRaises(ValueError, index.set, 'validator0', -1)
+
+    def test_consensus_elections(self):
+        """Test that ProofOfStake and Consensus elect only staked validators, roughly in proportion to stake."""
+        pos = ProofOfStake()
+        for node, stake in (('NodeA', 50), ('NodeB', 30), ('NodeC', 20), ('NodeD', 0)):
+            pos.register_stakeholder(node, stake)
+        pos.remove_stakeholder('NodeC')
+        self.assertEqual(pos.stakeholders, {'NodeA': 50, 'NodeB': 30, 'NodeD': 0})
+        schedule = pos.elect_validators(8000, random.Random(3))
+        self.assertAlmostEqual(schedule.count('NodeA') / len(schedule), 50 / 80, delta=0.02)
+        self.assertEqual(set(schedule), {'NodeA', 'NodeB'})
+
+        consensus = Consensus(Blockchain())
+        self.assertIsNone(consensus.proof_of_stake())
+        consensus.set_stake('validator1', 100)
+        self.assertEqual(consensus.elect_validators(3), ['validator1'] * 3)
+        stakes = consensus.get_current_stakes()
+        self.assertEqual(consensus.proof_of_stake(stakes, random.Random(4)), linear_election(stakes, random.Random(4)))
+
+
+
+class UncheckedProofBlockchain(Blockchain):
+    @staticmethod
+    def valid_proof(last_proof, proof, work=None):
+        return True
+
+
+class TestLeaderSchedule(unittest.TestCase):
+    def test_reproducible_schedule(self):
+        """Test that a schedule depends only on the seed and the stakes, not on registration order."""
+        stakes = {f'validator{i}': i % 7 for i in range(50)}
+        seed = epoch_seed(3, ['ab' * 32, 'cd' * 32])
+        schedule = LeaderSchedule.compute(3, 1000, seed, stakes)
+        shuffled = dict(sorted(stakes.items(), key=lambda item: random.Random(5).random()))
+        self.assertEqual(LeaderSchedule.compute(3, 1000, seed, StakeIndex(shuffled)).leaders, schedule.leaders)
+        self.assertNotEqual(LeaderSchedule.compute(3, 1000, epoch_seed(3, ['ab' * 32]), stakes).leaders,
+                            schedule.leaders)
+
+        self.assertEqual((len(schedule), schedule.leaders.itemsize, schedule.first_slot), (1000, 2, 3000))
+        leaders = [schedule.leader(slot) for slot in range(3000, 4000)]
+        self.assertNotIn('validator0', leaders)
+        self.assertEqual(schedule.slots_of('validator6'),
+                         [slot for slot, leader in enumerate(leaders, 3000) if leader == 'validator6'])
+        self.assertRaises(ValueError, schedule.leader, 4000)
+        self.assertRaises(ValueError, LeaderSchedule.compute, 0, 10, seed, {'validator0': 0})
+
+    def test_epoch_scheduler(self):
+        """Test that epochs are seeded from the previous epoch's blocks and known once it is complete."""
+        blockchain = UncheckedProofBlockchain()
+        consensus = Consensus(blockchain)
+        consensus.scheduler = EpochScheduler(slots_per_epoch=4)
+        for node, stake in (('NodeA', 50), ('NodeB', 30), ('NodeC', 20)):
+            consensus.set_stake(node, stake)
+        self.assertEqual(consensus.slot_leader(0), consensus.leader_schedule(0).leader(0))
+        self.assertRaises(ValueError, consensus.leader_schedule, 1)
+
+        while len(blockchain.chain) < 8:
+            blockchain.new_transaction(MINT_ADDRESS, 'NodeA', len(blockchain.chain))
+            blockchain.create_block(proof=len(blockchain.chain))
+        schedule = consensus.leader_schedule(2)
+        self.assertIs(consensus.leader_schedule(2), schedule)
+        self.assertEqual(schedule.seed, epoch_seed(2, [block.hash for block in blockchain.chain[4:8]]))
+        self.assertEqual([consensus.slot_leader(slot) for slot in range(8, 12)],
+                         [schedule.leader(slot) for slot in range(8, 12)])
+
+        other = EpochScheduler(slots_per_epoch=4)
+        self.assertEqual(other.schedule(blockchain.chain, {'NodeC': 20, 'NodeB': 30, 'NodeA': 50}, 2).leaders,
+                         schedule.leaders)
+
+
+
+class ForgingReplica(Replica):
+    """Byzantine backup that prepares and commits a digest of its own instead of the primary's."""
+
+    def _broadcast(self, kind, sequence, digest, payload=None):
+        if kind in (PREPARE, COMMIT):
+            digest = 'f' * 64
+        super()._broadcast(kind, sequence, digest, payload)
+
+
+class StackTransport(Transport):
+    """Transport of the documented interface that delivers the newest message first."""
+
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+
+    def send(self, recipient, message):
+        self.sent += 1
+        self.stack.append((recipient, message))
+
+    def deliver(self, limit=None):
+        delivered = 0
+        while self.stack and (limit is None or delivered < limit):
+            recipient, message = self.stack.pop()
+            self.replicas[recipient].receive(message)
+            delivered += 1
+        return delivered
+
+    def pending(self):
+        return len(self.stack)
+
+
+class SelfDeliveringTransport(Transport):
+    """Transport that delivers on send, without deliver and pending."""
+
+    def send(self, recipient, message):
+        self.sent += 1
+        self.replicas[recipient].receive(message)
+
+
+class TestPBFT(unittest.TestCase):
+    def test_pipelined_batches(self):
+        """Test that batches are pipelined up to the window and executed in order by every replica."""
+        cluster = PBFTCluster(size=4, batch_size=5, window=4, checkpoint_interval=2)
+        for i in range(30):
+            cluster.submit(i)
+        cluster.transport.deliver(limit=30)  # Only the requests: the primary can fill the window
+        self.assertEqual((cluster.primary.in_flight, len(cluster.primary.pending)), (4, 10))
+
+        for i in range(30, 53):
+            cluster.submit(i)
+        self.assertEqual(cluster.run(), 11)
+        self.assertEqual([operation for _, batch in cluster.committed for operation in batch], list(range(53)))
+        self.assertEqual([sequence for sequence, _ in cluster.committed], list(range(1, 12)))
+        self.assertEqual(len(cluster.latencies), 53)
+        for replica in cluster.replicas:
+            self.assertEqual((replica.last_executed, replica.low, replica.state),
+                             (11, 10, cluster.primary.state))
+            self.assertLessEqual(len(replica.log), replica.window)
+
+    def test_faulty_replicas(self):
+        """Test that 4 replicas commit with one crashed or forging replica, and stop with two crashed."""
+        cluster = PBFTCluster(size=4, transport=LocalTransport(crashed=[3]), batch_size=4, window=4,
+                              checkpoint_interval=2)
+        for i in range(20):
+            cluster.submit(i)
+        self.assertEqual(cluster.run(), 5)
+        self.assertEqual(cluster.replicas[3].last_executed, 0)
+
+        cluster = PBFTCluster(size=4, batch_size=4, window=4, checkpoint_interval=2)
+        forger = ForgingReplica(3, [0, 1, 2, 3], cluster.transport, on_execute=cluster._executed)
+        cluster.replicas[3] = forger
+        for i in range(20):
+            cluster.submit(i)
+        self.assertEqual(cluster.run(), 5)
+        # The forger's votes never count, but it still executes what the others commit
+        self.assertEqual({replica.state for replica in cluster.replicas}, {cluster.primary.state})
+
+        cluster = PBFTCluster(size=4, transport=LocalTransport(crashed=[2, 3]))
+        cluster.submit(1)
+        self.assertEqual(cluster.run(), 0)
+
+    def test_run_over_other_transports(self):
+        """Test that run drives any transport with deliver and pending, and rejects one without them."""
+        cluster = PBFTCluster(size=4, transport=StackTransport(), batch_size=4)
+        for i in range(10):
+            cluster.submit(i)
+        self.assertEqual(cluster.run(), 3)
+        # Requests reach the primary newest first
+        self.assertEqual([operation for _, batch in cluster.committed for operation in batch], list(range(9, -1, -1)))
+        self.assertEqual({replica.state for replica in cluster.replicas}, {cluster.primary.state})
+
+        with self.assertRaisesRegex(TypeError, 'SelfDeliveringTransport delivers by itself'):
+            PBFTCluster(size=4, transport=SelfDeliveringTransport()).run()
+
+    def test_rejects_forged_pre_prepare(self):
+        """Test that backups ignore pre-prepares from a non-primary or with a wrong digest."""
+        cluster = PBFTCluster(size=4)
+        backup = cluster.replicas[1]
+        backup.receive(Message('pre-prepare', 0, 1, 'a' * 64, 0, [[0, 'x']]))
+        backup.receive(Message('pre-prepare', 0, 1, None, 2, [[0, 'x']]))
+        self.assertNotIn(1, backup.log)
+        self.assertEqual(cluster.transport.sent, 0)
+
+    def test_propose_block(self):
+        """Test that PracticalByzantineFaultTolerance commits each proposed block through PBFT."""
+        nodes = ["NodeA", "NodeB", "NodeC", "NodeD"]
+        pbft = PracticalByzantineFaultTolerance(nodes=nodes)
+        blocks = [Block(1, "0", []), Block(2, "1", [{"from": "Bob", "to": "Alice", "amount": 5}])]
+        self.assertTrue(all(pbft.propose_block(block) for block in blocks))
+        self.assertEqual(pbft.ledger, blocks)
+        self.assertEqual(pbft.collect_votes(blocks[1]), nodes)
+
+        pbft = PracticalByzantineFaultTolerance(nodes=nodes, transport=LocalTransport(crashed=["NodeC", "NodeD"]))
+        self.assertFalse(pbft.propose_block(blocks[0]))
+        self.assertEqual(pbft.ledger, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,900 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from core.account_state import MINT_ADDRESS
+from core.block_store import BlockStore
+from core.blockchain import Blockchain
+from core.difficulty import DEFAULT_WORK, DifficultyRetarget
+from core.encoding import Block, Transaction, encode_chain, decode_chain
+from core.mempool import Mempool
+from core.state_snapshot import SNAPSHOT_MAGIC, SnapshotStore, decode_snapshot, encode_snapshot
+
+
+class UncheckedProofBlockchain(Blockchain):
+    @staticmethod
+    def valid_proof(last_proof, proof, work=None):
+        return True
+
+
+def build_chain(length):
+    blockchain = UncheckedProofBlockchain()
+    while len(blockchain.chain) < length:
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', len(blockchain.chain))
+        blockchain.create_block(proof=len(blockchain.chain))
+    return blockchain
+
+
+class TestIncrementalValidation(unittest.TestCase):
+    def setUp(self):
+        self.ours = build_chain(10)
+        self.peer = build_chain(1)
+        self.peer.chain = list(self.ours.chain)
+        for _ in range(3):
+            self.peer.create_block(proof=len(self.peer.chain))
+
+    def test_cached_hashes_match(self):
+        """Test that every block carries the hash that Blockchain.hash computes."""
+        self.assertEqual([block.hash for block in self.ours.chain],
+                         [Blockchain.hash(block.to_dict()) for block in self.ours.chain])
+        self.assertEqual(self.ours.validated_height, len(self.ours.chain))
+
+    def test_shared_height(self):
+        """Test that the shared prefix is found by hash."""
+        self.assertEqual(self.ours.shared_height(self.peer.chain), 10)
+        self.assertEqual(self.ours.shared_height(self.ours.chain[:4]), 4)
+        self.assertEqual(self.ours.shared_height(build_chain(3).chain), 0)
+
+    def test_incremental_validation_checks_suffix(self):
+        """Test that incremental validation still rejects a broken suffix."""
+        self.assertTrue(self.ours.valid_chain(self.peer.chain, incremental=True))
+        self.assertEqual(self.ours.verify_chain(self.peer.chain, incremental=True)[0], 10)
+
+        tampered = self.peer.get_chain()
+        self.assertTrue(self.ours.valid_chain(tampered, incremental=True))
+        tampered[-2]['proof'] = -1
+        self.assertFalse(self.ours.valid_chain(tampered, incremental=True))
+        self.assertFalse(self.ours.valid_chain(tampered))
+
+    def test_replace_chain(self):
+        """Test that replacing the chain keeps the cached hashes consistent."""
+        self.assertTrue(self.ours.replace_chain(self.peer.chain))
+        self.assertEqual(len(self.ours.chain), 13)
+        self.assertEqual(self.ours.get_chain(), self.peer.get_chain())
+
+    def test_malformed_chain_is_invalid(self):
+        """Test that blocks missing fields are rejected instead of raising."""
+        chain = self.peer.get_chain()
+        del chain[-1]['proof']
+        self.assertFalse(self.ours.valid_chain(chain, incremental=True))
+
+
+class TestMerkleProofs(unittest.TestCase):
+    def test_proofs_for_every_position(self):
+        """Test that every transaction in blocks of various sizes has a valid inclusion proof."""
+        for count in range(1, 10):
+            blockchain = UncheckedProofBlockchain()
+            for i in range(count):
+                blockchain.new_transaction(MINT_ADDRESS, 'bob', i)
+            blockchain.create_block(proof=1)
+            for position in range(count):
+                proof = blockchain.transaction_proof(2, position)
+                self.assertLessEqual(len(proof['proof']), count.bit_length())
+                self.assertTrue(Blockchain.verify_transaction_proof(
+                    proof['transaction'], proof['proof'], proof['merkle_root']))
+                forged = dict(proof['transaction'], amount=-1)
+                self.assertFalse(Blockchain.verify_transaction_proof(forged, proof['proof'], proof['merkle_root']))
+
+    def test_headers_only_validation(self):
+        """Test that headers validate without transaction bodies, and bodies are checked against the root."""
+        blockchain = build_chain(6)
+        headers = [block.header() for block in blockchain.chain]
+        self.assertTrue(blockchain.valid_chain(headers, headers_only=True))
+        self.assertFalse(blockchain.valid_chain(headers))
+
+        chain = blockchain.get_chain()
+        chain[3]['transactions'][0]['amount'] = 1000
+        self.assertTrue(blockchain.valid_chain(chain, headers_only=True))
+        self.assertFalse(blockchain.valid_chain(chain))
+
+
+def transaction(amount, fee=0):
+    return Transaction('alice', 'bob', amount, {'fee': fee} if fee else None)
+
+
+class TestMempool(unittest.TestCase):
+    def test_duplicates_are_rejected(self):
+        """Test that a transaction id can only be pooled once."""
+        mempool = Mempool()
+        mempool.add(transaction(1))
+        with self.assertRaises(ValueError):
+            mempool.add(transaction(1))
+        self.assertEqual(len(mempool), 1)
+
+    def test_full_pool_evicts_lowest_fee(self):
+        """Test that a full pool evicts its cheapest transaction for a better one, and rejects worse ones."""
+        mempool = Mempool(max_transactions=3)
+        for fee in (5, 1, 3):
+            mempool.add(transaction(fee, fee))
+        mempool.add(transaction(10, 10))
+        self.assertNotIn(transaction(1, 1).id, mempool)
+        with self.assertRaises(ValueError):
+            mempool.add(transaction(2, 2))
+        self.assertEqual(sorted(mempool.fee_of(tx) for tx in mempool.transactions()), [3, 5, 10])
+
+    def test_byte_cap(self):
+        """Test that the pool never holds more encoded bytes than its cap."""
+        size = len(transaction(0, 1).encode())
+        mempool = Mempool(max_bytes=size * 4)
+        for fee in range(1, 10):
+            try:
+                mempool.add(transaction(0, fee))
+            except ValueError:
+                pass
+        self.assertLessEqual(mempool.total_bytes, size * 4)
+        self.assertEqual(sorted(mempool.fee_of(tx) for tx in mempool.transactions()), [6, 7, 8, 9])
+
+    def test_select_best_within_block_limit(self):
+        """Test that blocks take the highest fee transactions that fit."""
+        blockchain = UncheckedProofBlockchain()
+        size = len(Blockchain.make_transaction('user1', 'bob', 0, 1, 0).encode())
+        for fee in (4, 9, 1, 7, 3):
+            blockchain.new_transaction(MINT_ADDRESS, f'user{fee}', 100)
+        blockchain.create_block(proof=1)
+        blockchain.max_block_bytes = size * 3
+        for fee in (4, 9, 1, 7, 3):
+            blockchain.new_transaction(f'user{fee}', 'bob', 0, fee)
+        block = blockchain.create_block(proof=1)
+        self.assertEqual([tx['fee'] for tx in block['transactions']], [9, 7, 4])
+        self.assertEqual(sorted(tx['fee'] for tx in blockchain.current_transactions), [1, 3])
+
+    def test_add_many(self):
+        """Test that a bulk insert gives per-transaction results and the same ordering as single adds."""
+        mempool = Mempool()
+        mempool.add(transaction(1, 2))
+        results = mempool.add_many([transaction(2, 5), transaction(1, 2), transaction(-1), transaction(3, 1)])
+        self.assertEqual(results[0], transaction(2, 5).id)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(len(mempool), 3)
+        self.assertEqual(mempool.pending_cost('alice'), 3 + 7 + 4)
+        self.assertEqual([mempool.fee_of(tx) for tx in mempool.select(10 ** 6)], [5, 2, 1])
+
+    def test_new_transactions_counts_batch_as_pending(self):
+        """Test that a batch cannot overspend a balance across its own transactions."""
+        blockchain = UncheckedProofBlockchain()
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', 10)
+        blockchain.create_block(proof=1)
+        results = blockchain.new_transactions([('alice', 'bob', 6, 0), ('alice', 'bob', 6, 0),
+                                               ('alice', 'carol', 4, 0), ('alice', ['bob'], 'x', 0)])
+        self.assertIsInstance(results[0], str)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], str)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(blockchain.mempool.pending_cost('alice'), 10)
+
+    def test_repeated_payments_and_replays(self):
+        """Test that a repeated payment gets its own id and a confirmed transaction cannot be replayed."""
+        blockchain = UncheckedProofBlockchain()
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', 10)
+        blockchain.create_block(proof=1)
+        first = blockchain.add_transaction('alice', 'bob', 2)
+        second = blockchain.add_transaction('alice', 'bob', 2)
+        self.assertNotEqual(first.id, second.id)
+        block = blockchain.create_block(proof=2)
+        self.assertEqual((blockchain.get_nonce('alice'), blockchain.get_balance('bob')), (2, 4))
+
+        with self.assertRaises(ValueError):
+            blockchain.new_transaction('alice', 'bob', 2, nonce=0)
+        with self.assertRaises(ValueError):
+            blockchain.add_block(Block(block.index + 1, 0.0, [first], 3, block.hash))
+        self.assertEqual(blockchain.get_balance('bob'), 4)
+
+    def test_nonce_gaps(self):
+        """Test that a nonce skipping ahead is rejected, and a pooled one after a gap waits until it is filled."""
+        blockchain = UncheckedProofBlockchain()
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', 10)
+        blockchain.create_block(proof=1)
+        with self.assertRaisesRegex(ValueError, 'skips ahead'):
+            blockchain.new_transaction('alice', 'bob', 1, nonce=2)
+        self.assertEqual(len(blockchain.mempool), 0)
+
+        waiting = Blockchain.make_transaction('alice', 'bob', 1, nonce=1)
+        blockchain.mempool.add(waiting)  # E.g. back from an abandoned block whose nonce 0 payment was dropped
+        self.assertEqual(blockchain.create_block(proof=2).transactions, ())
+        self.assertEqual(blockchain.current_transactions, [waiting.to_dict()])
+        blockchain.new_transaction('alice', 'carol', 1, nonce=0)
+        blockchain.create_block(proof=3)
+        self.assertEqual((blockchain.get_nonce('alice'), len(blockchain.mempool)), (2, 0))
+
+    def test_selection_keeps_nonce_order(self):
+        """Test that a sender's transactions are mined in nonce order whatever their fees."""
+        blockchain = UncheckedProofBlockchain()
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', 10)
+        blockchain.create_block(proof=1)
+        blockchain.max_block_bytes = len(Blockchain.make_transaction('alice', 'bob', 0, 1, 0).encode())
+        for fee in (1, 5):
+            blockchain.new_transaction('alice', 'bob', 0, fee)
+        for proof in (2, 3):
+            blockchain.create_block(proof=proof)
+        self.assertEqual([block['transactions'][0]['fee'] for block in blockchain.chain[2:]], [1, 5])
+        self.assertEqual(blockchain.get_nonce('alice'), 2)
+
+
+class TestBlockStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_chain(self):
+        self.store = BlockStore(self.directory, segment_size=512)
+        return UncheckedProofBlockchain(store=self.store)
+
+    def test_chain_survives_restart(self):
+        """Test that a reopened store yields the same chain, loading bodies lazily."""
+        blockchain = self.open_chain()
+        for i in range(30):
+            blockchain.new_transaction(MINT_ADDRESS, 'alice', i)
+            blockchain.create_block(proof=i)
+        expected = blockchain.get_chain()
+        self.store.close()
+
+        reopened = self.open_chain()
+        self.assertEqual(len(reopened.chain), 31)
+        self.assertIsNone(Block.transactions.__get__(reopened.chain[5]))
+        self.assertEqual(reopened.get_chain(), expected)
+        self.assertTrue(reopened.valid_chain(reopened.chain))
+        self.store.close()
+
+    def test_body_flag_read_from_header(self):
+        """Test that a stored block tells whether it has a body without decoding it."""
+        store = BlockStore(self.directory)
+        self.addCleanup(store.close)
+        block = child(Block(1, 0.0, [], 100, '1'), Transaction(MINT_ADDRESS, 'alice', 5))
+        store.append(block.header_only())
+        store.append(block)
+        store.read_body = None  # Any decoding would fail
+        self.assertEqual([stored.has_body for stored in store.load_headers()], [False, True])
+
+    def test_replace_chain_rewrites_store(self):
+        """Test that adopting a fork truncates the store and appends the new branch."""
+        blockchain = self.open_chain()
+        for i in range(10):
+            blockchain.create_block(proof=i)
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(blockchain.chain[:5])
+        for i in range(8):
+            peer.new_transaction(MINT_ADDRESS, 'dave', i)
+            peer.create_block(proof=i)
+        self.assertTrue(blockchain.replace_chain(peer.get_chain()))
+        self.store.close()
+
+        reopened = self.open_chain()
+        self.assertEqual(reopened.get_chain(), peer.get_chain())
+        self.store.close()
+
+
+class TestAccountState(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = UncheckedProofBlockchain()
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', 50)
+        self.blockchain.create_block(proof=1)
+
+    def test_balances_follow_blocks(self):
+        """Test that balances and nonces are updated as blocks are created."""
+        self.blockchain.new_transaction('alice', 'bob', 20, fee=1)
+        self.assertEqual(self.blockchain.get_balance('bob'), 0)
+        self.blockchain.create_block(proof=2)
+        self.assertEqual(self.blockchain.get_balance('alice'), 29)
+        self.assertEqual(self.blockchain.get_balance('bob'), 20)
+        self.assertEqual((self.blockchain.get_nonce('alice'), self.blockchain.get_nonce('bob')), (1, 0))
+
+    def test_overdraft_rejected(self):
+        """Test that new transactions cannot spend more than the balance minus pending spends."""
+        self.blockchain.new_transaction('alice', 'bob', 30)
+        with self.assertRaises(ValueError):
+            self.blockchain.new_transaction('alice', 'carol', 30)
+        with self.assertRaises(ValueError):
+            self.blockchain.new_transaction('bob', 'carol', 1)
+        self.blockchain.new_transaction('alice', 'carol', 20)
+
+    def test_chain_replacement_reverts_state(self):
+        """Test that adopting a fork reverts our blocks and applies the fork's."""
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(self.blockchain.chain[:1])
+        peer.new_transaction(MINT_ADDRESS, 'carol', 7)
+        peer.create_block(proof=1)
+        peer.create_block(proof=2)
+        self.blockchain.new_transaction('alice', 'bob', 5)
+
+        self.assertTrue(self.blockchain.replace_chain(peer.get_chain()))
+        self.assertEqual(self.blockchain.get_balance('alice'), 0)
+        self.assertEqual(self.blockchain.get_balance('carol'), 7)
+        # The abandoned mint transaction returns to the mempool
+        self.assertIn({'sender': MINT_ADDRESS, 'recipient': 'alice', 'amount': 50}, self.blockchain.current_transactions)
+
+    def test_chain_with_overdraft_rejected(self):
+        """Test that a longer chain spending money nobody has is not adopted."""
+        chain = self.blockchain.get_chain()
+        forged = Block(3, 0.0, [Transaction('bob', 'mallory', 1000)], 3, self.blockchain.last_block.hash)
+        chain.append(forged.to_dict())
+        self.assertTrue(self.blockchain.valid_chain(chain, incremental=True))
+        self.assertFalse(self.blockchain.replace_chain(chain))
+        self.assertEqual(len(self.blockchain.chain), 2)
+        self.assertEqual(self.blockchain.get_balance('alice'), 50)
+
+
+def child(parent, *transactions, proof=0):
+    return Block(parent.index + 1, 0.0, transactions, proof, parent.hash)
+
+
+class TestBlockTree(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = UncheckedProofBlockchain()
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', 50)
+        self.blockchain.create_block(proof=1)
+        self.fork_point = self.blockchain.last_block
+
+    def test_extends_tip(self):
+        """Test that a block on our tip extends the chain and applies its transactions."""
+        block = child(self.fork_point, Transaction('alice', 'bob', 20, {'nonce': 0}))
+        self.assertEqual(self.blockchain.add_block(block.to_dict()), 'extended')
+        self.assertEqual(self.blockchain.last_block.hash, block.hash)
+        self.assertEqual(self.blockchain.get_balance('bob'), 20)
+        self.assertEqual(self.blockchain.add_block(block), 'duplicate')
+
+    def test_side_branch_then_reorganization(self):
+        """Test that a lighter branch is kept and adopted once it has more work than our chain."""
+        ours = self.blockchain.create_block(proof=2)
+        side = child(self.fork_point, Transaction(MINT_ADDRESS, 'carol', 7), proof=5)
+        self.assertEqual(self.blockchain.add_block(side), 'side')  # Equal work: the first seen wins
+        self.assertEqual(self.blockchain.last_block.hash, ours.hash)
+
+        self.assertEqual(self.blockchain.add_block(child(side, proof=6)), 'reorganized')
+        self.assertEqual([block.hash for block in self.blockchain.chain[2:3]], [side.hash])
+        self.assertEqual(self.blockchain.get_balance('carol'), 7)
+        self.assertIn(ours.hash, self.blockchain.tree.side)  # The abandoned block stays in the tree
+
+        # Extending the abandoned block switches back
+        self.assertEqual(self.blockchain.add_block(child(child(ours, proof=7), proof=8)), 'orphan')
+        self.assertEqual(self.blockchain.add_block(child(ours, proof=7)), 'reorganized')
+        self.assertEqual(len(self.blockchain.chain), 5)
+        self.assertEqual(self.blockchain.chain[2].hash, ours.hash)
+        self.assertEqual(self.blockchain.get_balance('carol'), 0)
+
+    def test_orphans_connect_when_parent_arrives(self):
+        """Test that orphans are connected in order once their missing parent is added."""
+        blocks = [child(self.fork_point, Transaction(MINT_ADDRESS, 'dave', 1))]
+        for proof in range(3):
+            payment = Transaction('dave', 'erin', (proof + 1) / 10, {'nonce': proof})
+            blocks.append(child(blocks[-1], payment, proof=proof))
+        for block in reversed(blocks[1:]):
+            self.assertEqual(self.blockchain.add_block(block), 'orphan')
+        self.assertEqual(len(self.blockchain.tree.orphans), 3)
+
+        self.assertEqual(self.blockchain.add_block(blocks[0]), 'extended')
+        self.assertEqual(self.blockchain.last_block.hash, blocks[-1].hash)
+        self.assertEqual(len(self.blockchain.tree.orphans), 0)
+        self.assertEqual(self.blockchain.find_transaction(blocks[-1].transactions[0].id)['block_index'], 6)
+
+    def test_deep_side_branches_are_evicted(self):
+        """Test that side blocks falling max_depth below the tip are dropped with their descendants."""
+        self.blockchain.tree.max_depth = 5
+        for proof in range(2):
+            self.blockchain.create_block(proof=proof)
+        deep = child(self.fork_point, proof=3)
+        self.assertEqual(self.blockchain.add_block(deep), 'side')
+        self.assertEqual(self.blockchain.add_block(child(deep, proof=4)), 'side')
+        for proof in range(2):
+            self.blockchain.create_block(proof=proof)
+        recent = child(self.blockchain.chain[-2], proof=5)
+        self.assertEqual(self.blockchain.add_block(recent), 'side')
+        self.assertEqual(len(self.blockchain.tree.side), 3)
+
+        self.blockchain.create_block(proof=6)
+        self.assertEqual(len(self.blockchain.tree.side), 3)
+        self.blockchain.create_block(proof=7)  # Height 3 is now 5 below the tip, and goes with its child
+        self.assertEqual(list(self.blockchain.tree.side), [recent.hash])
+
+    def test_eviction_after_reorganization(self):
+        """Test that a side child of a block adopted by a reorganization is evicted at its own height."""
+        self.blockchain.tree.max_depth = 5
+        ours = self.blockchain.create_block(proof=2)
+        adopted = child(self.fork_point, proof=3)
+        self.assertEqual(self.blockchain.add_block(adopted), 'side')
+        self.assertEqual(self.blockchain.add_block(child(adopted, proof=4)), 'reorganized')
+        sibling = child(adopted, proof=5)
+        self.assertEqual(self.blockchain.add_block(sibling), 'side')
+
+        while len(self.blockchain.chain) < 8:
+            self.blockchain.create_block(proof=6)
+        self.assertEqual(list(self.blockchain.tree.side), [sibling.hash])  # Height 3 went, height 4 stays
+        self.assertNotIn(ours.hash, self.blockchain.tree.side)
+        self.blockchain.create_block(proof=7)
+        self.assertEqual(self.blockchain.tree.side, {})
+
+    def test_fork_below_retention_window(self):
+        """Test that a heavier branch forking below the retention window is dropped with its own error."""
+        blockchain = UncheckedProofBlockchain(retention=2)
+        for proof in range(3):
+            blockchain.create_block(proof=proof)
+        branch = [child(blockchain.chain[0], proof=10)]
+        for proof in range(11, 14):
+            branch.append(child(branch[-1], proof=proof))
+        for block in branch[:-1]:
+            self.assertEqual(blockchain.add_block(block), 'side')
+        with self.assertRaisesRegex(ValueError, 'below the retention window'):
+            blockchain.add_block(branch[-1])
+        self.assertEqual(blockchain.tree.side, {})
+        self.assertEqual(len(blockchain.chain), 4)
+
+    def test_orphan_at_wrong_height(self):
+        """Test that an orphan whose height does not follow its parent's cannot strand the parent."""
+        parent = child(self.fork_point, proof=3)
+        stray = Block(999, 0.0, [], 4, parent.hash)
+        self.assertEqual(self.blockchain.add_block(stray), 'orphan')
+        self.assertEqual(self.blockchain.add_block(parent), 'extended')
+        self.assertEqual(self.blockchain.last_block.hash, parent.hash)
+        self.assertEqual(len(self.blockchain.tree.orphans), 0)
+
+        side = child(self.fork_point, proof=5)
+        self.assertEqual(self.blockchain.add_block(side), 'side')
+        for block in (Block(999, 0.0, [], 6, side.hash), Block(1, 0.0, [], 7, 'unknown')):
+            with self.assertRaises(ValueError):
+                self.blockchain.add_block(block)
+
+    def test_reorganization_touches_only_the_branch(self):
+        """Test that a reorganization reverts and applies only the blocks after the fork point."""
+        for proof in range(50):
+            self.blockchain.create_block(proof=proof)
+        fork_point = self.blockchain.chain[-3]
+        branch = [child(fork_point, proof=100)]
+        for proof in range(101, 104):
+            branch.append(child(branch[-1], proof=proof))
+
+        applied, reverted = [], []
+        apply_block, revert_block = self.blockchain._apply_block, self.blockchain._revert_block
+        self.blockchain._apply_block = lambda block, check=False: (applied.append(block), apply_block(block, check))
+        self.blockchain._revert_block = lambda block: (reverted.append(block), revert_block(block))
+        statuses = [self.blockchain.add_block(block) for block in branch]
+        self.assertEqual(statuses, ['side', 'side', 'reorganized', 'extended'])
+        self.assertEqual((len(reverted), len(applied)), (2, 4))
+
+    def test_snapshots_survive_reorganization(self):
+        """Test that a chain truncated in place by a reorganization leaves older snapshots unchanged."""
+        ours = [self.blockchain.create_block(proof=proof) for proof in range(3)]
+        chain, main_work = self.blockchain._consistent_chain()
+        before, works = list(chain), list(main_work)
+        blocks = self.blockchain._blocks
+        branch = [child(self.fork_point, proof=10)]
+        for proof in range(11, 14):
+            branch.append(child(branch[-1], proof=proof))
+        statuses = [self.blockchain.add_block(block) for block in branch]
+        self.assertEqual(statuses, ['side', 'side', 'side', 'reorganized'])
+
+        self.assertIs(self.blockchain._blocks, blocks)  # Truncated and extended, not rebuilt
+        self.assertEqual(self.blockchain.chain[2:], branch)
+        self.assertEqual(list(chain), before)
+        self.assertEqual(chain[2:], ours)
+        self.assertEqual(chain[-1], ours[-1])
+        self.assertEqual(list(main_work), works)
+        self.assertEqual(main_work[1:], works[1:])
+
+    def test_invalid_blocks_rejected(self):
+        """Test that bad bodies raise and that a branch which overdraws is dropped."""
+        forged = child(self.fork_point, Transaction('alice', 'bob', 1))
+        forged.transactions = (Transaction('alice', 'bob', 2),)
+        with self.assertRaises(ValueError):
+            self.blockchain.add_block(forged)
+
+        overdraft = child(self.fork_point, Transaction('bob', 'mallory', 1000))
+        with self.assertRaises(ValueError):
+            self.blockchain.add_block(overdraft)
+        self.assertEqual(len(self.blockchain.chain), 2)
+        self.assertNotIn(overdraft.hash, self.blockchain.tree.side)
+
+    def test_replace_chain_compares_work(self):
+        """Test that replace_chain with longer_only keeps our chain when the other has no more work."""
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(self.blockchain.chain[:1])
+        peer.create_block(proof=9)
+        self.assertFalse(self.blockchain.replace_chain(peer.get_chain(), longer_only=True))
+        peer.create_block(proof=10)
+        self.assertTrue(self.blockchain.replace_chain(peer.get_chain(), longer_only=True))
+        self.assertIn(self.fork_point.hash, self.blockchain.tree.side)
+        self.assertEqual(self.blockchain.tree.tip_work, 3 * DEFAULT_WORK)
+
+
+class TestChainIndex(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = UncheckedProofBlockchain()
+        for i in range(5):
+            for j in range(3):
+                self.blockchain.new_transaction(MINT_ADDRESS, 'alice' if j else 'bob', i * 3 + j)
+            self.blockchain.create_block(proof=i)
+
+    def test_find_transaction(self):
+        """Test that transactions are found by id at their block and position."""
+        block = self.blockchain.chain[3]
+        transaction = block.transactions[1]
+        found = self.blockchain.find_transaction(transaction.id)
+        self.assertEqual((found['block_index'], found['position']), (4, 1))
+        self.assertEqual(found['transaction'], transaction.to_dict())
+        self.assertIsNone(self.blockchain.find_transaction('0' * 64))
+
+    def test_address_history_pages(self):
+        """Test that paging returns every transaction once, newest first, even while blocks are added."""
+        page, cursor = self.blockchain.get_address_history('alice', limit=4)
+        self.assertEqual([item['block_index'] for item in page], [6, 6, 5, 5])
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', 100)
+        self.blockchain.create_block(proof=9)
+
+        seen = page
+        while cursor is not None:
+            page, cursor = self.blockchain.get_address_history('alice', cursor=cursor, limit=4)
+            seen += page
+        self.assertEqual(len(seen), 10)
+        self.assertEqual(seen, sorted(seen, key=lambda item: (item['block_index'], item['position']), reverse=True))
+
+        oldest, _ = self.blockchain.get_address_history('bob', limit=2, newest_first=False)
+        self.assertEqual([item['transaction']['amount'] for item in oldest], [0, 3])
+
+    def test_index_follows_chain_replacement(self):
+        """Test that transactions of abandoned blocks leave the index."""
+        abandoned = self.blockchain.chain[-1].transactions[0]
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(self.blockchain.chain[:4])
+        peer.create_block(proof=1)
+        peer.create_block(proof=2)
+        peer.new_transaction(MINT_ADDRESS, 'carol', 1)
+        peer.create_block(proof=3)
+        self.assertTrue(self.blockchain.replace_chain(peer.get_chain()))
+        self.assertIsNone(self.blockchain.find_transaction(abandoned.id))
+        self.assertEqual(len(self.blockchain.get_address_history('alice', limit=100)[0]), 6)
+        self.assertEqual(self.blockchain.find_transaction(peer.chain[-1].transactions[0].id)['block_index'], 7)
+
+
+class TestEncoding(unittest.TestCase):
+    def test_dict_round_trip(self):
+        """Test that blocks convert to and from the dict shape without loss."""
+        block = {
+            'index': 2,
+            'timestamp': 1700000000.123456,
+            'transactions': [
+                {'sender': 'alice', 'recipient': 'bob', 'amount': 5},
+                {'sender': 'bob', 'recipient': 'carol', 'amount': 2.5, 'memo': ['a', None, True]},
+            ],
+            'proof': 35293,
+            'previous_hash': 'ab' * 32,
+        }
+        block['merkle_root'] = Block.from_dict(block).merkle_root
+        self.assertEqual(Block.from_dict(block).to_dict(), block)
+        self.assertEqual(Block.decode(Block.from_dict(block).encode()).to_dict(), block)
+        self.assertEqual(Transaction.from_dict(block['transactions'][1])['memo'], ['a', None, True])
+
+    def test_encoding_is_canonical(self):
+        """Test that key order does not change the encoding, but value types do."""
+        a = Transaction.from_dict({'sender': 'a', 'recipient': 'b', 'amount': 1, 'x': 1, 'y': 2})
+        b = Transaction.from_dict({'y': 2, 'x': 1, 'amount': 1, 'recipient': 'b', 'sender': 'a'})
+        c = Transaction.from_dict({'sender': 'a', 'recipient': 'b', 'amount': 1.0, 'x': 1, 'y': 2})
+        self.assertEqual(a.encode(), b.encode())
+        self.assertNotEqual(a.encode(), c.encode())
+
+    def test_chain_round_trip(self):
+        """Test that the binary chain format decodes to the same blocks."""
+        chain = build_chain(5).chain
+        self.assertEqual([block.hash for block in decode_chain(encode_chain(chain))],
+                         [block.hash for block in chain])
+
+
+class TestSnapshotsAndPruning(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def mine(self, blockchain, blocks):
+        for i in range(blocks):
+            height = len(blockchain.chain)
+            blockchain.new_transaction(MINT_ADDRESS, 'alice', height)
+            blockchain.new_transaction(MINT_ADDRESS, f'user{height}', 1 + i / 100)
+            blockchain.create_block(proof=height)
+        return blockchain
+
+    def test_snapshot_checksum(self):
+        """Test that snapshots round-trip and that any corruption is detected."""
+        blockchain = self.mine(UncheckedProofBlockchain(), 3)
+        data = encode_snapshot(4, blockchain.last_block, blockchain.accounts)
+        snapshot = decode_snapshot(data)
+        self.assertEqual((snapshot['height'], snapshot['tip'].hash), (4, blockchain.last_block.hash))
+        self.assertEqual(snapshot['balances'], blockchain.accounts.balances)
+        corrupted = bytearray(data)
+        corrupted[-3] ^= 1
+        with self.assertRaises(ValueError):
+            decode_snapshot(bytes(corrupted))
+        # A truncated payload with a matching checksum, as a faulty peer might serve
+        payload = data[len(SNAPSHOT_MAGIC) + 32:-3]
+        with self.assertRaises(ValueError):
+            decode_snapshot(SNAPSHOT_MAGIC + hashlib.sha256(payload).digest() + payload)
+
+    def test_periodic_snapshots(self):
+        """Test that snapshots are written every interval blocks and only the newest are kept."""
+        snapshots = SnapshotStore(self.directory, interval=4, keep=2)
+        blockchain = self.mine(UncheckedProofBlockchain(snapshots=snapshots), 11)
+        self.assertEqual(snapshots.heights(), [8, 12])
+        with open(os.path.join(self.directory, 'snapshot-0000000012.dat'), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        snapshot = snapshots.latest(blockchain.chain)  # The corrupted snapshot is skipped
+        self.assertEqual(snapshot['tip'].hash, blockchain.chain[7].hash)
+
+    def test_checkpoints(self):
+        """Test that blocks up to a checkpoint are trusted by hash, and nothing else is."""
+        chain = self.mine(UncheckedProofBlockchain(), 10).chain  # Proofs that a real node rejects
+        self.assertFalse(Blockchain().valid_chain(chain))
+        trusting = Blockchain(checkpoints={11: chain[10].hash})
+        self.assertTrue(trusting.valid_chain(chain))
+        self.assertTrue(trusting.valid_chain([block.header_only() for block in chain[:10]] + chain[10:]))
+        self.assertFalse(Blockchain(checkpoints={9: chain[8].hash}).valid_chain(chain))
+        self.assertFalse(Blockchain(checkpoints={11: chain[9].hash}).valid_chain(chain))
+
+    def test_pruning(self):
+        """Test that only the retention window keeps transactions and that deeper reorganizations are refused."""
+        blockchain = self.mine(UncheckedProofBlockchain(retention=5), 20)
+        self.assertEqual(blockchain.pruned_height, 16)
+        self.assertEqual([block.has_body for block in blockchain.chain], [False] * 16 + [True] * 5)
+        self.assertEqual(blockchain.get_balance('user3'), 1.02)
+        self.assertIsNone(blockchain.find_transaction(Blockchain.make_transaction(MINT_ADDRESS, 'user3', 1.02).id))
+        self.assertEqual(blockchain.find_transaction(blockchain.chain[18].transactions[0].id)['block_index'], 19)
+        history, _ = blockchain.get_address_history('alice', limit=100)
+        self.assertEqual({entry['block_index'] for entry in history}, set(range(17, 22)))
+
+        fork = UncheckedProofBlockchain()
+        fork.chain = list(blockchain.chain[:10])
+        for proof in range(15):
+            fork.create_block(proof=proof)
+        self.assertFalse(blockchain.replace_chain(fork.chain))
+        self.assertEqual(len(blockchain.chain), 21)
+
+    def test_restart_from_snapshot(self):
+        """Test that a pruning node restarts from its snapshot and keeps its state."""
+        def open_chain():
+            store = BlockStore(os.path.join(self.directory, 'blocks'))
+            self.addCleanup(store.close)
+            snapshots = SnapshotStore(os.path.join(self.directory, 'snapshots'), interval=8)
+            return UncheckedProofBlockchain(store=store, retention=4, snapshots=snapshots)
+
+        blockchain = self.mine(open_chain(), 20)
+        balances = dict(blockchain.accounts.balances)
+        blockchain.store.close()
+
+        reopened = open_chain()
+        self.assertEqual(reopened.accounts.balances, balances)
+        self.assertEqual(reopened.pruned_height, 17)
+        self.assertEqual(reopened.find_transaction(blockchain.chain[19].transactions[1].id)['block_index'], 20)
+        self.mine(reopened, 1)
+        self.assertEqual(reopened.get_balance('user21'), 1.0)
+
+    def test_restore_snapshot(self):
+        """Test that a node starts from a snapshot at a checkpoint, with headers only below it."""
+        source = self.mine(UncheckedProofBlockchain(), 12)
+        snapshot = decode_snapshot(encode_snapshot(13, source.last_block, source.accounts))
+        headers = [block.header_only() for block in source.chain]
+
+        with self.assertRaises(ValueError):
+            UncheckedProofBlockchain().restore_snapshot(snapshot, headers)
+        with self.assertRaises(ValueError):  # A block checkpoint alone does not vouch for the state
+            UncheckedProofBlockchain(checkpoints={13: source.last_block.hash}).restore_snapshot(snapshot, headers)
+        blockchain = UncheckedProofBlockchain(checkpoints={13: (source.last_block.hash, source.accounts.digest())})
+        forged = dict(snapshot, balances={**snapshot['balances'], 'mallory': 10 ** 9})
+        with self.assertRaisesRegex(ValueError, 'does not match the state checkpoint'):
+            blockchain.restore_snapshot(forged, headers)
+        self.assertEqual(blockchain.get_balance('mallory'), 0)
+        blockchain.restore_snapshot(snapshot, headers)
+        self.assertEqual(blockchain.accounts.balances, source.accounts.balances)
+        self.assertEqual(blockchain.get_tip(), source.get_tip())
+        self.mine(source, 2)
+        self.assertTrue(blockchain.replace_chain(source.get_chain()))
+        self.assertEqual(blockchain.accounts.balances, source.accounts.balances)
+
+    def test_restart_after_restore(self):
+        """Test that a persisted node restores a snapshot only with a SnapshotStore, and restarts from it."""
+        source = self.mine(UncheckedProofBlockchain(), 12)
+        snapshot = decode_snapshot(encode_snapshot(13, source.last_block, source.accounts))
+        headers = [block.header_only() for block in source.chain]
+        checkpoints = {13: (source.last_block.hash, source.accounts.digest())}
+        blocks_directory = os.path.join(self.directory, 'blocks')
+        snapshots_directory = os.path.join(self.directory, 'snapshots')
+
+        store = BlockStore(blocks_directory)
+        blockchain = self.mine(UncheckedProofBlockchain(store=store, checkpoints=checkpoints), 2)
+        with self.assertRaises(ValueError):
+            blockchain.restore_snapshot(snapshot, headers)
+        store.close()
+        store = BlockStore(blocks_directory)
+        self.assertEqual(len(UncheckedProofBlockchain(store=store, checkpoints=checkpoints).chain), 3)
+        store.close()
+
+        store, snapshots = BlockStore(blocks_directory), SnapshotStore(snapshots_directory)
+        UncheckedProofBlockchain(store=store, checkpoints=checkpoints, snapshots=snapshots).restore_snapshot(
+            snapshot, headers)
+        store.close()
+        store = BlockStore(blocks_directory)
+        reopened = UncheckedProofBlockchain(store=store, checkpoints=checkpoints, snapshots=snapshots)
+        self.assertEqual(reopened.accounts.balances, source.accounts.balances)
+        self.assertEqual(reopened.get_tip(), source.get_tip())
+        store.close()
+
+        shutil.rmtree(snapshots_directory)
+        store = BlockStore(blocks_directory)
+        self.addCleanup(store.close)
+        with self.assertRaises(ValueError):
+            UncheckedProofBlockchain(store=store, snapshots=SnapshotStore(snapshots_directory))
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlockStore(self.directory, segment_size=4096)
+        self.blockchain = UncheckedProofBlockchain(store=self.store)
+        self.errors = []
+        self.reorganizations = 0
+        self.mined = 0
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def run_thread(self, target):
+        def run():
+            try:
+                while not self.stop.is_set():
+                    target()
+            except Exception as e:  # Reported by the test thread
+                self.errors.append(e)
+                self.stop.set()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def check_snapshot(self):
+        chain = self.blockchain.chain
+        assert len(chain) >= 1, 'empty chain'
+        for height in range(1, len(chain)):
+            assert chain[height].index == height + 1, f'index gap at {height}'
+            assert chain[height].previous_hash == chain[height - 1].hash, f'broken link at {height}'
+        assert chain[-1] is chain.tip
+        assert chain[len(chain) // 2].valid_body(), 'body does not match its header'
+
+    def mine(self):
+        self.mined += 1
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', self.mined)
+        try:
+            self.blockchain.new_transaction('alice', 'bob', 1, fee=self.mined)
+        except ValueError:
+            pass  # Not funded yet
+        self.blockchain.create_block(proof=0)
+        time.sleep(0.001)  # Leave the reorganizing thread a chance to catch up
+
+    def reorganize(self):
+        chain = self.blockchain.chain
+        fork = UncheckedProofBlockchain()
+        fork.replace_chain(chain[:max(1, len(chain) - 3)])
+        for i in range(10):
+            fork.new_transaction(MINT_ADDRESS, 'carol', i + 1)
+            fork.create_block(proof=i)
+        if self.blockchain.replace_chain(fork.chain, longer_only=True):
+            self.reorganizations += 1
+
+    def test_readers_never_see_torn_chain(self):
+        """Test that readers racing with miners and reorganizations only ever see whole chains."""
+        threads = [self.run_thread(self.check_snapshot) for _ in range(4)]
+        threads += [self.run_thread(self.mine), self.run_thread(self.reorganize)]
+        threads.append(self.run_thread(lambda: self.blockchain.get_chain(max(0, len(self.blockchain.chain) - 5))))
+        time.sleep(2)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+        self.assertGreater(self.reorganizations, 0)
+
+        self.check_snapshot()
+        rebuilt = UncheckedProofBlockchain()
+        rebuilt.replace_chain(self.blockchain.get_chain())
+        self.assertEqual(self.blockchain.accounts.balances, rebuilt.accounts.balances)
+        self.assertEqual(self.blockchain.get_chain(), [block.to_dict() for block in self.store.load_headers()])
+
+
+def timed_history(intervals, work=16):
+    """(timestamp, cumulative work) of blocks of the same work found at the given intervals."""
+    history, now, total = [], 0.0, 0
+    for interval in intervals:
+        now += interval
+        total += work
+        history.append((now, total))
+    return history
+
+
+class TestDifficultyRetarget(unittest.TestCase):
+    def setUp(self):
+        self.retarget = DifficultyRetarget(target_interval=10, window=4, initial_work=16, median_span=3)
+
+    def test_next_work(self):
+        """Test that work follows the block interval within max_adjustment per block, after a warm-up."""
+        self.assertEqual(self.retarget.next_work(timed_history([1] * 4)), 16)  # Not a full window yet
+        self.assertEqual(self.retarget.next_work(timed_history([10] * 5)), 16)
+        self.assertEqual(self.retarget.next_work(timed_history([5] * 5)), 32)
+        self.assertEqual(self.retarget.next_work(timed_history([0.1] * 5)), 64)  # Clamped to 4 times the parent
+        self.assertEqual(self.retarget.next_work(timed_history([1000] * 5)), 16)  # min_work
+
+    def test_converges_after_hash_rate_change(self):
+        """Test that block intervals return to the target after the hash rate grows eightfold."""
+        hash_rate = 8 * 16 / 10
+        history = timed_history([10] * 5)
+        for _ in range(40):
+            work = self.retarget.next_work(history)
+            history.append((history[-1][0] + work / hash_rate, history[-1][1] + work))
+        self.assertAlmostEqual(history[-1][0] - history[-2][0], 10, delta=0.5)
+        self.assertAlmostEqual(self.retarget.hash_rate(history[-5:]), hash_rate)
+
+    def test_valid_timestamp(self):
+        """Test that a timestamp must pass the median of the recent blocks and not run ahead of our clock."""
+        history = timed_history([10, 10, 10, 10])
+        self.assertFalse(self.retarget.valid_timestamp(history, 30))
+        self.assertTrue(self.retarget.valid_timestamp(history, 31))
+        self.assertFalse(self.retarget.valid_timestamp(history, 300, now=100))
+        self.assertTrue(self.retarget.valid_timestamp(history, 200, now=100))
+
+    def test_telemetry(self):
+        """Test the hash rate estimate and the block interval histogram."""
+        self.assertEqual(self.retarget.hash_rate(timed_history([5] * 5)), 3.2)
+        self.assertIsNone(self.retarget.hash_rate(timed_history([5])))
+        histogram = self.retarget.interval_histogram([0, 2, 5, 15, 100])
+        self.assertEqual([bucket['le'] for bucket in histogram], [2.5, 5, 10, 20, 40, None])
+        self.assertEqual([bucket['count'] for bucket in histogram], [1, 1, 1, 0, 0, 1])
+
+    def test_retargeting_chain(self):
+        """Test that a retargeting chain raises its difficulty, counts it for fork choice and enforces it."""
+        blockchain = Blockchain(retarget=DifficultyRetarget(target_interval=3600, window=2, initial_work=16))
+        for _ in range(5):
+            blockchain.create_block(blockchain.proof_of_work(blockchain.last_block.proof))
+        self.assertEqual(blockchain.tree.tip_work, 3 * 16 + 64 + 256 + 1024)
+        self.assertEqual(blockchain.next_work(), 4096)
+        self.assertTrue(blockchain.valid_chain(blockchain.get_chain()))
+
+        last = blockchain.last_block
+        weak = next(proof for proof in range(100000) if Blockchain.valid_proof(last.proof, proof, 16)
+                    and not Blockchain.valid_proof(last.proof, proof, 4096))
+        with self.assertRaises(ValueError):
+            blockchain.add_block(Block(last.index + 1, time.time(), [], weak, last.hash))
+        proof = blockchain.proof_of_work(last.proof)
+        with self.assertRaises(ValueError):
+            blockchain.add_block(Block(last.index + 1, blockchain.chain[2].timestamp, [], proof, last.hash))
+        self.assertEqual(blockchain.add_block(Block(last.index + 1, time.time(), [], proof, last.hash)), 'extended')
+        self.assertEqual(blockchain.tree.tip_work, 3 * 16 + 64 + 256 + 1024 + 4096)
+
+        stats = blockchain.mining_stats()
+        self.assertEqual((stats['height'], stats['next_work'], stats['target_interval']), (7, 16384, 3600))
+        self.assertEqual(sum(bucket['count'] for bucket in stats['intervals']), 6)
+        self.assertGreater(stats['hash_rate'], 0)
+
+    def test_fixed_difficulty_stats(self):
+        """Test that without retargeting every block takes DEFAULT_WORK and stats still report the hash rate."""
+        blockchain = build_chain(30)
+        stats = blockchain.mining_stats(window=10)
+        self.assertEqual((stats['next_work'], stats['target_interval']), (DEFAULT_WORK, None))
+        self.assertEqual(sum(bucket['count'] for bucket in stats['intervals']), 10)
+        self.assertEqual(blockchain.tree.tip_work, 30 * DEFAULT_WORK)
+
+
+if __name__ == '__main__':
+    unittest.main()
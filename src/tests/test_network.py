@@ -0,0 +1,656 @@
+import asyncio
+import gzip
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import requests
+from werkzeug.serving import make_server
+from core.account_state import MINT_ADDRESS, AccountState
+from core.admission import Overloaded, WorkQueue
+from core.async_network import ASGIServer, AsyncNetwork
+from core.blockchain import Blockchain
+from core.difficulty import DEFAULT_WORK, DifficultyRetarget
+from core.encoding import Block
+from core.encoding import decode_chain
+from core.gossip import GossipEngine
+from core.network import Network
+from core.peers import NEXT_CURSOR_HEADER, PeerClient
+from core.state_snapshot import SnapshotStore, decode_snapshot
+from core.sync import BlockSubscriber, HeaderSync
+
+
+class UncheckedProofBlockchain(Blockchain):
+    @staticmethod
+    def valid_proof(last_proof, proof, work=None):
+        return True
+
+
+class NodeServer:
+    """Serves a Network's Flask app on an ephemeral local port."""
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.network = Network(blockchain)
+        self.server = make_server('127.0.0.1', 0, self.network.app, threaded=True)
+        self.address = f'127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class AsyncNodeServer:
+    """Serves an AsyncNetwork with the bundled ASGI server, from an event loop in a thread."""
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.network = AsyncNetwork(blockchain, sync_interval=3600)
+        self.server = ASGIServer(self.network)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        self.address = f'127.0.0.1:{self.server.port}'
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def extend(blockchain, blocks):
+    for i in range(blocks):
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', len(blockchain.chain) * 100 + i)
+        blockchain.create_block(proof=i)
+    return blockchain
+
+
+class TestResolveConflicts(unittest.TestCase):
+    def setUp(self):
+        self.ours = extend(UncheckedProofBlockchain(), 3)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def serve(self, blockchain):
+        server = NodeServer(blockchain)
+        self.servers.append(server)
+        self.ours.register_node(f'http://{server.address}')
+        return server
+
+    def fork(self, blocks):
+        peer = UncheckedProofBlockchain()
+        peer.replace_chain(self.ours.get_chain())
+        return extend(peer, blocks)
+
+    def test_adopts_longest_valid_chain(self):
+        """Test that the longest peer chain is adopted and shorter ones are skipped."""
+        self.serve(self.fork(2))
+        longest = self.serve(self.fork(5))
+        self.serve(UncheckedProofBlockchain())
+        self.assertTrue(self.ours.resolve_conflicts())
+        self.assertEqual(self.ours.get_chain(), longest.blockchain.get_chain())
+        self.assertEqual(set(self.ours.peer_client.latencies), self.ours.nodes)
+        self.assertFalse(self.ours.resolve_conflicts())
+
+    def test_falls_back_when_longest_chain_is_invalid(self):
+        """Test that an invalid longest chain does not stop a valid shorter one from being adopted."""
+        valid = self.serve(self.fork(2))
+        invalid = self.fork(4)
+        chain = list(invalid.chain)
+        chain[5] = chain[5].header_only()
+        chain[5].transactions = ()
+        invalid.chain = chain
+        self.serve(invalid)
+        self.assertTrue(self.ours.resolve_conflicts())
+        self.assertEqual(self.ours.get_chain(), valid.blockchain.get_chain())
+
+    def test_slow_peer_times_out(self):
+        """Test that a peer that never answers only costs the per-peer timeout."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        self.addCleanup(listener.close)
+        self.ours.register_node(f'http://127.0.0.1:{listener.getsockname()[1]}')
+        self.serve(self.fork(1))
+        self.ours.peer_client = PeerClient(timeout=(1, 0.5))
+
+        start = time.perf_counter()
+        self.assertTrue(self.ours.resolve_conflicts())
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(len(self.ours.peer_client.errors), 1)
+
+
+class TestHeaderSync(unittest.TestCase):
+    def setUp(self):
+        self.ours = extend(UncheckedProofBlockchain(), 20)
+        self.sync = HeaderSync(self.ours, PeerClient(), header_batch=4, block_batch=3)
+        self.servers = []
+
+    def tearDown(self):
+        self.sync.client.close()
+        for server in self.servers:
+            server.stop()
+
+    def serve(self, blockchain):
+        server = NodeServer(blockchain)
+        self.servers.append(server)
+        self.ours.register_node(f'http://{server.address}')
+        return server
+
+    def fork(self, height, blocks):
+        peer = UncheckedProofBlockchain()
+        peer.replace_chain(self.ours.get_chain(0, height))
+        return extend(peer, blocks)
+
+    def test_extends_tip(self):
+        """Test that a peer ahead of us costs one hash lookup and only the missing blocks."""
+        peer = self.serve(self.fork(21, 5))
+        self.assertEqual(self.sync.find_fork_point(peer.address, 26), 21)
+        self.assertTrue(self.sync.sync())
+        self.assertEqual(self.ours.get_chain(), peer.blockchain.get_chain())
+
+    def test_finds_fork_point(self):
+        """Test that the common ancestor is found by binary search and the branch is switched."""
+        peer = self.serve(self.fork(13, 10))
+        self.assertEqual(self.sync.find_fork_point(peer.address, 23), 13)
+        self.assertTrue(self.sync.sync_with(peer.address))
+        self.assertEqual(self.ours.get_chain(), peer.blockchain.get_chain())
+        self.assertEqual(self.ours.get_balance('alice'), peer.blockchain.get_balance('alice'))
+
+    def test_unrelated_chain(self):
+        """Test that a chain with a different genesis block forks at height 0."""
+        peer = self.serve(extend(UncheckedProofBlockchain(), 25))
+        self.assertEqual(self.sync.find_fork_point(peer.address, 26), 0)
+        self.assertTrue(self.sync.sync())
+        self.assertEqual(self.ours.get_chain(), peer.blockchain.get_chain())
+
+    def test_idle_rounds_cost_constant_bytes(self):
+        """Test that rounds against peers that are not ahead only exchange tips."""
+        peer = self.serve(self.fork(13, 3))
+        self.assertFalse(self.sync.sync())
+        before = self.sync.client.bytes_received[peer.address]
+        self.assertFalse(self.sync.sync())
+        idle = self.sync.client.bytes_received[peer.address] - before
+        extend(self.ours, 50)
+        self.assertFalse(self.sync.sync())
+        self.assertEqual(self.sync.client.bytes_received[peer.address] - before, 2 * idle)
+
+    def test_heavier_shorter_chain(self):
+        """Test that a shorter chain with more work is synced, followed and resolved to."""
+        def retarget():
+            return DifficultyRetarget(target_interval=1, window=2, initial_work=16)
+
+        def slow_chain():
+            blockchain = UncheckedProofBlockchain(retarget=retarget())
+            for _ in range(10):  # Ten seconds apart: the work stays at its minimum
+                last = blockchain.last_block
+                blockchain.add_block(Block(last.index + 1, last.timestamp + 10, [], 0, last.hash))
+            return blockchain
+
+        peer = extend(UncheckedProofBlockchain(retarget=retarget()), 5)  # Fast blocks: fourfold work each
+        server = NodeServer(peer)
+        self.servers.append(server)
+        self.assertGreater(peer.tree.tip_work, slow_chain().tree.tip_work)
+
+        ours = slow_chain()
+        self.assertTrue(HeaderSync(ours, self.sync.client).sync_with(server.address))
+        self.assertEqual(ours.get_chain(), peer.get_chain())
+        ours = slow_chain()
+        self.assertTrue(BlockSubscriber(HeaderSync(ours, self.sync.client)).on_block(server.address, *peer.get_tip()))
+        self.assertEqual(ours.get_chain(), peer.get_chain())
+        ours = slow_chain()
+        ours.register_node(f'http://{server.address}')
+        ours.peer_client = self.sync.client
+        self.assertTrue(ours.resolve_conflicts())
+        self.assertEqual(ours.get_chain(), peer.get_chain())
+
+    def test_rejects_invalid_headers(self):
+        """Test that bad headers are rejected before any block body is downloaded."""
+        self.serve(self.fork(21, 3))
+        self.ours.valid_proof = Blockchain.valid_proof
+        self.assertFalse(self.sync.sync())
+        self.assertEqual(len(self.ours.chain), 21)
+
+    def test_bootstrap_from_snapshot(self):
+        """Test that a new node starts from a peer's snapshot at a checkpoint and syncs the blocks after it."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source = extend(UncheckedProofBlockchain(snapshots=SnapshotStore(directory, interval=10)), 25)
+        peer = self.serve(source)
+        self.assertEqual(source.snapshots.heights(), [10, 20])
+
+        state = decode_snapshot(source.snapshots.read(20))
+        digest = AccountState.restore(state['balances'], state['nonces']).digest()
+        new = UncheckedProofBlockchain(checkpoints={20: (source.chain[19].hash, digest)})
+        sync = HeaderSync(new, self.sync.client)
+        self.assertTrue(sync.bootstrap(peer.address))
+        self.assertEqual(new.get_tip(), source.get_tip())
+        self.assertEqual(new.accounts.balances, source.accounts.balances)
+        self.assertEqual((new.pruned_height, new.chain[19].has_body, new.chain[20].has_body), (20, False, True))
+        self.assertFalse(HeaderSync(UncheckedProofBlockchain(), self.sync.client).bootstrap(peer.address))
+
+    def test_block_ranges(self):
+        """Test the start and limit parameters of /chain and /headers."""
+        peer = self.serve(self.ours)
+        blocks = self.sync.client.fetch_blocks(peer.address, 5, 3)
+        headers = self.sync.client.fetch_headers(peer.address, 5, 3)
+        self.assertEqual([block.to_dict() for block in blocks], self.ours.get_chain(5, 8))
+        self.assertEqual([header.header() for header in headers], self.ours.get_headers(5, 8))
+        self.assertFalse(any(header.has_body for header in headers))
+        self.assertIsNone(self.sync.client.fetch_block_hash(peer.address, 22))
+
+
+class TestChainEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = extend(UncheckedProofBlockchain(), 150)
+        self.client = Network(self.blockchain).app.test_client()
+
+    def test_streams_full_chain(self):
+        """Test that the streamed JSON matches the chain and carries the tip hash as ETag."""
+        response = self.client.get('/chain')
+        self.assertTrue(response.is_streamed)
+        values = json.loads(response.get_data())
+        self.assertEqual(values['chain'], self.blockchain.get_chain())
+        self.assertEqual(values['length'], 151)
+        self.assertIsNone(values['next_cursor'])
+        self.assertEqual(response.headers['ETag'], f'W/"{self.blockchain.last_block.hash}"')
+
+    def test_cursor_pagination(self):
+        """Test that following next_cursor pages through the whole chain."""
+        blocks, cursor = [], None
+        while True:
+            query = {'limit': 40, 'cursor': cursor} if cursor else {'limit': 40}
+            values = self.client.get('/chain', query_string=query).get_json()
+            blocks.extend(values['chain'])
+            cursor = values['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(blocks, self.blockchain.get_chain())
+
+    def test_stale_cursor(self):
+        """Test that a cursor into a replaced branch is rejected."""
+        cursor = self.client.get('/chain?limit=100').get_json()['next_cursor']
+        fork = UncheckedProofBlockchain()
+        fork.replace_chain(self.blockchain.get_chain(0, 90))
+        self.blockchain.replace_chain(extend(fork, 80).get_chain())
+        self.assertEqual(self.client.get('/chain', query_string={'cursor': cursor}).status_code, 409)
+        self.assertEqual(self.client.get('/chain?cursor=x').status_code, 400)
+
+    def test_height_range_binary(self):
+        """Test a height range in the binary format."""
+        response = self.client.get('/chain?start=10&limit=5&format=binary')
+        self.assertEqual([block.to_dict() for block in decode_chain(response.get_data())],
+                         self.blockchain.get_chain(10, 15))
+        self.assertEqual(response.headers[NEXT_CURSOR_HEADER], f'15:{self.blockchain.chain[14].hash}')
+
+    def test_gzip(self):
+        """Test that the stream is gzip-compressed when the client accepts it."""
+        response = self.client.get('/chain', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.get_data()))['chain'], self.blockchain.get_chain())
+
+    def test_not_modified(self):
+        """Test that a matching ETag is answered with an empty 304 until a block is added."""
+        etag = self.client.get('/chain').headers['ETag']
+        response = self.client.get('/chain', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        extend(self.blockchain, 1)
+        self.assertEqual(self.client.get('/chain', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_new_block(self):
+        """Test that POST /blocks adds a peer's block to our chain or to the orphan pool."""
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(self.blockchain.chain)
+        blocks = [peer.create_block(proof=1).to_dict(), peer.create_block(proof=2).to_dict()]
+        self.assertEqual(self.client.post('/blocks', json=blocks[1]).get_json()['status'], 'orphan')
+        values = self.client.post('/blocks', json=blocks[0]).get_json()
+        self.assertEqual((values['status'], values['length'], values['hash']), ('extended', 153, peer.last_block.hash))
+        self.assertEqual(self.client.post('/blocks', json={'index': 1}).status_code, 400)
+
+    def test_mining_stats(self):
+        """Test that /mining/stats reports the difficulty and a histogram of the requested block intervals."""
+        stats = self.client.get('/mining/stats?window=50').get_json()
+        self.assertEqual((stats['height'], stats['next_work'], stats['target_interval']), (151, DEFAULT_WORK, None))
+        self.assertEqual(sum(bucket['count'] for bucket in stats['intervals']), 50)
+        self.assertEqual(self.client.get('/mining/stats?window=x').status_code, 400)
+
+
+class TestTransactionBatch(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = UncheckedProofBlockchain()
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', 100)
+        self.blockchain.create_block(proof=1)
+        self.client = Network(self.blockchain).app.test_client()
+
+    def test_per_item_results(self):
+        """Test that every transaction of a batch gets its own result, in order."""
+        batch = [
+            {'sender': 'alice', 'recipient': 'bob', 'amount': 60},
+            {'sender': 'alice', 'recipient': 'bob'},
+            {'sender': MINT_ADDRESS, 'recipient': 'bob', 'amount': 1},
+            {'sender': 'alice', 'recipient': 'carol', 'amount': 60},
+            {'sender': 'alice', 'recipient': 'carol', 'amount': 30, 'fee': 2},
+        ]
+        response = self.client.post('/transactions/batch', json={'transactions': batch})
+        self.assertEqual(response.status_code, 200)
+        values = response.get_json()
+        self.assertEqual([result['status'] for result in values['results']],
+                         ['accepted', 'rejected', 'rejected', 'rejected', 'accepted'])
+        self.assertEqual(values['accepted'], 2)
+        self.assertEqual(values['results'][0]['block_index'], 3)
+        self.assertEqual(len(self.blockchain.mempool), 2)
+
+    def test_rejects_malformed_batches(self):
+        """Test that a body that is not a list, or is too long, is rejected as a whole."""
+        self.assertEqual(self.client.post('/transactions/batch', json={'nodes': []}).status_code, 400)
+        too_many = [{'sender': 'alice', 'recipient': 'bob', 'amount': 0}] * 10001
+        self.assertEqual(self.client.post('/transactions/batch', json=too_many).status_code, 413)
+
+    def test_address_history_paging(self):
+        """Test that address history pages follow the cursor and a malformed cursor is rejected."""
+        for amount in range(1, 6):
+            self.blockchain.new_transaction('alice', 'bob', amount)
+            self.blockchain.create_block(proof=amount)
+        first = self.client.get('/accounts/bob/transactions?limit=3').get_json()
+        second = self.client.get('/accounts/bob/transactions', query_string={'cursor': first['next_cursor']})
+        amounts = [item['transaction']['amount'] for item in first['transactions'] + second.get_json()['transactions']]
+        self.assertEqual(amounts, [5, 4, 3, 2, 1])
+        self.assertEqual(self.client.get('/accounts/bob/transactions?cursor=x').status_code, 400)
+        self.assertEqual(self.client.get('/accounts/bob/transactions?limit=x').status_code, 400)
+
+
+class TestGossipEngine(unittest.TestCase):
+    def funded_node(self):
+        blockchain = UncheckedProofBlockchain()
+        blockchain.new_transaction(MINT_ADDRESS, 'alice', 10000)
+        blockchain.create_block(proof=1)
+        server = NodeServer(blockchain)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_coalesces_per_peer(self):
+        """Test that transactions published within one window reach each peer in a single batch."""
+        peers = [self.funded_node() for _ in range(2)]
+        gossip = GossipEngine({peer.address for peer in peers}, window=0.2)
+        for amount in range(50):
+            gossip.publish([Blockchain.make_transaction('alice', 'bob', amount)])
+        self.assertTrue(gossip.drain())
+        gossip.close()
+        metrics = gossip.metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        for peer in peers:
+            self.assertEqual(len(peer.blockchain.mempool), 50)
+            self.assertEqual(metrics['peers'][peer.address]['sent'], 50)
+            self.assertEqual(len(gossip.queues[peer.address].latencies), 1)
+
+    def test_bounded_fanout_and_seen_cache(self):
+        """Test that each transaction is queued for fanout peers, and only the first time it is seen."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        nodes = {f'127.0.0.1:{listener.getsockname()[1]}/{i}' for i in range(6)}
+        gossip = GossipEngine(nodes, PeerClient(timeout=(0.2, 0.2)), fanout=2, window=60)
+        transactions = [Blockchain.make_transaction('alice', 'bob', amount) for amount in range(30)]
+        self.assertEqual(gossip.publish(transactions), 30)
+        self.assertEqual(gossip.publish(transactions[:10]), 0)
+        self.assertEqual(gossip.queue_depth(), 60)
+        self.assertEqual(gossip.metrics()['seen'], 30)
+
+    def test_relays_without_reflooding(self):
+        """Test that a transaction submitted to one node spreads to its peer and stops there."""
+        first, second = self.funded_node(), self.funded_node()
+        first.blockchain.register_node(f'http://{second.address}')
+        second.blockchain.register_node(f'http://{first.address}')
+        values = {'sender': 'alice', 'recipient': 'bob', 'amount': 5}
+        response = first.network.app.test_client().post('/transactions/new', json=values)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(first.network.gossip.drain())
+        self.assertTrue(second.network.gossip.drain())
+        self.assertEqual(len(second.blockchain.mempool), 1)
+        metrics = first.network.app.test_client().get('/gossip/metrics').get_json()
+        self.assertEqual(metrics['peers'][second.address]['sent'], 1)
+        self.assertEqual(second.network.gossip.metrics()['peers'][first.address]['sent'], 1)
+        self.assertEqual(len(first.blockchain.mempool), 1)
+
+
+class TestBlockSubscriptions(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = extend(UncheckedProofBlockchain(), 5)
+        self.client = PeerClient(timeout=(3.05, 10))
+        self.addCleanup(self.client.close)
+
+    def add_block_later(self, blockchain, delay=0.2):
+        timer = threading.Timer(delay, extend, (blockchain, 1))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def check_server(self, node):
+        # Long-poll: answered as soon as the tip changes, or with the same tip when the wait is over
+        url = f'http://{node.address}/chain/tip'
+        known = self.blockchain.last_block.hash
+        self.assertEqual(requests.get(url, params={'known': known, 'wait': 0.1}).json()['hash'], known)
+        self.add_block_later(self.blockchain)
+        start = time.monotonic()
+        values = requests.get(url, params={'known': known, 'wait': 10}).json()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual((values['length'], values['hash']), self.blockchain.get_tip())
+        self.assertEqual(requests.get(url, params={'wait': 'x'}).status_code, 400)
+
+        # Server-sent events: the current tip, then every new one
+        events = self.client.iter_block_events(node.address)
+        self.assertEqual(next(events), self.blockchain.get_tip())
+        self.add_block_later(self.blockchain)
+        self.assertEqual(next(events), self.blockchain.get_tip())
+        events.close()
+
+    def test_flask_server(self):
+        """Test tip long-polls and the /blocks/events stream of the Flask app."""
+        node = NodeServer(self.blockchain)
+        self.addCleanup(node.stop)
+        self.check_server(node)
+
+    def test_async_server(self):
+        """Test tip long-polls and the /blocks/events stream of the async app."""
+        node = AsyncNodeServer(self.blockchain)
+        self.addCleanup(node.stop)
+        self.check_server(node)
+
+    def test_subscriber_syncs_on_announcement(self):
+        """Test that a follower syncs as soon as a peer announces a block, without polling."""
+        node = NodeServer(self.blockchain)
+        self.addCleanup(node.stop)
+        follower = UncheckedProofBlockchain()
+        follower.register_node(f'http://{node.address}')
+        subscriber = BlockSubscriber(HeaderSync(follower, self.client))
+        self.addCleanup(subscriber.close)
+        subscriber.start()
+
+        def wait_for(length):
+            deadline = time.monotonic() + 5
+            while len(follower.chain) < length and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        wait_for(6)  # Synced from the announcement of the current tip
+        extend(self.blockchain, 1)
+        wait_for(7)
+        self.assertEqual(follower.get_chain(), self.blockchain.get_chain())
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = UncheckedProofBlockchain()
+        self.blockchain.new_transaction(MINT_ADDRESS, 'alice', 100)
+        self.blockchain.create_block(proof=1)
+
+    def test_rate_limit_per_client_and_route(self):
+        """Test that a client is held to a route's rate after its burst, without affecting others."""
+        client = Network(self.blockchain, rate_limits={'new_transaction': (0.5, 3)}).app.test_client()
+        values = {'sender': 'alice', 'recipient': 'bob'}
+        statuses = [client.post('/transactions/new', json={**values, 'amount': i}).status_code for i in range(4)]
+        self.assertEqual(statuses, [201, 201, 201, 429])
+        response = client.post('/transactions/new', json={**values, 'amount': 9})
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual(client.post('/transactions/new', json={**values, 'amount': 5},
+                                     environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code, 201)
+        self.assertEqual(client.get('/chain/tip').status_code, 200)  # No limit for other routes
+
+    def test_async_rate_limit(self):
+        """Test that the async app rejects over-limit requests with 429."""
+        node = AsyncNodeServer(self.blockchain)
+        self.addCleanup(node.stop)
+        node.network.rate_limiter.limits = {None: (1, 2)}
+        statuses = [requests.get(f'http://{node.address}/chain/tip').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_work_queue_rejects_when_full(self):
+        """Test that the work queue rejects at once beyond its bound and shares keyed runs."""
+        queue = WorkQueue(max_workers=1, max_pending=2)
+        self.addCleanup(queue.close)
+        release = threading.Event()
+        first = queue.submit(release.wait, key='resolve')
+        self.assertIs(queue.submit(release.wait, key='resolve'), first)
+        queue.submit(release.wait)
+        with self.assertRaises(Overloaded):
+            queue.submit(release.wait)
+        release.set()
+        first.result(timeout=5)
+        queue.submit(lambda: None).result(timeout=5)
+        self.assertEqual((queue.coalesced, queue.rejected), (1, 1))
+
+    def test_concurrent_resolves_share_one_run(self):
+        """Test that concurrent /nodes/resolve requests are collapsed into one resolve_conflicts call."""
+        network = Network(self.blockchain, rate_limits={})
+        calls = []
+        release = threading.Event()
+
+        def resolve_conflicts():
+            calls.append(1)
+            release.wait(5)
+            return False
+
+        self.blockchain.resolve_conflicts = resolve_conflicts
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(network.app.test_client().get('/nodes/resolve')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while network.work_queue.coalesced < 4 and len(calls) < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+
+
+class TestAsyncNetwork(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = extend(UncheckedProofBlockchain(), 100)
+        self.node = AsyncNodeServer(self.blockchain)
+        self.session = requests.Session()
+        self.url = f'http://{self.node.address}'
+
+    def tearDown(self):
+        self.session.close()
+        self.node.stop()
+
+    def test_chain(self):
+        """Test that /chain streams the same chain and pages as the Flask app, gzipped over keep-alive."""
+        response = self.session.get(f'{self.url}/chain')
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.json()['chain'], self.blockchain.get_chain())
+        page = self.session.get(f'{self.url}/chain', params={'limit': 10, 'format': 'binary'})
+        self.assertEqual([block.to_dict() for block in decode_chain(page.content)], self.blockchain.get_chain(0, 10))
+        self.assertEqual(page.headers[NEXT_CURSOR_HEADER], f'10:{self.blockchain.chain[9].hash}')
+        etag = response.headers['ETag']
+        self.assertEqual(self.session.get(f'{self.url}/chain', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.session.get(f'{self.url}/chain/tip').json()['length'], 101)
+        self.assertEqual(self.session.get(f'{self.url}/blocks/101/hash').json()['hash'],
+                         self.blockchain.last_block.hash)
+        self.assertEqual(self.session.get(f'{self.url}/mining/stats').json()['height'], 101)
+        self.assertEqual(self.session.get(f'{self.url}/missing').status_code, 404)
+
+    def test_transactions(self):
+        """Test single and batch transaction submission."""
+        values = {'sender': 'alice', 'recipient': 'bob', 'amount': 5}
+        self.assertEqual(self.session.post(f'{self.url}/transactions/new', json=values).status_code, 201)
+        self.assertEqual(self.session.post(f'{self.url}/transactions/new', json={'sender': 'alice'}).status_code,
+                         400)
+        # The first repeats the payment above with its nonce, and so its id
+        batch = [{**values, 'nonce': 0}, {**values, 'amount': 6}]
+        results = self.session.post(f'{self.url}/transactions/batch', json=batch)
+        self.assertEqual([result['status'] for result in results.json()['results']], ['rejected', 'accepted'])
+        self.assertEqual(len(self.blockchain.mempool), 2)
+
+    def test_account_routes(self):
+        """Test the account, address history and transaction lookups."""
+        self.blockchain.new_transaction(MINT_ADDRESS, 'dave', 10)
+        block = self.blockchain.create_block(proof=1)
+        self.assertEqual(self.session.get(f'{self.url}/accounts/dave').json()['balance'], 10)
+        history = self.session.get(f'{self.url}/accounts/dave/transactions').json()['transactions']
+        self.assertEqual([item['block_index'] for item in history], [102])
+        self.assertEqual(self.session.get(f'{self.url}/accounts/dave/transactions?cursor=x').status_code, 400)
+        transaction_id = block.transactions[0].id
+        self.assertEqual(self.session.get(f'{self.url}/transactions/{transaction_id}').json()['block_index'], 102)
+        self.assertEqual(self.session.get(f'{self.url}/transactions/unknown').status_code, 404)
+
+    def test_writes_do_not_block_the_loop(self):
+        """Test that reads are served while a write waits for the chain lock."""
+        peer = UncheckedProofBlockchain()
+        peer.chain = list(self.blockchain.chain)
+        block = peer.create_block(proof=1).to_dict()
+        responses = []
+        with self.blockchain._lock:
+            writer = threading.Thread(target=lambda: responses.append(
+                requests.post(f'{self.url}/blocks', json=block, timeout=10)))
+            writer.start()
+            time.sleep(0.2)
+            self.assertEqual(self.session.get(f'{self.url}/chain/tip', timeout=2).json()['length'], 101)
+            self.assertEqual(responses, [])
+        writer.join()
+        self.assertEqual(responses[0].json()['status'], 'extended')
+
+    def test_idle_connections_closed(self):
+        """Test that a connection idle between requests or stalled within one is closed after the idle timeout."""
+        self.node.server.idle_timeout = 0.2
+        for sent in (b'', b'GET /chain/tip HTTP/1.1\r\n', b'GET /chain/tip HTTP/1.1\r\nHost: x\r\n\r\n'):
+            with socket.create_connection(('127.0.0.1', self.node.server.port), timeout=5) as client:
+                client.sendall(sent)
+                received = b''
+                while True:
+                    data = client.recv(65536)
+                    if not data:
+                        break
+                    received += data
+                self.assertEqual(received.startswith(b'HTTP/1.1 200'), bool(sent.endswith(b'\r\n\r\n')))
+        self.assertEqual(self.session.get(f'{self.url}/chain/tip').json()['length'], 101)
+
+    def test_register_and_resolve(self):
+        """Test that the async node adopts a longer chain from a Flask peer, which can sync back from it."""
+        peer = UncheckedProofBlockchain()
+        peer.replace_chain(self.blockchain.get_chain())
+        flask_node = NodeServer(extend(peer, 3))
+        self.addCleanup(flask_node.stop)
+        response = self.session.post(f'{self.url}/nodes/register', json={'nodes': [f'http://{flask_node.address}']})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(self.session.get(f'{self.url}/nodes/resolve').json()['replaced'])
+        self.assertEqual(self.blockchain.get_chain(), peer.get_chain())
+
+        extend(self.blockchain, 2)
+        sync = HeaderSync(peer, PeerClient())
+        self.addCleanup(sync.client.close)
+        self.assertTrue(sync.sync_with(self.node.address))
+        self.assertEqual(peer.get_chain(), self.blockchain.get_chain())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from core.simulator import (NetworkModel, PBFTSimulation, ProofOfStakeSimulation, ProofOfWorkSimulation,
+                            SimulatedNetwork, Simulator, VoteSimulation)
+
+
+class TestSimulatedNetwork(unittest.TestCase):
+    def setUp(self):
+        self.simulator = Simulator(seed=1)
+        self.received = []
+
+    def network(self, **kwargs):
+        network = SimulatedNetwork(self.simulator, NetworkModel(**kwargs))
+        for node in 'abc':
+            network.register(node, lambda sender, message, node=node: self.received.append(
+                (self.simulator.now, sender, node, message)))
+        return network
+
+    def test_event_order(self):
+        """Test that events run in time order, ties in scheduling order, and stop at until."""
+        order = []
+        for delay, name in ((2, 'late'), (1, 'first'), (1, 'second'), (5, 'never')):
+            self.simulator.schedule(delay, order.append, name)
+        self.assertEqual(self.simulator.run(until=3), 3)
+        self.assertEqual((order, self.simulator.now), (['first', 'second', 'late'], 3))
+
+    def test_bandwidth_and_crashes(self):
+        """Test that messages queue on the sender's uplink and are lost to a crashed node."""
+        network = self.network(latency=0.1, jitter=0, bandwidth=1000)
+        network.send('a', 'b', 'block', 1, size=1000)
+        network.send('a', 'c', 'block', 2, size=1000)
+        network.send('b', 'c', 'vote', 3, size=100)
+        network.crash('c', at=1.5)
+        self.simulator.run()
+        self.assertEqual([(round(at, 3), message) for at, _, _, message in self.received], [(0.2, 3), (1.1, 1)])
+        self.assertEqual((network.messages['block'], network.bytes, network.lost), (2, 2100, 1))
+
+    def test_loss(self):
+        """Test that lost messages never arrive, unless sent reliably, which only delays them."""
+        network = self.network(latency=0.1, jitter=0, loss=0.5, retransmit_timeout=1)
+        for message in range(200):
+            network.send('a', 'b', 'gossip', message)
+            network.send('a', 'c', 'pbft', message, reliable=True)
+        self.simulator.run()
+        gossip = [at for at, _, recipient, _ in self.received if recipient == 'b']
+        pbft = [at for at, _, recipient, _ in self.received if recipient == 'c']
+        self.assertAlmostEqual(len(gossip), 100, delta=25)
+        self.assertEqual(len(pbft), 200)
+        self.assertGreater(max(pbft), 1)
+        self.assertEqual(network.lost, 200 - len(gossip) + round(sum(pbft) - 0.1 * 200))
+
+
+class TestConsensusSimulations(unittest.TestCase):
+    model = NetworkModel(latency=0.05, jitter=0.05, bandwidth=12.5e6, loss=0.01)
+
+    def test_proof_of_work(self):
+        """Test that Proof of Work finds about one block per interval and withheld blocks stay off the chain."""
+        report = ProofOfWorkSimulation(200, model=self.model, block_interval=10, confirmations=3).run(1000)
+        self.assertAlmostEqual(report['blocks'] / (1 - report['stale_rate']), 100, delta=30)
+        self.assertGreater(report['finality_p50'], 10)
+
+        simulation = ProofOfWorkSimulation(200, model=self.model, byzantine=range(100))
+        report = simulation.run(1000)
+        self.assertTrue(all(block.producer >= 100 for block in simulation.main_chain()))
+        self.assertAlmostEqual(report['blocks'], 50, delta=20)
+
+    def test_proof_of_stake(self):
+        """Test that slots of crashed or Byzantine leaders stay empty."""
+        simulation = ProofOfStakeSimulation(100, model=self.model, slot_time=2, byzantine=range(25))
+        for node in range(25, 50):
+            simulation.network.crash(node)
+        report = simulation.run(400)
+        self.assertAlmostEqual(report['missed_slots'], 100, delta=25)
+        self.assertEqual(len(simulation.blocks), 200 - report['missed_slots'])
+        self.assertTrue(all(block.producer >= 50 for block in simulation.blocks))
+
+    def test_pbft(self):
+        """Test that PBFT commits every request despite loss and a Byzantine replica, and halts without a quorum."""
+        simulation = PBFTSimulation(7, model=self.model, request_rate=500, byzantine=[6])
+        report = simulation.run(10)
+        self.assertGreater(report['blocks'], 100)
+        self.assertLess(report['finality_p99'], 1)
+        self.assertLess(report['pending_requests'], 500)  # Only the last second's requests are still in flight
+
+        simulation = PBFTSimulation(7, model=self.model)
+        for node in (4, 5, 6):
+            simulation.network.crash(node)
+        self.assertEqual(simulation.run(10)['blocks'], 0)
+
+    def test_vote(self):
+        """Test that byzantine_fault_tolerance decides with up to a third of Byzantine nodes and stalls beyond."""
+        model = NetworkModel(latency=0.05, jitter=0.05)  # Without loss, as every honest vote is needed
+        report = VoteSimulation(10, model=model, byzantine=range(3)).run(19.9)
+        self.assertEqual((report['blocks'], report['rounds']), (20, 20))
+        self.assertEqual(report['messages_per_block'], 90)
+        self.assertEqual(VoteSimulation(10, model=model, byzantine=range(4)).run(19.9)['blocks'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()